@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import glob
+import multiprocessing
+import os
+import time
+from typing import List, NamedTuple, Optional
+
+from cache import DEFAULT_CACHE_SIZE, FUNCTION_CACHE_DIR, CompileCache
+from parser import Compiler, build_tables
+
+# ワーカープロセスごとに 1 つだけ作る Compiler とキャッシュ
+_worker_compiler: Optional[Compiler] = None
+_worker_cache: Optional[CompileCache] = None
+
+
+class BatchItem(NamedTuple):
+    source: str
+    output: str
+    lines:  int
+    error:  Optional[str] = None
+    cached: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class BatchResult(object):
+    def __init__(self, items: List[BatchItem], elapsed: float, cache_enabled: bool = False):
+        super().__init__()
+        self.items         = items
+        self.elapsed       = elapsed
+        self.cache_enabled = cache_enabled
+
+    @property
+    def failures(self) -> List[BatchItem]:
+        return [item for item in self.items if not item.ok]
+
+    @property
+    def lines(self) -> int:
+        return sum(item.lines for item in self.items)
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed, 1e-9)
+        lines   = [
+            f"{len(self.items)} ファイル ({len(self.failures)} 件失敗), {self.elapsed:.2f} 秒: "
+            f"{len(self.items) / elapsed:,.1f} files/s, {self.lines / elapsed:,.0f} lines/s"
+        ]
+        if self.cache_enabled:
+            hits   = sum(item.cached for item in self.items)
+            lines += [f"キャッシュ: {hits} ヒット, {len(self.items) - hits} ミス"]
+        lines += [f"失敗: {item.source}: {item.error}" for item in self.failures]
+        return '\n'.join(lines)
+
+
+def collect_sources(pattern: str) -> List[str]:
+    '''
+    ディレクトリ (以下の全ての .p ファイル) かグロブパターンからソースファイルを集める
+    '''
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '**', '*.p')
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def output_path(source: str, outdir: Optional[str] = None, root: str = '') -> str:
+    '''
+    foo/bar.p -> foo/bar.ll (outdir を指定した場合は，root からの相対パスを outdir の下に置く)
+    '''
+    base = os.path.splitext(source)[0] + '.ll'
+    if outdir is None:
+        return base
+    return os.path.join(outdir, os.path.relpath(base, root or os.curdir))
+
+
+def _init_worker(optimization: Optional[dict], lexer: str, engine: str, cache_dir: Optional[str], cache_size: int):
+    global _worker_compiler, _worker_cache
+    build_tables()
+    _worker_cache  = None
+    function_cache = None
+    if cache_dir is not None:
+        _worker_cache  = CompileCache(cache_dir, cache_size)
+        function_cache = CompileCache(os.path.join(cache_dir, FUNCTION_CACHE_DIR), cache_size)
+    _worker_compiler = Compiler(optimization, lexer=lexer, engine=engine, function_cache=function_cache)
+
+
+def _compile_one(task) -> BatchItem:
+    source, output = task
+    with open(source, encoding='utf-8') as f:
+        data = f.read()
+    lines = data.count('\n') + 1
+
+    key     = None
+    content = None
+    if _worker_cache is not None:
+        key     = _worker_cache.key(data, _worker_compiler.optimization)
+        content = _worker_cache.get(key)
+    cached = content is not None
+
+    if not cached:
+        try:
+            content = _worker_compiler.compile(data)
+        except Exception as e:
+            return BatchItem(source, output, lines, f"{type(e).__name__}: {e}")
+        if key is not None:
+            _worker_cache.put(key, content)
+
+    # 途中まで書かれたファイルが見えないように，一時ファイルに書いてから置き換える
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with open(tmp, mode='w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp, output)
+    return BatchItem(source, output, lines, cached=cached)
+
+
+def run_batch(sources: List[str], jobs: Optional[int] = None, optimization: Optional[dict] = None,
+              lexer: str = 'ply', engine: str = 'ply', outdir: Optional[str] = None,
+              cache_dir: Optional[str] = None, cache_size: int = DEFAULT_CACHE_SIZE) -> BatchResult:
+    '''
+    sources をそれぞれ別の .ll ファイルにコンパイルする．
+    jobs 個のワーカープロセスは最後まで使い回すので，字句解析表・構文解析表の読み込みは 1 プロセス 1 回で済む．
+    cache_dir を指定すると，キャッシュにあるものは構文解析せずにそのまま書き出す．
+    '''
+    jobs  = jobs or os.cpu_count() or 1
+    # 別のディレクトリにある同じ名前のファイルが上書きし合わないように，共通のディレクトリからの構成を保つ
+    root  = os.path.commonpath([os.path.dirname(source) or os.curdir for source in sources]) if sources else ''
+    tasks = [(source, output_path(source, outdir, root)) for source in sources]
+    if outdir is not None:
+        for directory in sorted(set(os.path.dirname(output) for _, output in tasks)) or [outdir]:
+            os.makedirs(directory, exist_ok=True)
+
+    initargs = (optimization, lexer, engine, cache_dir, cache_size)
+    start    = time.perf_counter()
+    if jobs == 1:
+        _init_worker(*initargs)
+        items = [_compile_one(task) for task in tasks]
+    else:
+        chunksize = max(1, len(tasks) // (jobs * 8))
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=initargs) as pool:
+            items = list(pool.imap_unordered(_compile_one, tasks, chunksize))
+        items.sort(key=lambda item: item.source)
+
+    if cache_dir is not None:
+        CompileCache(cache_dir, cache_size).evict()
+        CompileCache(os.path.join(cache_dir, FUNCTION_CACHE_DIR), cache_size).evict()
+    return BatchResult(items, time.perf_counter() - start, cache_enabled=cache_dir is not None)
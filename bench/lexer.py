@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+'''
+字句解析の速度比較．
+pscripts/ 以下のプログラムを連結した大きな入力を PLY の字句解析器と FastLexer で字句解析する．
+
+    python bench/lexer.py --repeat 2000
+'''
+import argparse
+import glob
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import parser  # noqa: E402
+from fastlexer import FastLexer  # noqa: E402
+
+
+def count_tokens(lexer, data: str) -> int:
+    lexer.input(data)
+    n = 0
+    while lexer.token() is not None:
+        n += 1
+    return n
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--repeat', type=int, default=1000, help='pscripts/ を何回連結するか')
+    args = ap.parse_args()
+
+    sources = [open(f).read() for f in sorted(glob.glob(os.path.join(ROOT, 'pscripts', '*.p')))]
+    data    = '\n'.join(sources) * args.repeat
+    print(f"input: {len(data) / 1e6:.1f} MB")
+
+    results = {}
+    for name, lexer in [('ply', parser.get_lexer().clone()), ('fast', FastLexer(parser.reserved))]:
+        start = time.perf_counter()
+        n     = count_tokens(lexer, data)
+        elapsed = time.perf_counter() - start
+        results[name] = elapsed
+        print(f"{name:5s}: {n} tokens in {elapsed:.3f} s ({n / elapsed / 1e6:.2f} Mtokens/s)")
+
+    print(f"speedup: {results['ply'] / results['fast']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''
+命令列 (Fundecl.codes) のメモリ使用量．
+PL-X プログラムをコンパイルして得た命令を複製して --instructions 個の命令列を作り，
+1 命令あたりのバイト数 (オペランドの Factor を含む) を tracemalloc で測る．
+比較のため，以前と同じく __dict__ に属性を持つ命令・Factor (Legacy*) でも同じ命令列を作る．
+
+    python bench/memory.py --instructions 1000000
+'''
+import argparse
+import gc
+import io
+import os
+import sys
+import tracemalloc
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import llvmcodes  # noqa: E402
+from decls import Factor  # noqa: E402
+from parser import Compiler  # noqa: E402
+
+PROC_TEMPLATE = '''
+function f{i}(a, b);
+var x, y, z, w[0..9];
+begin
+    x := a * 2 + b div 3 - (a - b) * 4;
+    y := 0;
+    z := 1;
+    while x > 0 do
+    begin
+        if x >= y then
+            y := y + x * z
+        else
+            y := y - 1;
+        w[x div 10] := y;
+        x := x - 1
+    end;
+    for z := 1 to 10 do
+        y := y + f{prev}(z, y);
+    write(y);
+    f{i} := y
+end;
+'''
+
+
+def generate(procs: int) -> str:
+    body = ''.join(PROC_TEMPLATE.format(i=i, prev=max(i - 1, 0)) for i in range(procs))
+    return f"program MEMORY;\nvar n, m;\n{body}\nbegin\n    read(n);\n    m := f{procs - 1}(n, 1);\n    write(m)\nend.\n"
+
+
+class LegacyFactor(object):
+    '''
+    以前の実装と同じく __dict__ に属性を持つ Factor
+    '''
+    def __init__(self, scope, name, val, size, ptr_offset):
+        self.scope      = scope
+        self.name       = name
+        self.val        = val
+        self.size       = size
+        self.ptr_offset = ptr_offset
+
+
+class LegacyCode(object):
+    '''
+    以前の実装と同じく __dict__ に属性を持つ命令．
+    命令の種類ごとにサブクラスを作るので，__dict__ のキーの共有も以前と同じになる．
+    '''
+    def __init__(self, fields):
+        for name, value in fields:
+            setattr(self, name, value)
+
+
+LEGACY_CLASSES = {}
+
+
+def legacy_class(cls):
+    if cls not in LEGACY_CLASSES:
+        LEGACY_CLASSES[cls] = type(f'Legacy{cls.__name__}', (LegacyCode,), {})
+    return LEGACY_CLASSES[cls]
+
+
+def clone_factor(f, legacy: bool, memo: dict):
+    # コンパイラと同じく，1 つのレジスタの定義と使用は同じ Factor を共有する
+    if not isinstance(f, Factor):
+        return f
+    new = memo.get(id(f))
+    if new is None:
+        if legacy:
+            new = LegacyFactor(f.scope, f.name, f.val, f.size, f.ptr_offset)
+        else:
+            new = Factor(f.scope, name=f.name, val=f.val, size=f.size, ptr_offset=f.ptr_offset)
+        memo[id(f)] = new
+    return new
+
+
+def clone_operand(v, legacy: bool, memo: dict):
+    if type(v) is list:
+        return [clone_factor(f, legacy, memo) for f in v]
+    return clone_factor(v, legacy, memo)
+
+
+def clone_code(code, legacy: bool, memo: dict):
+    cls    = type(code)
+    fields = [(name, clone_operand(getattr(code, name), legacy, memo)) for name in cls.fields]
+    if legacy:
+        # 以前は二項演算の名前も命令ごとに持っていた
+        if isinstance(code, llvmcodes.LLVMCodeOperator):
+            fields.append(('operator', code.operator))
+        return legacy_class(cls)(fields)
+
+    new = cls.__new__(cls)
+    for name, value in fields:
+        setattr(new, name, value)
+    return new
+
+
+def measure(codes, n: int, legacy: bool) -> int:
+    gc.collect()
+    tracemalloc.start()
+    base  = tracemalloc.get_traced_memory()[0]
+    built = []
+    while len(built) < n:
+        memo   = {}
+        built += [clone_code(code, legacy, memo) for code in codes[:n - len(built)]]
+        # memo 自体の大きさは含めない
+        del memo
+    size  = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del built
+    return size
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--instructions', type=int, default=1000000, help='作る命令列の長さ')
+    ap.add_argument('--procs', type=int, default=200, help='元にするプログラムの関数の数')
+    args = ap.parse_args()
+
+    compiler = Compiler()
+    with redirect_stdout(io.StringIO()):
+        compiler.compile(generate(args.procs))
+    codes = [code for fn in compiler.codegen.functions for code in fn.codes]
+    print(f"source: {len(codes):,} instructions, sample: {args.instructions:,} instructions")
+
+    legacy  = measure(codes, args.instructions, legacy=True)
+    slotted = measure(codes, args.instructions, legacy=False)
+    n       = args.instructions
+    print(f"legacy  (__dict__)  : {legacy / 2**20:8.1f} MiB ({legacy / n:6.1f} bytes/instruction)")
+    print(f"slotted (__slots__) : {slotted / 2**20:8.1f} MiB ({slotted / n:6.1f} bytes/instruction)")
+    print(f"reduction           : {1 - slotted / legacy:.1%}")
+
+
+if __name__ == '__main__':
+    main()
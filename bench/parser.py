@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+'''
+構文解析の速度比較．
+大きな PL-X プログラムを生成し，PLY (LALR) と再帰下降の構文解析器で解析する．
+parse は意味動作を空にした構文解析のみ，compile は LLVM IR の生成までを含む時間．
+
+    python bench/parser.py --procs 300
+'''
+import argparse
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import parser  # noqa: E402
+from fastlexer import FastLexer  # noqa: E402
+from rdparser import RecursiveDescentParser  # noqa: E402
+
+PROC_TEMPLATE = '''
+function f{i}(a, b);
+var x, y, z;
+begin
+    x := a * 2 + b div 3 - (a - b) * 4;
+    y := 0;
+    z := 1;
+    while x > 0 do
+    begin
+        if x >= y then
+            y := y + x * z
+        else
+            y := y - 1;
+        x := x - 1
+    end;
+    for z := 1 to 10 do
+        y := y + f{prev}(z, y);
+    write(y);
+    f{i} := y
+end;
+'''
+
+
+def generate(procs: int) -> str:
+    body = ''.join(PROC_TEMPLATE.format(i=i, prev=max(i - 1, 0)) for i in range(procs))
+    return f"program BENCH;\nvar n, m;\n{body}\nbegin\n    read(n);\n    m := f{procs - 1}(n, 1);\n    write(m)\nend.\n"
+
+
+class NullCompiler(object):
+    '''
+    意味動作を全て何もしないメソッドにした Compiler．構文解析だけの時間を測るのに使う．
+    '''
+    def __getattr__(self, name):
+        noop = lambda *args, **kwargs: None  # noqa: E731
+        setattr(self, name, noop)
+        return noop
+
+
+def parse_ply(data: str):
+    lexer = parser.get_lexer().clone()
+    lexer.lineno = 1
+    ply_parser = parser.get_parser()
+    ply_parser.compiler = NullCompiler()
+    ply_parser.parse(data, lexer=lexer)
+
+
+def parse_rd(data: str):
+    RecursiveDescentParser(NullCompiler(), FastLexer(parser.reserved)).parse(data)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--procs', type=int, default=300, help='生成するプログラムの関数の数')
+    args = ap.parse_args()
+
+    data  = generate(args.procs)
+    lines = data.count('\n')
+    print(f"input: {lines} lines, {len(data) / 1e3:.0f} KB")
+
+    parser.get_parser()
+    ply_parse = timed(parse_ply, data)
+    rd_parse  = timed(parse_rd, data)
+
+    with redirect_stdout(io.StringIO()):
+        ply_compile = timed(parser.compile_source, data)
+        rd_compile  = timed(parser.compile_source, data, None, 'fast', 'rd')
+
+    print(f"parse    ply (LALR + PLY lexer): {ply_parse:.3f} s ({lines / ply_parse:,.0f} lines/s)")
+    print(f"parse    rd  (RD + FastLexer)  : {rd_parse:.3f} s ({lines / rd_parse:,.0f} lines/s)")
+    print(f"parse    speedup               : {ply_parse / rd_parse:.2f}x")
+    print(f"compile  ply                   : {ply_compile:.3f} s")
+    print(f"compile  rd                    : {rd_compile:.3f} s")
+    print(f"compile  speedup               : {ply_compile / rd_compile:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
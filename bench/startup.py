@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''
+起動時間の計測．
+`python parser.py` 相当のプロセスを起動し，最初のトークンを読み出すまでの時間を測る．
+cold は生成済みの表を消してから，warm は表が揃っている状態で計測する．
+
+    python bench/startup.py --runs 10 --budget-ms 150
+'''
+import argparse
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_TOKEN = '''
+import parser
+lexer = parser.get_lexer().clone()
+lexer.input(open({source!r}).read())
+lexer.token()
+'''
+
+FIRST_PARSE = FIRST_TOKEN + '''
+parser.get_parser()
+'''
+
+
+def remove_tables():
+    for path in glob.glob(os.path.join(ROOT, 'plx_*tab_*.py')):
+        os.remove(path)
+
+
+def measure(snippet: str, runs: int, cold: bool):
+    times = []
+    for _ in range(runs):
+        if cold:
+            remove_tables()
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', snippet], cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--runs', type=int, default=5)
+    ap.add_argument('--budget-ms', type=float, default=150.0,
+                    help='warm 状態での最初のトークンまでの時間の上限')
+    ap.add_argument('--source', default=os.path.join(ROOT, 'pscripts', 'pl3a.p'))
+    args = ap.parse_args()
+
+    first_token = FIRST_TOKEN.format(source=args.source)
+    first_parse = FIRST_PARSE.format(source=args.source)
+
+    interpreter = measure('pass', args.runs, cold=False)
+    cold_token  = measure(first_token, args.runs, cold=True)
+    warm_token  = measure(first_token, args.runs, cold=False)
+    cold_parse  = measure(first_parse, args.runs, cold=True)
+    warm_parse  = measure(first_parse, args.runs, cold=False)
+
+    print(f"interpreter only        : {interpreter:8.1f} ms")
+    print(f"first token   (cold)    : {cold_token:8.1f} ms")
+    print(f"first token   (warm)    : {warm_token:8.1f} ms")
+    print(f"parser ready  (cold)    : {cold_parse:8.1f} ms")
+    print(f"parser ready  (warm)    : {warm_parse:8.1f} ms")
+    print(f"budget (first token)    : {args.budget_ms:8.1f} ms")
+
+    if warm_token > args.budget_ms:
+        print("起動時間が予算を超えています")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
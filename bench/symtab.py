@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+'''
+記号表の規模に対する速度の変化．
+n 個の大域変数と n 個の手続き (それぞれ局所変数を 4 つ持つ) を登録し，
+大域変数の検索・手続きの検索・局所変数の追加と削除にかかる時間を測る．
+比較のため，以前のリストを走査する記号表 (LegacySymbolTable) も --legacy-max まで計測する．
+
+    python bench/symtab.py
+'''
+import argparse
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from symtab import Scope, Symbol, SymbolTable  # noqa: E402
+
+
+class LegacySymbolTable(object):
+    '''
+    以前の実装と同じくリストを走査する記号表 (表示は省略)
+    '''
+    def __init__(self):
+        self.symbols = []
+        self.local_depth = 0
+
+    def insert(self, token, scope=None, register=None, size=0, ptr_offset=0):
+        if type(scope) is str:
+            scope = Scope.from_str(scope)
+        self.symbols.append(Symbol(token, scope=scope, register=register, size=size, ptr_offset=ptr_offset))
+
+    def lookup(self, token, scope_condition=None, args_cnt=None):
+        found = [
+            r for r in self.symbols
+            if r.name == token and
+               (args_cnt        is None or r.args_cnt == args_cnt) and
+               (scope_condition is None or r.scope in scope_condition)]
+        if not len(found) > 0:
+            raise RuntimeError(token)
+        return found[-1]
+
+    def remove_local_var(self):
+        self.symbols = [s for s in self.symbols if s.scope != Scope.LOCAL]
+
+
+def run(table_class, n: int) -> float:
+    symtab = table_class()
+    start  = time.perf_counter()
+    for i in range(n):
+        symtab.insert(f"g{i}", scope=Scope.GLOBAL)
+    for i in range(n):
+        symtab.insert(f"p{i}", 'proc')
+        for j in range(4):
+            symtab.insert(f"l{j}", scope=Scope.LOCAL, register=j + 1)
+        symtab.lookup(f"l{i % 4}")
+        symtab.lookup(f"g{i}")
+        symtab.lookup(f"p{i}", [Scope.FUNC], args_cnt=0)
+        symtab.remove_local_var()
+    return time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    ap.add_argument('--legacy-max', type=int, default=1000)
+    args = ap.parse_args()
+
+    print(f"{'n':>8} {'SymbolTable':>14} {'per op':>10} {'Legacy':>12}")
+    for n in args.sizes:
+        ops = n * 10
+        with redirect_stdout(io.StringIO()):
+            elapsed = run(SymbolTable, n)
+        legacy = f"{run(LegacySymbolTable, n):10.3f} s" if n <= args.legacy_max else f"{'-':>12}"
+        print(f"{n:>8} {elapsed:12.3f} s {elapsed / ops * 1e6:7.2f} us {legacy}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+from functools import lru_cache
+from typing import Dict, Optional
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 生成された表やテストは出力に影響しないのでバージョンに含めない
+VERSION_EXCLUDE = ('test.py',)
+VERSION_EXCLUDE_PREFIX = ('plx_lextab_', 'plx_parsetab_')
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# キャッシュのディレクトリの中で，関数ごとの LLVM IR を置くディレクトリ
+FUNCTION_CACHE_DIR = 'functions'
+
+# put() をこの回数行うごとにキャッシュの大きさを確かめる
+EVICT_INTERVAL = 64
+
+# コード生成器が作るラベル (while.init.3 など)．番号はプログラム全体の通し番号になっている．
+# 展開した関数の名前が前に付いたラベル (prime.while.body.3.2 など) は含めない
+LABEL_RE = re.compile(r'(?<![\w.])((?:while|if|for)\.[a-z]+)\.(\d+)\b')
+
+
+def rebase_labels(ir: str, offset: int) -> str:
+    '''
+    ir の中のラベル番号を offset だけずらす．
+    関数ごとのキャッシュには関数の先頭のラベルを 0 として保存し，使うときに元の番号に戻す．
+    '''
+    if offset == 0:
+        return ir
+    return LABEL_RE.sub(lambda m: f"{m.group(1)}.{int(m.group(2)) + offset}", ir)
+
+
+@lru_cache(maxsize=None)
+def compiler_version() -> str:
+    '''
+    コンパイラのソースコード (トップレベルの .py ファイル) から求めたハッシュ値．
+    コンパイラを変更すると古いキャッシュは自動で使われなくなる．
+    '''
+    h = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(ROOT, '*.py'))):
+        name = os.path.basename(path)
+        if name in VERSION_EXCLUDE or name.startswith(VERSION_EXCLUDE_PREFIX):
+            continue
+        h.update(name.encode())
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+class CompileCache(object):
+    '''
+    ソースコード・最適化オプション・コンパイラのバージョンをキーにした LLVM IR のディスクキャッシュ．
+    書き込みは一時ファイルからの os.replace で行うので，複数のプロセスが同じディレクトリを共有してもよい．
+    大きさが max_bytes を超えると，最後に使われた時刻 (mtime) が古いものから削除する．
+    '''
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_SIZE):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits      = 0
+        self.misses    = 0
+        self.stores    = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, data: str, optimization: Optional[dict] = None) -> str:
+        h = hashlib.sha256()
+        h.update(compiler_version().encode())
+        h.update(json.dumps(optimization or {}, sort_keys=True).encode())
+        h.update(data.encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.ll')
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                content = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # LRU のために使った時刻を更新する (他のプロセスに削除されていてもよい)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return content
+
+    def put(self, key: str, content: str):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode='w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        self.stores += 1
+        if self.stores % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total   = 0
+        for path in glob.glob(os.path.join(self.directory, '*', '*.ll')):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits':      self.hits,
+            'misses':    self.misses,
+            'stores':    self.stores,
+            'evictions': self.evictions,
+        }
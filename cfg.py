@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+import copy
+from typing import Dict, Iterator, List, Optional
+
+from decls import Factor, Fundecl
+from llvmcodes import LLVMCode, LLVMCodeBrUncond, LLVMCodeRegisterLabel, Opcode
+from symtab import Scope
+
+TERMINATORS = (Opcode.BR_UNCOND, Opcode.BR_COND, Opcode.RET)
+
+# phi から参照するために，ラベルのない入口のブロックに付けるラベル (コード生成器のラベルは必ず . を含む)
+ENTRY_LABEL = 'entry'
+
+
+def label_factor(label: str) -> Factor:
+    '''
+    分岐命令のオペランドになるラベル (%while.init.0 など)
+    '''
+    return Factor(Scope.LOCAL, val=label)
+
+
+def branch_targets(code: LLVMCode) -> List[str]:
+    if code.opcode == Opcode.BR_UNCOND:
+        return [code.arg1.val]
+    if code.opcode == Opcode.BR_COND:
+        return [code.arg2.val, code.arg3.val]
+    return []
+
+
+def register_of(f) -> Optional[int]:
+    '''
+    f が局所レジスタ (引数を含む) なら仮想レジスタ番号，それ以外 (定数・大域変数・ラベル) は None
+    '''
+    if type(f) is Factor and f.scope == Scope.LOCAL and type(f.val) is int:
+        return f.val
+    return None
+
+
+def used_values(code: LLVMCode) -> Iterator:
+    '''
+    code が値として読み出すオペランド
+    '''
+    for field in code.uses:
+        value = getattr(code, field)
+        if type(value) is list:
+            yield from value
+        else:
+            yield value
+
+
+def replace_uses(code: LLVMCode, replace: Dict[int, Factor]):
+    '''
+    code が読み出すレジスタのうち replace にあるものを置き換える (Factor は共有されているので書き換えない)
+    '''
+    for field in code.uses:
+        value = getattr(code, field)
+        if type(value) is list:
+            for i, v in enumerate(value):
+                r = register_of(v)
+                if r is not None and r in replace:
+                    value[i] = replace[r]
+        else:
+            r = register_of(value)
+            if r is not None and r in replace:
+                setattr(code, field, replace[r])
+
+
+def clone_code(code: LLVMCode, replace: Dict[int, Factor], register) -> LLVMCode:
+    '''
+    code の複製．読み出すレジスタは replace で置き換え，結果は register() で作った新しいレジスタに書き込む．
+    元の結果のレジスタ -> 新しいレジスタを replace に加えるので，続く命令の複製は新しい結果を読む．
+    '''
+    clone = copy.copy(code)
+    for field in code.fields:
+        value = getattr(code, field)
+        if type(value) is list:
+            setattr(clone, field, list(value))
+    replace_uses(clone, replace)
+    if code.defines is not None:
+        r = register_of(getattr(code, code.defines))
+        if r is not None:
+            f = Factor(Scope.LOCAL, val=register())
+            setattr(clone, code.defines, f)
+            replace[r] = f
+    return clone
+
+
+class BasicBlock(object):
+    '''
+    基本ブロック．codes にはラベルを含めず，最後の命令が終端命令 (br / ret) になる．
+    preds / succs は CFG の編集メソッドを通して更新する．
+    '''
+    __slots__ = ('label', 'codes', 'preds', 'succs')
+
+    def __init__(self, label: Optional[str], codes: Optional[List[LLVMCode]] = None):
+        super().__init__()
+        self.label = label
+        self.codes: List[LLVMCode]       = codes if codes is not None else []
+        self.preds: List['BasicBlock']   = []
+        self.succs: List['BasicBlock']   = []
+
+    @property
+    def terminator(self) -> Optional[LLVMCode]:
+        if len(self.codes) > 0 and self.codes[-1].opcode in TERMINATORS:
+            return self.codes[-1]
+        return None
+
+    def phis(self) -> Iterator[LLVMCode]:
+        '''
+        ブロックの先頭に並ぶ phi
+        '''
+        for code in self.codes:
+            if code.opcode != Opcode.PHI:
+                break
+            yield code
+
+    @property
+    def body(self) -> List[LLVMCode]:
+        '''
+        終端命令を除いた命令
+        '''
+        return self.codes[:-1] if self.terminator is not None else self.codes
+
+    def __str__(self) -> str:
+        return self.label if self.label is not None else '<entry>'
+
+    def __repr__(self) -> str:
+        return f'<BasicBlock {self}>'
+
+
+class CFG(object):
+    '''
+    Fundecl.codes を基本ブロックに分けた制御フローグラフ．
+    ブロックの並び (blocks) がそのまま出力の順番になり，先頭が入口のブロック．
+    並びはブロックごとの前後のブロックで持つので，ブロックの追加は並びの長さによらない．
+    グラフを変える操作は version を 1 つ進め，逆後順 (rpo) などの解析結果はその version の間だけ使い回す．
+    '''
+
+    def __init__(self, blocks: List[BasicBlock], name: Optional[str] = None):
+        super().__init__()
+        self.name    = name
+        self.blocks  = blocks
+        self.labels: Dict[str, BasicBlock] = {b.label: b for b in blocks if b.label is not None}
+        self.version = 0
+        self.analyses: Dict[str, tuple] = {}  # 名前 -> (version, 結果)
+        self.label_cnt = 0
+
+        for block in blocks:
+            for label in self.successor_labels(block):
+                self.link(block, self.labels[label])
+
+    @classmethod
+    def from_codes(cls, codes: List[LLVMCode], name: Optional[str] = None) -> 'CFG':
+        '''
+        ラベルと終端命令の位置で命令列を基本ブロックに分ける．
+        終端命令なしで次のラベルに続くブロックには，明示的な br を補う．
+        '''
+        blocks = [BasicBlock(None)]
+        for code in codes:
+            last = blocks[-1]
+            if code.opcode == Opcode.LABEL:
+                if len(blocks) == 1 and last.label is None and not len(last.codes) > 0:
+                    # 入口のブロックにラベルが付いている
+                    last.label = code.label
+                    continue
+                if last.terminator is None:
+                    last.codes.append(LLVMCodeBrUncond(label_factor(code.label)))
+                blocks.append(BasicBlock(code.label))
+                continue
+            if last.terminator is not None:
+                # 終端命令の後にラベルなしで続く命令 (到達しない)
+                blocks.append(BasicBlock(None))
+            blocks[-1].codes.append(code)
+        return cls(blocks, name)
+
+    @classmethod
+    def from_fundecl(cls, fn: Fundecl) -> 'CFG':
+        return cls.from_codes(fn.codes, fn.name)
+
+    def to_codes(self) -> List[LLVMCode]:
+        codes = []
+        for block in self.blocks:
+            if block.label is not None:
+                codes.append(LLVMCodeRegisterLabel(block.label))
+            codes += block.codes
+        return codes
+
+    # NOTE: ブロックの並び
+
+    @property
+    def blocks(self) -> List[BasicBlock]:
+        '''
+        ブロックの並び．並びを変えた後に初めて読むときにリストを作り直す (リストを書き換えても並びは変わらない)
+        '''
+        if self.order is None:
+            order = []
+            block = self.head
+            while block is not None:
+                order.append(block)
+                block = self.nexts[id(block)]
+            self.order = order
+        return self.order
+
+    @blocks.setter
+    def blocks(self, blocks: List[BasicBlock]):
+        self.head  = blocks[0] if len(blocks) > 0 else None
+        self.tail  = blocks[-1] if len(blocks) > 0 else None
+        self.prevs: Dict[int, Optional[BasicBlock]] = {id(b): p for p, b in zip([None] + blocks[:-1], blocks)}
+        self.nexts: Dict[int, Optional[BasicBlock]] = {id(b): n for b, n in zip(blocks, blocks[1:] + [None])}
+        self.order = list(blocks)
+
+    def previous(self, block: BasicBlock) -> Optional[BasicBlock]:
+        '''
+        並びで block の直前のブロック (入口なら None)
+        '''
+        return self.prevs[id(block)]
+
+    # NOTE: 参照
+
+    @property
+    def entry(self) -> BasicBlock:
+        return self.head
+
+    def block(self, label: str) -> BasicBlock:
+        return self.labels[label]
+
+    def label_of(self, block: BasicBlock) -> str:
+        '''
+        block のラベル．ラベルのない入口のブロックには ENTRY_LABEL を付ける
+        '''
+        if block.label is None:
+            assert block is self.entry
+            block.label = ENTRY_LABEL
+            self.labels[ENTRY_LABEL] = block
+        return block.label
+
+    def successor_labels(self, block: BasicBlock) -> List[str]:
+        t = block.terminator
+        return branch_targets(t) if t is not None else []
+
+    def instructions(self) -> Iterator[LLVMCode]:
+        for block in self.blocks:
+            yield from block.codes
+
+    def __len__(self) -> int:
+        return len(self.nexts)
+
+    def __str__(self) -> str:
+        lines = []
+        for block in self.blocks:
+            preds = ', '.join(str(p) for p in block.preds)
+            succs = ', '.join(str(s) for s in block.succs)
+            lines.append(f"{block}: preds=[{preds}] succs=[{succs}] ({len(block.codes)} 命令)")
+        return '\n'.join(lines)
+
+    # NOTE: 解析結果のキャッシュ
+
+    def invalidate(self):
+        '''
+        グラフの形を変えたときに呼ぶ．version が変わると以前の解析結果は使われなくなる．
+        '''
+        self.version += 1
+
+    def cached(self, name: str, compute):
+        entry = self.analyses.get(name)
+        if entry is not None and entry[0] == self.version:
+            return entry[1]
+        result = compute()
+        self.analyses[name] = (self.version, result)
+        return result
+
+    def rpo(self) -> List[BasicBlock]:
+        '''
+        入口から到達できるブロックの逆後順
+        '''
+        return self.cached('rpo', self._compute_rpo)
+
+    def _compute_rpo(self) -> List[BasicBlock]:
+        order   = []
+        visited = {id(self.entry)}
+        stack   = [(self.entry, iter(self.entry.succs))]
+        while stack:
+            block, it = stack[-1]
+            for succ in it:
+                if id(succ) not in visited:
+                    visited.add(id(succ))
+                    stack.append((succ, iter(succ.succs)))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        order.reverse()
+        return order
+
+    def rpo_index(self) -> Dict[int, int]:
+        '''
+        id(ブロック) -> 逆後順での番号
+        '''
+        return self.cached('rpo_index', lambda: {id(b): i for i, b in enumerate(self.rpo())})
+
+    def reachable(self, block: BasicBlock) -> bool:
+        return id(block) in self.rpo_index()
+
+    # NOTE: 編集
+
+    def link(self, pred: BasicBlock, succ: BasicBlock):
+        pred.succs.append(succ)
+        succ.preds.append(pred)
+        self.invalidate()
+
+    def unlink(self, pred: BasicBlock, succ: BasicBlock):
+        pred.succs.remove(succ)
+        succ.preds.remove(pred)
+        self.invalidate()
+
+    def new_label(self, prefix: str) -> str:
+        while True:
+            label = f"{prefix}.{self.label_cnt}"
+            self.label_cnt += 1
+            if label not in self.labels:
+                return label
+
+    def add_block(self, label: str, after: Optional[BasicBlock] = None) -> BasicBlock:
+        '''
+        空のブロックを after の直後 (省略時は末尾) に追加する
+        '''
+        block = BasicBlock(label)
+        prev  = after if after is not None else self.tail
+        succ  = self.nexts[id(prev)] if prev is not None else None
+        self.prevs[id(block)] = prev
+        self.nexts[id(block)] = succ
+        if prev is None:
+            self.head = block
+        else:
+            self.nexts[id(prev)] = block
+        if succ is None:
+            self.tail = block
+        else:
+            self.prevs[id(succ)] = block
+        self.order = None
+        self.labels[label] = block
+        self.invalidate()
+        return block
+
+    def set_terminator(self, block: BasicBlock, code: LLVMCode):
+        '''
+        block の終端命令を code に置き換え，辺を付け直す．行き先でなくなったブロックの phi からは block の値を除く
+        '''
+        targets = branch_targets(code)
+        for succ in list(block.succs):
+            self.unlink(block, succ)
+            if succ.label not in targets:
+                self.remove_incoming(succ, block)
+        if block.terminator is not None:
+            block.codes[-1] = code
+        else:
+            block.codes.append(code)
+        for label in targets:
+            self.link(block, self.labels[label])
+
+    def remove_incoming(self, block: BasicBlock, pred: BasicBlock):
+        '''
+        block の phi から pred を通って来たときの値を除く
+        '''
+        if pred.label is None:
+            return
+        for phi in block.phis():
+            keep = [i for i, l in enumerate(phi.labels) if l.val != pred.label]
+            phi.values = [phi.values[i] for i in keep]
+            phi.labels = [phi.labels[i] for i in keep]
+
+    def rename_incoming(self, block: BasicBlock, old: str, new: str):
+        '''
+        block の phi の，ラベル old から来たときの値をラベル new からの値にする
+        '''
+        for phi in block.phis():
+            phi.labels = [label_factor(new) if l.val == old else l for l in phi.labels]
+
+    def retarget(self, block: BasicBlock, old: BasicBlock, new: BasicBlock):
+        '''
+        block から old への分岐を new への分岐に付け替える
+        '''
+        t = block.terminator
+        for field in ('arg1', 'arg2', 'arg3'):
+            if field in t.fields:
+                f = getattr(t, field)
+                if isinstance(f, Factor) and f.val == old.label:
+                    setattr(t, field, label_factor(new.label))
+        while old in block.succs:
+            self.unlink(block, old)
+            self.link(block, new)
+
+    def split_edge(self, pred: BasicBlock, succ: BasicBlock, prefix: str = 'split',
+                   label: Optional[str] = None) -> BasicBlock:
+        '''
+        pred -> succ の辺の間に新しいブロックを挟む (ブロックは succ の直前に置く)．label を省略すると prefix.N
+        '''
+        block = self.add_block(label or self.new_label(prefix), after=self.previous(succ))
+        self.retarget(pred, succ, block)
+        self.set_terminator(block, LLVMCodeBrUncond(label_factor(succ.label)))
+        if pred.label is not None:
+            self.rename_incoming(succ, pred.label, block.label)
+        return block
+
+    def merge_blocks(self) -> int:
+        '''
+        無条件分岐の行き先が他から分岐されないブロックなら，分岐元の末尾につなげて 1 つのブロックにする．
+        行き先に phi がある場合はまとめない．まとめた数を返す．
+        '''
+        merged = set()
+        for block in self.blocks:
+            if id(block) in merged:
+                continue
+            while block.terminator is not None and block.terminator.opcode == Opcode.BR_UNCOND:
+                succ = block.succs[0]
+                if succ is block or succ is self.entry or len(succ.preds) != 1 or next(succ.phis(), None) is not None:
+                    break
+                next_blocks = list(succ.succs)
+                for s in next_blocks:
+                    self.unlink(succ, s)
+                self.unlink(block, succ)
+                del block.codes[-1]
+                block.codes.extend(succ.codes)
+                for s in next_blocks:
+                    self.link(block, s)
+                    if next(s.phis(), None) is not None:
+                        self.rename_incoming(s, succ.label, self.label_of(block))
+                del self.labels[succ.label]
+                merged.add(id(succ))
+
+        if len(merged) > 0:
+            self.blocks = [b for b in self.blocks if id(b) not in merged]
+            self.invalidate()
+        return len(merged)
+
+    def remove_unreachable(self) -> int:
+        '''
+        入口から到達できないブロックを削除し，削除した数を返す
+        '''
+        dead = [b for b in self.blocks if not self.reachable(b)]
+        for block in dead:
+            for succ in list(block.succs):
+                self.unlink(block, succ)
+                self.remove_incoming(succ, block)
+        for block in dead:
+            for pred in list(block.preds):
+                self.unlink(pred, block)
+            if block.label is not None:
+                del self.labels[block.label]
+        if len(dead) > 0:
+            removed     = set(id(b) for b in dead)
+            self.blocks = [b for b in self.blocks if id(b) not in removed]
+            self.invalidate()
+        return len(dead)
@@ -1,24 +1,56 @@
 # -*- coding: utf-8 -*-
-from typing import List
+import hashlib
+import io
+from typing import Dict, List, Optional, Set, TextIO
 
+from cache import CompileCache, rebase_labels
 from decls import Factor, Fundecl
 from llvmcodes import (LLVMCode, LLVMCodeDeclarePrintf, LLVMCodeDeclareScanf,
-                       LLVMCodeReadFormat, LLVMCodeWriteFormat)
+                       LLVMCodeReadFormat, LLVMCodeWriteFormat, Opcode)
+from inline import INLINE_CANDIDATE_SIZE
+from passes import Pipeline
+from tailcall import mark_tail_calls, merge_recursion
+from tracing import Tracer
+
+# ファイルに書き出すときのバッファの大きさ
+WRITE_BUFFER_SIZE = 1 << 16
 
 
 class CodeGenerator(object):
-    def __init__(self, optimization) -> None:
+    def __init__(self, optimization, tracer: Optional[Tracer] = None,
+                 function_cache: Optional[CompileCache] = None, stream: Optional[TextIO] = None) -> None:
         super().__init__()
+        self.tracer         = tracer or Tracer()
+        self.function_cache = function_cache
+
+        # ストリーミング出力の書き出し先 (None のときは to_string でまとめて出力する)
+        self.stream          = stream
+        self.globals_flushed = False
+        self.blocks_written  = 0
         # グローバル変数を定義するための Fundecl を用意
-        self.functions:   List[Fundecl] = [Fundecl()]
+        self.functions:   List[Fundecl] = [Fundecl(tracer=self.tracer)]
         self.factorstack: List[Factor]  = []
         self.lbl_stack:   List[int]     = []
+        # while の条件式の命令 (while_rotation のときにループの末尾に複製する)
+        self.loop_stack:  List          = []
 
         self.write_enabled = False
         self.read_enabled  = False
 
         self.lbl_cnt      = 0
         self.optimization = optimization
+        self.pipeline     = Pipeline.from_options(optimization, self.tracer)
+        # 関数を展開するときと末尾呼び出しを扱うときは，呼び出される関数を先に最適化する．
+        # ストリーミング出力では，まだ本体のない (forward で宣言した) 関数を呼び出す関数の書き出しを待たせる
+        self.inlining        = self.pipeline is not None and self.pipeline.inliner is not None
+        self.tail_calls      = bool(optimization.get('tail_calls'))
+        self.interprocedural = self.inlining or self.tail_calls
+        self.defined:    Set[str]      = set()
+        self.optimized:  Set[str]      = set()
+        self.procedures: Set[str]      = set()
+        self.pending:    List[Fundecl] = []
+        # 関数の名前 -> 呼び出す関数の fingerprint を含めた fingerprint
+        self.fingerprints: Dict[str, str] = {}
 
     @property
     def current_function(self):
@@ -34,7 +66,7 @@ class CodeGenerator(object):
         return t
 
     def add_function(self, name: str):
-        self.functions.append(Fundecl(name, optimize_deadcode=self.optimization["remove_deadcode"]))
+        self.functions.append(Fundecl(name, tracer=self.tracer, pipeline=self.pipeline))
     
     def move_to_last(self, name: str):
         found = [i for i, fn in enumerate(self.functions) if fn.name == name]
@@ -61,7 +93,10 @@ class CodeGenerator(object):
     def push_code(self, code: LLVMCode, func_idx=-1):
         self.functions[func_idx].codes.append(code)
 
-    def export(self, filename, verbose=False):
+    def push_declarations(self):
+        '''
+        printf / scanf を使っていれば，書式文字列と関数の宣言を大域変数の Fundecl に追加する
+        '''
         if self.write_enabled:
             self.push_code(LLVMCodeWriteFormat(),   func_idx=0)
             self.push_code(LLVMCodeDeclarePrintf(), func_idx=0)
@@ -69,14 +104,235 @@ class CodeGenerator(object):
             self.push_code(LLVMCodeReadFormat(),    func_idx=0)
             self.push_code(LLVMCodeDeclareScanf(),  func_idx=0)
 
-        blocks  = [f.to_string() for f in self.functions]
-        content = '\n'.join(blocks)
+    def to_string(self):
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+    def write(self, out: TextIO):
+        '''
+        全ての関数を順に out に書き出す (関数全体を 1 つの文字列にまとめることはしない)
+        '''
+        self.push_declarations()
+        if self.interprocedural:
+            # 相互再帰をまとめた関数は main の前に置く
+            for merged in self.optimize_callees(self.functions, self.functions):
+                self.functions.insert(len(self.functions) - 1, merged)
+        for i, fn in enumerate(self.functions):
+            if i > 0:
+                out.write('\n')
+            self.write_function(fn, out)
+
+    def write_function(self, fn: Fundecl, out: TextIO):
+        if self.function_cache is None or fn.fingerprint is None:
+            fn.write(out)
+        else:
+            out.write(self.function_to_string(fn))
+
+    # NOTE: 関数の展開
+
+    @staticmethod
+    def callees(fn: Fundecl) -> List[str]:
+        names = []
+        for code in fn.codes:
+            if code.opcode == Opcode.CALL and code.func.name not in names:
+                names.append(code.func.name)
+        return names
+
+    def components(self, roots: List[Fundecl], table: Dict[str, Fundecl]) -> List[List[Fundecl]]:
+        '''
+        roots から table の関数をたどり，呼び出しグラフの強連結成分を呼び出される側から順に並べる (Tarjan のアルゴリズム)．
+        成分の中の関数は，深さ優先探索で先に帰りがけになったものから並ぶ．
+        '''
+        index:    Dict[str, int]      = {}
+        low:      Dict[str, int]      = {}
+        stack:    List[Fundecl]       = []
+        on_stack: Set[str]            = set()
+        result:   List[List[Fundecl]] = []
+
+        def visit(fn: Fundecl):
+            index[fn.name] = low[fn.name] = len(index)
+            stack.append(fn)
+            on_stack.add(fn.name)
+
+        for root in roots:
+            if root.name not in table or root.name in index:
+                continue
+            visit(root)
+            work = [(root, iter(self.callees(root)))]
+            while work:
+                fn, names = work[-1]
+                name = next(names, None)
+                if name is not None:
+                    if name not in table:
+                        continue
+                    if name not in index:
+                        visit(table[name])
+                        work.append((table[name], iter(self.callees(table[name]))))
+                    elif name in on_stack:
+                        low[fn.name] = min(low[fn.name], index[name])
+                    continue
+                work.pop()
+                if len(work) > 0:
+                    caller = work[-1][0].name
+                    low[caller] = min(low[caller], low[fn.name])
+                if low[fn.name] == index[fn.name]:
+                    component = []
+                    while True:
+                        f = stack.pop()
+                        on_stack.discard(f.name)
+                        component.append(f)
+                        if f is fn:
+                            break
+                    result.append(component)
+        return result
+
+    def optimize_callees(self, roots: List[Fundecl], functions: List[Fundecl]) -> List[Fundecl]:
+        '''
+        roots から呼び出しグラフを帰りがけ順にたどり，呼び出される関数から先に最適化する (再帰の輪は 1 度だけたどる)．
+        関数キャッシュのために，呼び出す関数の fingerprint のハッシュ値を呼び出し元の fingerprint に含める．
+        キャッシュを使うときは展開の候補になる小さな関数だけを先に最適化し，それ以外は書き出すときに任せる．
+        tail_calls のときは全ての関数を最適化してから末尾呼び出しに印を付け，相互再帰をまとめた関数を返す．
+        '''
+        table: Dict[str, Fundecl] = {fn.name: fn for fn in functions
+                                     if fn.name is not None and fn.name not in self.optimized}
+        for fn in table.values():
+            if not fn.is_func:
+                self.procedures.add(fn.name)
+
+        merged: List[Fundecl] = []
+        for component in self.components(roots, table):
+            for fn in component:
+                if fn.fingerprint is not None:
+                    for callee in self.callees(fn):
+                        if callee in self.fingerprints:
+                            fn.fingerprint += f"\ncalls {callee}:\n{self.fingerprints[callee]}"
+                    self.fingerprints[fn.name] = hashlib.sha256(fn.fingerprint.encode()).hexdigest()
+                if self.function_cache is None or self.tail_calls or len(fn.codes) <= INLINE_CANDIDATE_SIZE:
+                    fn.optimize()
+                self.optimized.add(fn.name)
+            if self.tail_calls:
+                merged += self.eliminate_tail_calls(component)
+        return merged
 
-        with open(filename, mode='w', encoding='utf-8') as f:
-            f.write(content)
+    def eliminate_tail_calls(self, component: List[Fundecl]) -> List[Fundecl]:
+        '''
+        最適化を終えた強連結成分の中で末尾呼び出しで回る相互再帰を 1 つの関数にまとめ，末尾呼び出しに印を付ける．
+        まとめた関数の出力は成分の全ての関数で決まるので，成分の関数はキャッシュしない．
+        '''
+        merged: List[Fundecl] = []
+        if len(component) > 1:
+            hashes = sorted(self.fingerprints.get(fn.name, '') for fn in component)
+            digest = hashlib.sha256('\n'.join(hashes).encode()).hexdigest()
+            for fn in component:
+                fn.fingerprint = None
+                if fn.name in self.fingerprints:
+                    self.fingerprints[fn.name] = digest
+            # 展開や末尾再帰の除去で呼び出しが消えていることもあるので，最適化した後の呼び出しで成分を分け直す
+            for group in self.components(component, {fn.name: fn for fn in component}):
+                if len(group) > 1:
+                    fn = merge_recursion(group)
+                    if fn is not None:
+                        merged.append(fn)
+                        self.optimized.add(fn.name)
+                        self.defined.add(fn.name)
+                        if not fn.is_func:
+                            self.procedures.add(fn.name)
+                        if self.inlining:
+                            for wrapper in group:
+                                self.pipeline.inliner.register(wrapper, len(wrapper.codes))
+        for fn in component + merged:
+            mark_tail_calls(fn, self.procedures)
+        return merged
+
+    def ready(self, fn: Fundecl) -> bool:
+        '''
+        fn から (書き出しを待っている関数を通って) 呼び出す関数が全て定義されているか
+        '''
+        table = {f.name: f for f in self.pending}
+        seen  = {fn.name}
+        work  = [fn]
+        while work:
+            for name in self.callees(work.pop()):
+                if name not in self.defined:
+                    return False
+                if name in table and name not in seen:
+                    seen.add(name)
+                    work.append(table[name])
+        return True
+
+    def flush_pending(self, final: bool = False):
+        while len(self.pending) > 0 and (final or self.ready(self.pending[0])):
+            fn = self.pending.pop(0)
+            for merged in self.optimize_callees([fn], [fn] + self.pending):
+                self.flush_block(merged)
+            self.flush_block(fn)
+
+    # NOTE: ストリーミング出力
+
+    def flush_function(self):
+        '''
+        ストリーミング出力のとき，完成した関数をすぐに書き出して手放す．
+        大域変数の定義は最初の関数の前に書き出すので，メモリには書き出し中の関数 1 つ分しか残らない．
+        '''
+        if self.stream is None:
+            return
+        fn = self.functions.pop()
+        if not self.globals_flushed:
+            self.globals_flushed = True
+            self.flush_block(self.functions[0])
+        if self.interprocedural:
+            self.defined.add(fn.name)
+            self.pending.append(fn)
+            self.flush_pending()
+            return
+        self.flush_block(fn)
+
+    def finish(self):
+        '''
+        ストリーミング出力の最後に書式文字列と printf / scanf の宣言を書き出す．
+        使うかどうかはプログラムの最後までわからないので，通常の出力と違ってモジュールの末尾に置く．
+        '''
+        self.flush_pending(final=True)
+        self.functions[0].codes = []
+        self.push_declarations()
+        self.flush_block(self.functions[0])
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def flush_block(self, fn: Fundecl):
+        if not len(fn.codes) > 0 and fn.name is None:
+            return
+        if self.blocks_written > 0:
+            self.stream.write('\n')
+        self.write_function(fn, self.stream)
+        self.blocks_written += 1
+
+    def function_to_string(self, fn: Fundecl) -> str:
+        '''
+        fingerprint が同じ関数の LLVM IR はキャッシュから取り出し，最適化と文字列化を省く
+        '''
+        cache = self.function_cache
+        if cache is None or fn.fingerprint is None:
+            return fn.to_string()
+
+        key = cache.key(fn.fingerprint, self.optimization)
+        ir  = cache.get(key)
+        if ir is not None:
+            return rebase_labels(ir, fn.label_base)
+
+        ir = fn.to_string()
+        if fn.fingerprint is not None:
+            cache.put(key, rebase_labels(ir, -fn.label_base))
+        return ir
+
+    def export(self, filename, verbose=False):
+        with open(filename, mode='w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+            self.write(f)
 
         if verbose:
-            print(content)
+            with open(filename, encoding='utf-8') as f:
+                print(f.read())
 
     def enable_write(self):
         self.write_enabled = True
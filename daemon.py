@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+'''
+コンパイラを常駐させるデーモンと，そのクライアント．
+デーモンは Unix ドメインソケットで 1 行 1 つの JSON を受け取り，ワーカープロセスでコンパイルして結果を返す．
+字句解析表・構文解析表やキャッシュを読み込んだままにしておくので，呼び出しごとの起動時間がかからない．
+
+    python daemon.py serve -j 4 --cache-dir ~/.cache/plx
+    python daemon.py compile source_file.p -o source_file.ll
+    python daemon.py stats
+    python daemon.py stop
+
+クライアントはデーモンが起動していなければ，同じプロセスの中でコンパイルする．
+'''
+import argparse
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from collections import deque
+from contextlib import redirect_stdout
+from typing import Dict, Optional
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f'plx-compiler-{os.getuid()}.sock')
+
+# キューが一杯のときに返すエラー．クライアントは少し待ってから再送する
+BUSY = 'busy'
+
+# レイテンシの統計に使う直近のリクエスト数
+LATENCY_WINDOW = 1000
+
+
+# NOTE: ワーカープロセス
+
+_worker_compilers: Dict[tuple, object] = {}
+_worker_cache = None
+_worker_function_cache = None
+
+
+def _init_worker(cache_dir: Optional[str], cache_size: int):
+    global _worker_cache, _worker_function_cache
+    from cache import FUNCTION_CACHE_DIR, CompileCache
+    from parser import build_tables
+
+    build_tables()
+    if cache_dir is not None:
+        _worker_cache          = CompileCache(cache_dir, cache_size)
+        _worker_function_cache = CompileCache(os.path.join(cache_dir, FUNCTION_CACHE_DIR), cache_size)
+
+
+def compile_request(source: str, options: Optional[dict] = None, lexer: str = 'ply', engine: str = 'ply') -> dict:
+    '''
+    1 つのリクエストをコンパイルする．
+    構文エラーなどで標準出力に書かれたメッセージは diagnostics として返す．
+    '''
+    from parser import Compiler
+
+    key      = (json.dumps(options or {}, sort_keys=True), lexer, engine)
+    compiler = _worker_compilers.get(key)
+    if compiler is None:
+        compiler = Compiler(options, lexer=lexer, engine=engine, function_cache=_worker_function_cache)
+        _worker_compilers[key] = compiler
+
+    cache_key = None
+    if _worker_cache is not None:
+        cache_key = _worker_cache.key(source, compiler.optimization)
+        ir        = _worker_cache.get(cache_key)
+        if ir is not None:
+            return {'ok': True, 'ir': ir, 'cached': True, 'diagnostics': ''}
+
+    out = io.StringIO()
+    try:
+        with redirect_stdout(out):
+            ir = compiler.compile(source)
+    except Exception as e:
+        return {'ok': False, 'error': f'{type(e).__name__}: {e}', 'diagnostics': out.getvalue()}
+
+    if cache_key is not None:
+        _worker_cache.put(cache_key, ir)
+    return {'ok': True, 'ir': ir, 'cached': False, 'diagnostics': out.getvalue()}
+
+
+# NOTE: サーバー
+
+class Metrics(object):
+    '''
+    リクエスト数とレイテンシ (キューで待った時間を含む) の統計
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.started   = time.time()
+        self.requests  = 0
+        self.failures  = 0
+        self.rejected  = 0
+        self.cached    = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.waits     = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, response: dict, latency: float, wait: float):
+        self.requests += 1
+        self.failures += not response['ok']
+        self.cached   += response.get('cached', False)
+        self.latencies.append(latency)
+        self.waits.append(wait)
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e3, 3)
+
+        return {
+            'uptime_s':       round(time.time() - self.started, 3),
+            'requests':       self.requests,
+            'failures':       self.failures,
+            'rejected':       self.rejected,
+            'cached':         self.cached,
+            'latency_p50_ms': percentile(0.50),
+            'latency_p95_ms': percentile(0.95),
+            'latency_p99_ms': percentile(0.99),
+            'latency_max_ms': round(latencies[-1] * 1e3, 3) if latencies else 0.0,
+            'queue_wait_avg_ms': round(sum(self.waits) / len(self.waits) * 1e3, 3) if self.waits else 0.0,
+        }
+
+
+class CompileServer(object):
+    '''
+    asyncio で接続を受け付け，CPU を使うコンパイルはワーカープロセスのプールで行う．
+    同時にプールに渡すリクエストは max_inflight 個までで，それを超えたものはキューで待たせる．
+    キューで待っているリクエストが max_queue 個を超えると，新しいリクエストには busy を返す．
+    '''
+
+    def __init__(self, path: str = DEFAULT_SOCKET, jobs: Optional[int] = None,
+                 max_inflight: Optional[int] = None, max_queue: int = 256,
+                 cache_dir: Optional[str] = None, cache_size: Optional[int] = None):
+        super().__init__()
+        from cache import DEFAULT_CACHE_SIZE
+
+        self.path         = path
+        self.jobs         = jobs or os.cpu_count() or 1
+        self.max_inflight = max_inflight or self.jobs * 2
+        self.max_queue    = max_queue
+        self.cache_dir    = cache_dir
+        self.cache_size   = cache_size or DEFAULT_CACHE_SIZE
+        self.metrics      = Metrics()
+        self.inflight     = 0
+        self.queued       = 0
+
+    async def serve(self):
+        import asyncio
+        import signal
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.loop     = asyncio.get_running_loop()
+        self.slots    = asyncio.Semaphore(self.max_inflight)
+        self.stopped  = asyncio.Event()
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=_init_worker,
+                                            initargs=(self.cache_dir, self.cache_size))
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stopped.set)
+
+        remove_stale_socket(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    response = {'ok': False, 'error': f'不正なリクエスト: {e}'}
+                else:
+                    response = await self.dispatch(request)
+                    if 'id' in request:
+                        response['id'] = request['id']
+                writer.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+                await writer.drain()
+                if self.stopped.is_set():
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, request: dict) -> dict:
+        command = request.get('command', 'compile')
+        if command == 'compile':
+            return await self.compile(request)
+        if command == 'stats':
+            stats = self.metrics.to_dict()
+            stats.update({'ok': True, 'inflight': self.inflight, 'queued': self.queued,
+                          'jobs': self.jobs, 'max_inflight': self.max_inflight, 'max_queue': self.max_queue})
+            return stats
+        if command == 'shutdown':
+            self.stopped.set()
+            return {'ok': True}
+        return {'ok': False, 'error': f'KeyError: {command}'}
+
+    async def compile(self, request: dict) -> dict:
+        if 'source' not in request:
+            return {'ok': False, 'error': 'source がありません'}
+        if self.queued >= self.max_queue:
+            self.metrics.rejected += 1
+            return {'ok': False, 'error': BUSY}
+
+        start = time.perf_counter()
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        wait = time.perf_counter() - start
+
+        self.inflight += 1
+        try:
+            response = await self.loop.run_in_executor(
+                self.executor, compile_request, request['source'], request.get('options'),
+                request.get('lexer', 'ply'), request.get('engine', 'ply'))
+        except Exception as e:
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+
+        latency = time.perf_counter() - start
+        self.metrics.record(response, latency, wait)
+        response['latency_ms'] = round(latency * 1e3, 3)
+        response['queue_ms']   = round(wait * 1e3, 3)
+        return response
+
+
+def remove_stale_socket(path: str):
+    '''
+    前に起動したデーモンが残したソケットファイルを削除する．動いているデーモンがあればエラーにする．
+    '''
+    if not os.path.exists(path):
+        return
+    try:
+        request({'command': 'stats'}, path, timeout=1.0)
+    except OSError:
+        os.unlink(path)
+        return
+    raise RuntimeError(f'デーモンは既に起動しています: {path}')
+
+
+# NOTE: クライアント
+
+def request(message: dict, path: str = DEFAULT_SOCKET, timeout: Optional[float] = None) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('デーモンから応答がありませんでした')
+    return json.loads(line)
+
+
+def compile_with_daemon(source: str, options: Optional[dict] = None, lexer: str = 'ply', engine: str = 'ply',
+                        path: str = DEFAULT_SOCKET, retries: int = 5, timeout: Optional[float] = None) -> dict:
+    '''
+    デーモンにコンパイルを依頼する．
+    デーモンが起動していないとき・混雑が続いたときは，このプロセスの中でコンパイルする (結果の daemon が False になる)．
+    '''
+    message = {'source': source, 'options': options, 'lexer': lexer, 'engine': engine}
+    delay   = 0.01
+    for _ in range(retries):
+        try:
+            response = request(message, path, timeout)
+        except (FileNotFoundError, ConnectionRefusedError):
+            break
+        if response.get('error') != BUSY:
+            response['daemon'] = True
+            return response
+        time.sleep(delay)
+        delay *= 2
+
+    response = compile_request(source, options, lexer, engine)
+    response['daemon'] = False
+    return response
+
+
+def main():
+    from parser import DEFAULT_OPTIMIZATION
+
+    ap  = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--socket', default=DEFAULT_SOCKET, help='Unix ドメインソケットのパス')
+    sub = ap.add_subparsers(dest='command', required=True)
+
+    serve = sub.add_parser('serve', help='デーモンを起動する')
+    serve.add_argument('-j', '--jobs', type=int, default=None, help='ワーカープロセス数 (省略時は CPU 数)')
+    serve.add_argument('--max-inflight', type=int, default=None, help='同時にコンパイルするリクエスト数の上限')
+    serve.add_argument('--max-queue', type=int, default=256, help='待たせておくリクエスト数の上限')
+    serve.add_argument('--cache-dir', default=None, help='コンパイル結果のキャッシュを置くディレクトリ')
+    serve.add_argument('--cache-size', type=int, default=256, metavar='MB', help='キャッシュの大きさの上限')
+
+    comp = sub.add_parser('compile', help='デーモンでコンパイルする')
+    comp.add_argument('source', help='PL-X のソースファイル')
+    comp.add_argument('-o', '--output', default=None, help='出力先 (省略時は標準出力)')
+    comp.add_argument('--lexer', choices=('ply', 'fast'), default='ply')
+    comp.add_argument('--engine', choices=('ply', 'rd'), default='ply')
+    comp.add_argument('-O', '--opt', action='append', choices=list(DEFAULT_OPTIMIZATION), default=[],
+                      metavar='NAME', help=f"有効にする最適化 (複数指定できる): {', '.join(DEFAULT_OPTIMIZATION)}")
+    comp.add_argument('--unroll-budget', type=int, default=None, metavar='N',
+                      help='-O unroll で展開した後のループの命令数の上限')
+
+    sub.add_parser('stats', help='デーモンの統計を表示する')
+    sub.add_parser('stop', help='デーモンを停止する')
+    args = ap.parse_args()
+
+    if args.command == 'serve':
+        import asyncio
+        server = CompileServer(args.socket, args.jobs, args.max_inflight, args.max_queue,
+                               args.cache_dir, args.cache_size * 1024 * 1024)
+        asyncio.run(server.serve())
+        return
+
+    if args.command in ('stats', 'stop'):
+        try:
+            response = request({'command': 'stats' if args.command == 'stats' else 'shutdown'}, args.socket)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sys.exit('デーモンは起動していません')
+        print(json.dumps(response, indent=2, ensure_ascii=False))
+        return
+
+    with open(args.source, encoding='utf-8') as f:
+        source = f.read()
+    options  = {name: True for name in args.opt}
+    if args.unroll_budget is not None:
+        options['unroll_budget'] = args.unroll_budget
+    response = compile_with_daemon(source, options, args.lexer, args.engine, args.socket)
+
+    sys.stderr.write(response.get('diagnostics', ''))
+    if not response['ok']:
+        sys.exit(response['error'])
+    if args.output is None:
+        sys.stdout.write(response['ir'])
+    else:
+        with open(args.output, mode='w', encoding='utf-8') as f:
+            f.write(response['ir'])
+
+
+if __name__ == '__main__':
+    main()
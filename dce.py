@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List
+
+from cfg import CFG, register_of, used_values
+from decls import Factor, Fundecl
+from llvmcodes import Opcode
+from mem2reg import slot_key
+from symtab import Scope
+from tracing import TRACE_DEBUG, TRACE_INFO
+
+# 結果が使われなくても必ず残す命令 (分岐・戻り値・入出力・関数呼び出し)
+CRITICAL = frozenset((Opcode.BR_UNCOND, Opcode.BR_COND, Opcode.RET,
+                      Opcode.WRITE, Opcode.READ, Opcode.CALL))
+
+
+def tracked_slots(cfg: CFG) -> Dict[object, int]:
+    '''
+    読み書きを追跡できる i32 の変数 (スロット) -> ビット番号．
+    番地が load / store の番地以外 (scanf の引数など) に使われる alloca は追跡しない．
+    配列は getelementptr を通して読み書きされるので追跡せず，その store は常に残す．
+    '''
+    slots: Dict[object, int] = {}
+    for code in cfg.instructions():
+        if code.opcode == Opcode.ALLOCA and code.retval.size == 0:
+            slots.setdefault(slot_key(code.retval), len(slots))
+        elif code.opcode in (Opcode.LOAD, Opcode.STORE):
+            f = code.arg2
+            if type(f) is Factor and f.scope == Scope.GLOBAL and f.size == 0:
+                slots.setdefault(slot_key(f), len(slots))
+
+    for code in cfg.instructions():
+        address = code.arg2 if code.opcode in (Opcode.LOAD, Opcode.STORE) else None
+        for value in used_values(code):
+            if value is not address:
+                slots.pop(slot_key(value), None)
+    return {key: i for i, key in enumerate(slots)}
+
+
+def eliminate_dead_code(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    def-use 連鎖の上のマーク・スイープと，基本ブロックをまたぐ変数の生存解析による不要な store の削除．
+    ブロックを後ろから走査し，必ず残す命令・生きているレジスタを定義する命令・後で読まれる変数への store を生きているとする．
+    生きている命令が読むレジスタを定義するブロックと，生きている変数が増えたブロックの前のブロックを作業リストに戻し，
+    変化がなくなるまで繰り返す．大域変数は関数の呼び出しと ret の時点で生きているとする．
+    '''
+    slots        = tracked_slots(cfg)
+    global_mask  = 0
+    for key, bit in slots.items():
+        if type(key) is str:
+            global_mask |= 1 << bit
+
+    defined_in: Dict[int, object] = {}
+    for block in cfg.blocks:
+        for code in block.codes:
+            if code.defines is not None:
+                r = register_of(getattr(code, code.defines))
+                if r is not None:
+                    defined_in[r] = block
+
+    live:      set                 = set()  # 生きている命令の id
+    live_regs: set                 = set()
+    live_in:   Dict[int, int]      = {id(b): 0 for b in cfg.blocks}
+    work:      List                = list(cfg.blocks)  # 後ろのブロックから取り出す
+    queued:    set                 = set(id(b) for b in work)
+
+    def enqueue(block):
+        if id(block) not in queued:
+            queued.add(id(block))
+            work.append(block)
+
+    while work:
+        block = work.pop()
+        queued.discard(id(block))
+
+        live_slots = 0
+        for succ in block.succs:
+            live_slots |= live_in[id(succ)]
+        if block.terminator is not None and block.terminator.opcode == Opcode.RET:
+            live_slots |= global_mask
+
+        for code in reversed(block.codes):
+            op   = code.opcode
+            slot = slots.get(slot_key(code.arg2)) if op in (Opcode.LOAD, Opcode.STORE) else None
+
+            alive = id(code) in live or op in CRITICAL
+            if not alive:
+                if op == Opcode.STORE:
+                    alive = slot is None or live_slots >> slot & 1 == 1
+                elif code.defines is not None:
+                    alive = register_of(getattr(code, code.defines)) in live_regs
+            if op == Opcode.STORE and slot is not None:
+                live_slots &= ~(1 << slot)
+            if not alive:
+                continue
+
+            live.add(id(code))
+            for value in used_values(code):
+                r = register_of(value)
+                if r is None or r in live_regs:
+                    continue
+                live_regs.add(r)
+                owner = defined_in.get(r)
+                if owner is not None and (owner is not block or op == Opcode.PHI):
+                    enqueue(owner)
+            if op == Opcode.LOAD and slot is not None:
+                live_slots |= 1 << slot
+            elif op == Opcode.CALL:
+                live_slots |= global_mask
+
+        if live_slots != live_in[id(block)]:
+            live_in[id(block)] = live_slots
+            for pred in block.preds:
+                enqueue(pred)
+
+    before = sum(len(b.codes) for b in cfg.blocks)
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_DEBUG):
+        tracer.emit('dce.function', "=" * 7 + f" {fn.name} の依存関係 " + "=" * 7, function=fn.name)
+        for i, code in enumerate(cfg.instructions()):
+            required = id(code) in live
+            tracer.emit('dce.dependence', f"{i+1}行目\t| required: {required}\t{code}", 'green' if required else 'red',
+                        function=fn.name, line=i + 1, required=required, code=str(code))
+
+    for block in cfg.blocks:
+        block.codes = [c for c in block.codes if id(c) in live]
+    after = sum(len(b.codes) for b in cfg.blocks)
+
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('dce.summary', f"{fn.name}: {before}行 -> {after}行へのコードの削減",
+                    function=fn.name, before=before, after=after)
+    return after < before
@@ -1,22 +1,28 @@
 # -*- coding: utf-8 -*-
-from typing import List, Optional
+import io
+from typing import Dict, List, Optional, TextIO
 
-import llvmcodes
-from llvmcodes import LLVMCode
-from symtab import Scope, colored
+from llvmcodes import LLVMCode, Opcode
+from symtab import Scope
+from tracing import Tracer
 
 
 class Fundecl(object):
-    def __init__(self, name: Optional[str] = None, optimize_deadcode = False):
+    def __init__(self, name: Optional[str] = None, tracer: Optional[Tracer] = None, pipeline = None):
         self.name     = name
         self.args_cnt = 0
         self.cntr     = 1 # レジスタカウンター
         self.rettype  = "i32"
         self.is_func  = False
-        
-        self.remove_deadcode       = optimize_deadcode
-        self.codes: List[LLVMCode] = [] 
-        self.replace_register_dict = {}
+
+        self.codes: List[LLVMCode] = []
+        self.tracer                = tracer or Tracer()
+        # 制御フローグラフの上で行う最適化 (passes.Pipeline)．None のときは行わない
+        self.pipeline              = pipeline
+
+        # 関数ごとのキャッシュ用: 関数を特定する文字列と，関数の先頭のラベル番号
+        self.fingerprint: Optional[str] = None
+        self.label_base                 = 0
 
     def register(self):
         t = self.cntr
@@ -24,101 +30,70 @@ class Fundecl(object):
         return t
 
     def to_string(self):
-        if self.remove_deadcode:
-            self.optimize_deadcode()
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
+
+    def write(self, out: TextIO):
+        '''
+        関数を 1 命令ずつ文字列にして out に書き出す (to_string と同じ内容になる)
+        '''
+        self.optimize()
 
         as_function = self.name is not None and len(self.name) > 0
-        statements  = [str(code) for code in self.codes]
+        reg         = self.register_formatter()
+        indent      = 2 if as_function else 0
+
+        if as_function:
+            arg_types = ['i32' for i in range(self.args_cnt)]
+            out.write(f"define {self.rettype} @{self.name}({', '.join(arg_types)})" + "{\n")
+        for i, code in enumerate(self.codes):
+            if i > 0:
+                out.write('\n')
+            out.write(with_indent(code.format(reg), indent))
         if as_function:
-            statements = [with_indent(s, 2) for s in statements]
-
-        arg_types = ['i32' for i in range(self.args_cnt)]
-
-        header = f"define {self.rettype} @{self.name}({', '.join(arg_types)})" + "{\n" if as_function else ""
-        body   = '\n'.join(statements)
-        footer = "\n}" if as_function else ""
-
-        # レジスタ番号の置き換え
-        for rep_from, rep_to in sorted(self.replace_register_dict.items(), key=lambda x: x[0]):
-            body = body.replace(f"%{rep_from}", f"%{rep_to}")
-
-        return header + body + footer
-
-    def optimize_deadcode(self):
-        deps = []
-        for code_index, code in enumerate(self.codes):
-            if isinstance(code, llvmcodes.LLVMCodeAlloca):
-                deps.append(Dependence(code, code_index, deps=[code.retval], required=True))
-            if isinstance(code, llvmcodes.LLVMCodeGlobal):
-                deps.append(Dependence(code, code_index, deps=[code.retval], required=True))
-            if isinstance(code, llvmcodes.LLVMCodeStore):
-                deps.append(Dependence(code, code_index, host=code.arg2, deps=[code.arg1]))
-            if isinstance(code, llvmcodes.LLVMCodeLoad):
-                deps.append(Dependence(code, code_index, host=code.arg1, deps=[code.arg2]))
-            if isinstance(code, llvmcodes.LLVMCodeBrUncond):
-                deps.append(Dependence(code, code_index, required=True, require_above=True))
-            if isinstance(code, llvmcodes.LLVMCodeBrCond):
-                deps.append(Dependence(code, code_index, deps=[code.arg1], required=True, require_above=True))
-            if isinstance(code, llvmcodes.LLVMCodeIcmp):
-                deps.append(Dependence(code, code_index, host=code.retval, deps=[code.arg1, code.arg2]))
-            if isinstance(code, llvmcodes.LLVMCodeOperator):
-                deps.append(Dependence(code, code_index, host=code.retval, deps=[code.arg1, code.arg2]))
-            if isinstance(code, llvmcodes.LLVMCodeProcReturn):
-                deps.append(Dependence(code, code_index, deps=[code.arg], required=True))
-            if isinstance(code, llvmcodes.LLVMCodeWrite):
-                deps.append(Dependence(code, code_index, host=code.retval, deps=[code.arg], required=True))
-            if isinstance(code, llvmcodes.LLVMCodeRead):
-                deps.append(Dependence(code, code_index, host=code.retval, deps=[code.arg], required=True))
-            if isinstance(code, llvmcodes.LLVMCodeCallProc):
-                deps.append(Dependence(code, code_index, host=code.retval, deps=code.args, required=True))
-            if isinstance(code, llvmcodes.LLVMCodeGetPointer):
-                deps.append(Dependence(code, code_index, host=code.arg1, deps=[code.arg2, code.index]))
-        
-        if not len(deps) > 0:
-            return
-        
-        def search_host(host, start_i):
-            for dep in deps[:start_i][::-1]:
-                if dep.host == host:
-                    return dep
-            return None
-        
-        for i, dep in list(enumerate(deps))[::-1]:
-            if dep.required:
-                for d in dep.deps:
-                    host = search_host(d, i)
-                    if host is not None:
-                        host.required = True
-        
-        require_above = False
-        for i, dep in list(enumerate(deps))[::-1]:
-            require_above = require_above or dep.require_above
-            dep.required  = dep.required  or require_above
-        
-        required_deps = [d for d in deps if d.required]
-
-        print("=" * 7 + f" {self.name} の依存関係 " + "=" * 7)
-        print('\n'.join([str(d) for d in deps]))
-        print("↓  " * 5)
-        print('\n'.join([str(d) for d in required_deps]))
-        print(f"\n{len(deps)}行 -> {len(required_deps)}行へのコードの削減\n")
-
-        # self.codes の中からいらないものを削除
-        waste_deps       = [d for d in deps if not d.required]
-        waste_code_index = [d.code_index for d in waste_deps]
-        self.codes       = [c for i, c in enumerate(self.codes) if not i in waste_code_index]
-
-        # レジスタ番号を連番に直す
-        appear_registers = []
-        for dep in required_deps:
-            appear_registers += [dep.host] + dep.deps
-        appear_registers = list(set([r for r in appear_registers if r is not None and type(r) is int]))
-
-        for i, r in enumerate(appear_registers):
-            if r < self.args_cnt:
-                self.replace_register_dict[r] = r
-            else:
-                self.replace_register_dict[r] = i + 1
+            out.write("\n}")
+
+    def optimize(self):
+        '''
+        パイプラインの最適化を行う (1 度だけ)
+        '''
+        pipeline, self.pipeline = self.pipeline, None
+        if pipeline is not None:
+            pipeline.run(self)
+
+    def number_registers(self) -> Dict[int, int]:
+        '''
+        仮想レジスタ番号に，命令の結果として定義される順に LLVM IR のレジスタ番号を割り当てる．
+        引数 %0 .. %(args_cnt - 1) はそのままで，ラベルのない先頭のブロックが %args_cnt になるため，
+        命令の結果には %(args_cnt + 1) からの連番を振る．デッドコード削除で命令が減っても番号は詰まる．
+        '''
+        regmap = {i: i for i in range(self.args_cnt)}
+        n      = self.args_cnt
+        if not (len(self.codes) > 0 and self.codes[0].opcode == Opcode.LABEL):
+            n += 1
+
+        for code in self.codes:
+            field = code.defines
+            if field is None:
+                continue
+            f = getattr(code, field)
+            if f.scope == Scope.LOCAL and f.val not in regmap:
+                regmap[f.val] = n
+                n += 1
+        return regmap
+
+    def register_formatter(self):
+        '''
+        オペランドを文字列にする関数．局所レジスタは number_registers で振った番号で出力する．
+        '''
+        regmap = self.number_registers()
+
+        def reg(f) -> str:
+            if type(f) is Factor and f.scope == Scope.LOCAL and type(f.val) is int:
+                return f"%{regmap.get(f.val, f.val)}"
+            return str(f)
+        return reg
 
     def add_code(self, code: LLVMCode):
         assert isinstance(code, LLVMCode)
@@ -126,6 +101,8 @@ class Fundecl(object):
 
 
 class Factor(object):
+    __slots__ = ('scope', 'name', 'val', 'size', 'ptr_offset')
+
     def __init__(self, scope: Scope, name=None, val=None, size=0, ptr_offset=0):
         assert type(scope) is Scope
         self.scope      = scope
@@ -163,39 +140,6 @@ class Factor(object):
         val   = val   if val   is not None else self.val
         return Factor(scope=scope, name=name, val=val)
 
-class Dependence(object):
-    def __init__(self, code: LLVMCode, code_index: int, required=False,
-                 require_above=False, host: Optional[Factor] = None, deps: List[Factor] = []):
-        self.code          = code
-        self.code_index    = code_index
-        self.required      = required
-        self.require_above = require_above
-        self.host          = self.to_register(host)
-        deps               = [self.to_register(dep) for dep in deps]
-        self.deps          = [dep for dep in deps if dep is not None]
-
-        # グローバル変数の内容を決定する場合は required -> True
-        if isinstance(host, Factor) and host.scope == Scope.GLOBAL:
-            self.required = True
-
-    def to_register(self, factor):
-        if not isinstance(factor, Factor):
-            return None
-        if factor.scope == Scope.LOCAL:
-            return factor.val
-        if factor.scope == Scope.GLOBAL:
-            return str(factor)
-        return None
-
-    def __str__(self):
-        host  = f"%{self.host}" if self.host is not None else "NULL"
-        deps  = ', '.join([d if type(d) is str else f"%{d}" for d in self.deps])
-        color = 'green' if self.required else 'red'
-        return colored(f"{self.code_index+1}行目\t| required: {self.required}\t{host}\t-> {deps}", color) + f"\t{self.code}"
-
-    def __repr__(self) -> str:
-        return self.__str__()
-
 
 def with_indent(s: str, level: int = 0) -> str:
     return f"{' ' * level}{s}"
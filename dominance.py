@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from typing import List, Optional
+
+from cfg import CFG, BasicBlock
+
+
+class DominatorTree(object):
+    '''
+    支配木．Cooper-Harvey-Kennedy の方法 ("A Simple, Fast Dominance Algorithm") で，
+    逆後順の番号の上で直接の支配者 (idom) を求める．入口から到達できないブロックは含めない．
+    '''
+
+    def __init__(self, cfg: CFG):
+        super().__init__()
+        self.cfg    = cfg
+        self.blocks = cfg.rpo()
+        self.index  = cfg.rpo_index()
+        self.doms   = self._compute_idom()
+        self._children:  Optional[List[List[BasicBlock]]] = None
+        self._frontiers: Optional[List[List[BasicBlock]]] = None
+        # 支配木を深さ優先でたどったときの入る順・出る順の番号 (dominates を定数時間にする)
+        self._pre:  Optional[List[int]] = None
+        self._post: Optional[List[int]] = None
+
+    def _compute_idom(self) -> List[int]:
+        blocks, index = self.blocks, self.index
+        doms          = [-1] * len(blocks)
+        if not len(blocks) > 0:
+            return doms
+        doms[0] = 0
+
+        def intersect(a: int, b: int) -> int:
+            while a != b:
+                while a > b:
+                    a = doms[a]
+                while b > a:
+                    b = doms[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for i in range(1, len(blocks)):
+                new = -1
+                for pred in blocks[i].preds:
+                    j = index.get(id(pred))
+                    if j is None or doms[j] < 0:
+                        continue
+                    new = j if new < 0 else intersect(j, new)
+                if doms[i] != new:
+                    doms[i]  = new
+                    changed = True
+        return doms
+
+    def idom(self, block: BasicBlock) -> Optional[BasicBlock]:
+        '''
+        直接の支配者 (入口のブロックは None)
+        '''
+        i = self.index[id(block)]
+        return self.blocks[self.doms[i]] if i > 0 else None
+
+    def dominates(self, a: BasicBlock, b: BasicBlock) -> bool:
+        '''
+        a が b を支配するか (a == b のときも True)
+        '''
+        if self._pre is None:
+            self._number()
+        i, j = self.index[id(a)], self.index[id(b)]
+        return self._pre[i] <= self._pre[j] and self._post[j] <= self._post[i]
+
+    def _number(self):
+        pre, post = [0] * len(self.blocks), [0] * len(self.blocks)
+        counter   = 0
+        stack     = [(self.blocks[0], False)] if len(self.blocks) > 0 else []
+        while stack:
+            block, done = stack.pop()
+            i = self.index[id(block)]
+            if done:
+                post[i]  = counter
+                counter += 1
+                continue
+            pre[i]   = counter
+            counter += 1
+            stack.append((block, True))
+            stack.extend((child, False) for child in reversed(self.children(block)))
+        self._pre, self._post = pre, post
+
+    def children(self, block: BasicBlock) -> List[BasicBlock]:
+        if self._children is None:
+            children = [[] for _ in self.blocks]
+            for i in range(1, len(self.blocks)):
+                children[self.doms[i]].append(self.blocks[i])
+            self._children = children
+        return self._children[self.index[id(block)]]
+
+    def frontier(self, block: BasicBlock) -> List[BasicBlock]:
+        '''
+        支配辺境．block が支配するブロックから出る辺のうち，block が (真に) 支配しない行き先
+        '''
+        if self._frontiers is None:
+            self._frontiers = self._compute_frontiers()
+        return self._frontiers[self.index[id(block)]]
+
+    def _compute_frontiers(self) -> List[List[BasicBlock]]:
+        blocks, index, doms = self.blocks, self.index, self.doms
+        frontiers = [[] for _ in blocks]
+        for i, block in enumerate(blocks):
+            preds = [index[id(p)] for p in block.preds if id(p) in index]
+            if not len(preds) > 1:
+                continue
+            for runner in preds:
+                while runner != doms[i]:
+                    if not (len(frontiers[runner]) > 0 and frontiers[runner][-1] is block):
+                        frontiers[runner].append(block)
+                    runner = doms[runner]
+        return frontiers
+
+    def preorder(self) -> List[BasicBlock]:
+        '''
+        支配木を入口から深さ優先でたどった順 (親は子より先に来る)
+        '''
+        if not len(self.blocks) > 0:
+            return []
+        order = []
+        stack = [self.blocks[0]]
+        while stack:
+            block = stack.pop()
+            order.append(block)
+            stack.extend(reversed(self.children(block)))
+        return order
+
+
+def dominator_tree(cfg: CFG) -> DominatorTree:
+    '''
+    cfg の支配木．グラフを変えるまでは同じものを使い回す
+    '''
+    return cfg.cached('domtree', lambda: DominatorTree(cfg))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import namedtuple
+from functools import partial
+from typing import Dict
+
+# 演算子・区切り記号とトークンの対応
+OPERATORS = {
+    ':=': 'ASSIGN',
+    '..': 'INTERVAL',
+    '<>': 'NEQ',
+    '<=': 'LE',
+    '>=': 'GE',
+    '+':  'PLUS',
+    '-':  'MINUS',
+    '*':  'MULT',
+    '=':  'EQ',
+    '<':  'LT',
+    '>':  'GT',
+    '(':  'LPAREN',
+    ')':  'RPAREN',
+    '[':  'LBRACKET',
+    ']':  'RBRACKET',
+    ',':  'COMMA',
+    ';':  'SEMICOLON',
+    ':':  'COLON',
+    '.':  'PERIOD',
+}
+
+# 1 つの正規表現で全てのトークンを切り出す．
+# 空白は各トークンの前置きとして読み飛ばし，2 文字の演算子を 1 文字のものより先に並べることで PLY と同じ最長一致になる．
+TOKEN_RE = re.compile(r'''
+    [ \t]*
+    (?:
+        (?P<word>[a-zA-Z][a-zA-Z0-9]*|:=|\.\.|<>|<=|>=|[-+*=<>()\[\],;:.])
+      | (?P<number>[1-9][0-9]*|0)
+      | (?P<newline>\n+)
+      | (?P<comment>\#.*)
+      | (?P<error>.)
+    )
+''', re.VERBOSE)
+
+WORD, NUMBER, NEWLINE, COMMENT = 1, 2, 3, 4
+
+
+class Token(namedtuple('Token', ['type', 'value', 'lineno', 'lexpos'])):
+    '''
+    PLY の LexToken と同じ属性を持つトークン．
+    tuple なので生成が速く，1 トークンあたりのメモリも小さい．
+    '''
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        return f'LexToken({self.type},{self.value!r},{self.lineno},{self.lexpos})'
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class FastLexer(object):
+    '''
+    PL-X 専用の字句解析器．
+    PLY の字句解析器と同じトークン列 (種類・値・行番号・位置) を返し，
+    input() / token() を持つので yacc の lexer としてそのまま渡せる．
+    '''
+
+    def __init__(self, reserved: Dict[str, str]):
+        super().__init__()
+        self.reserved = reserved
+        self.lineno   = 1
+        self.lexpos   = 0
+        self.token    = lambda: None
+
+    def clone(self):
+        return FastLexer(self.reserved)
+
+    def input(self, data: str):
+        self.lexpos = 0
+        self.token  = partial(next, self._scan(data), None)
+
+    def _scan(self, data: str):
+        types  = dict(OPERATORS)
+        types.update(self.reserved)
+        lookup = types.get
+        new    = tuple.__new__
+        lineno = self.lineno
+
+        for m in TOKEN_RE.finditer(data):
+            kind = m.lastindex
+            if kind is None:
+                # 末尾の空白
+                continue
+
+            value       = m.group(kind)
+            self.lexpos = m.end()
+
+            if kind == WORD:
+                yield new(Token, (lookup(value, 'IDENT'), value, lineno, m.start(kind)))
+            elif kind == NUMBER:
+                yield new(Token, ('NUMBER', int(value), lineno, m.start(kind)))
+            elif kind == NEWLINE:
+                lineno += len(value)
+                self.lineno = lineno
+            elif kind != COMMENT:
+                print("不正な文字", value)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t = self.token()
+        if t is None:
+            raise StopIteration
+        return t
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Tuple
+
+from cfg import CFG, BasicBlock, register_of, replace_uses
+from decls import Factor, Fundecl
+from dominance import dominator_tree
+from llvmcodes import LLVMCode, Opcode
+from mem2reg import slot_key
+from symtab import Scope
+from tracing import TRACE_INFO
+
+# 副作用がなく，オペランドが同じなら同じ値になる命令
+PURE = frozenset((Opcode.ADD, Opcode.SUB, Opcode.MUL, Opcode.SDIV, Opcode.ICMP, Opcode.GETELEMENTPTR))
+
+# オペランドを入れ替えても同じ値になる命令
+COMMUTATIVE = frozenset((Opcode.ADD, Opcode.MUL))
+
+
+def value_key(f):
+    '''
+    オペランドを見分けるキー (定数・大域変数・レジスタ)
+    '''
+    if type(f) is not Factor:
+        return ('?', id(f))
+    if f.scope == Scope.CONSTANT:
+        return ('c', f.val)
+    if f.scope == Scope.GLOBAL:
+        return ('g', f.name)
+    return ('r', f.val)
+
+
+def expression_key(code: LLVMCode) -> tuple:
+    op = code.opcode
+    if op == Opcode.GETELEMENTPTR:
+        return (op, value_key(code.arg2), value_key(code.index), code.size)
+    a, b = value_key(code.arg1), value_key(code.arg2)
+    if op in COMMUTATIVE and b < a:
+        a, b = b, a
+    if op == Opcode.ICMP:
+        return (op, code.cmptype, a, b)
+    return (op, a, b)
+
+
+class MemoryModel(object):
+    '''
+    load / store の番地の別名関係．
+    i32 の変数は変数ごと，配列の要素は (配列, 添字) ごとに区別し，添字が異なる定数なら別の番地とみなす．
+    関数呼び出しは大域変数とその配列だけを書き換えうる (関数には i32 の値しか渡せない)．
+    '''
+
+    def __init__(self, cfg: CFG):
+        super().__init__()
+        self.elements: Dict[int, Tuple[object, tuple]] = {}  # getelementptr の結果 -> (配列, 添字)
+        for code in cfg.instructions():
+            if code.opcode == Opcode.GETELEMENTPTR:
+                self.elements[code.arg1.val] = (slot_key(code.arg2), value_key(code.index))
+
+    def address(self, f) -> tuple:
+        r = register_of(f)
+        if r is not None and r in self.elements:
+            return ('elem',) + self.elements[r]
+        return ('slot', slot_key(f))
+
+    def clobbers(self, code: LLVMCode) -> List[tuple]:
+        '''
+        code が書き換えうる番地 (('call',) は大域変数すべて)
+        '''
+        if code.opcode == Opcode.STORE:
+            return [self.address(code.arg2)]
+        if code.opcode == Opcode.READ:
+            return [self.address(code.arg)]
+        if code.opcode == Opcode.CALL:
+            return [('call',)]
+        return []
+
+    @staticmethod
+    def may_alias(kill: tuple, address: tuple) -> bool:
+        if kill[0] == 'call':
+            return type(address[1]) is str
+        if kill[0] != address[0] or kill[1] != address[1]:
+            return False
+        if kill[0] == 'slot':
+            return True
+        i, j = kill[2], address[2]
+        return i == j or i[0] != 'c' or j[0] != 'c'
+
+    def kill(self, loads: Dict[tuple, Factor], kill: tuple):
+        if kill[0] == 'slot':
+            loads.pop(kill, None)
+            return
+        for address in [a for a in loads if self.may_alias(kill, a)]:
+            del loads[address]
+
+
+def path_clobbers(parent: BasicBlock, block: BasicBlock, clobbers: Dict[int, set], index: Dict[int, int]) -> set:
+    '''
+    parent から block までの経路上 (parent の後，block の前) で書き換えられうる番地
+    '''
+    result = set()
+    seen   = {id(parent)}
+    work   = [p for p in block.preds if id(p) in index]
+    while work:
+        b = work.pop()
+        if id(b) in seen:
+            continue
+        seen.add(id(b))
+        result |= clobbers[id(b)]
+        work.extend(p for p in b.preds if id(p) in index)
+    return result
+
+
+def number_values(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    支配木に沿った大域値番号付け (GVN)．
+    同じ式 (四則演算・比較・getelementptr) を計算し直す命令は，それを支配する先の命令の結果で置き換える．
+    load は，同じ番地の load / store から間に書き換えうる store・scanf・関数呼び出しがなければ，その値で置き換える．
+    ブロックをまたぐときは，直接の支配者からそのブロックまでの経路上で書き換えられうる番地を除く．
+    '''
+    cfg.remove_unreachable()
+    tree   = dominator_tree(cfg)
+    index  = cfg.rpo_index()
+    memory = MemoryModel(cfg)
+
+    clobbers: Dict[int, set] = {}
+    for block in cfg.blocks:
+        clobbers[id(block)] = set(k for code in block.codes for k in memory.clobbers(code))
+
+    replace:     Dict[int, Factor]                      = {}
+    expressions: Dict[tuple, Tuple[Factor, BasicBlock]] = {}
+    exit_loads:  Dict[int, Dict[tuple, Factor]]         = {}
+    removed_expressions = removed_loads = 0
+
+    for block in tree.preorder():
+        parent = tree.idom(block)
+        loads: Dict[tuple, Factor] = {}
+        if parent is not None:
+            loads = dict(exit_loads[id(parent)])
+            if block.preds != [parent]:
+                for kill in path_clobbers(parent, block, clobbers, index):
+                    memory.kill(loads, kill)
+
+        codes = []
+        for code in block.codes:
+            replace_uses(code, replace)
+            op = code.opcode
+            if op in PURE:
+                result = getattr(code, code.defines)
+                key    = expression_key(code)
+                found  = expressions.get(key)
+                if found is not None and tree.dominates(found[1], block):
+                    replace[result.val] = found[0]
+                    removed_expressions += 1
+                    continue
+                # 先に見つけた式が支配しないブロックは，支配木の先行順ではもう現れない
+                expressions[key] = (result, block)
+            elif op == Opcode.LOAD:
+                address = memory.address(code.arg2)
+                found   = loads.get(address)
+                if found is not None:
+                    replace[code.arg1.val] = found
+                    removed_loads += 1
+                    continue
+                loads[address] = code.arg1
+            else:
+                for kill in memory.clobbers(code):
+                    memory.kill(loads, kill)
+                if op == Opcode.STORE and type(code.arg1) is Factor:
+                    loads[memory.address(code.arg2)] = code.arg1
+            codes.append(code)
+        block.codes = codes
+        exit_loads[id(block)] = loads
+
+    # 支配木で後に来るブロックの値を受け取る phi を書き換える
+    if len(replace) > 0:
+        for code in cfg.instructions():
+            replace_uses(code, replace)
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('gvn.summary', f"{fn.name}: {removed_expressions}個の式, {removed_loads}個の load を削除",
+                    function=fn.name, expressions=removed_expressions, loads=removed_loads)
+    return len(replace) > 0
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Optional, Set, Tuple
+
+from cfg import CFG, BasicBlock, label_factor, register_of, replace_uses, used_values
+from decls import Factor, Fundecl
+from dominance import dominator_tree
+from llvmcodes import LLVMCode, LLVMCodeAdd, LLVMCodeMul, LLVMCodePhi, LLVMCodeSub, Opcode, to_i32
+from loops import Loop, insert_preheader, loop_forest
+from symtab import Scope
+from tracing import TRACE_INFO
+
+# 帰納変数の 1 次式 (scale * i + offset) として調べる命令
+AFFINE = frozenset((Opcode.ADD, Opcode.SUB, Opcode.MUL))
+
+
+def constant_of(value) -> Optional[int]:
+    if type(value) is Factor and value.scope == Scope.CONSTANT:
+        return value.val
+    return None
+
+
+def affine(code: LLVMCode, known: Dict[int, Tuple[int, int]]) -> Optional[Tuple[int, int]]:
+    '''
+    code の結果を帰納変数の 1 次式 (scale, offset) で表す．片方のオペランドが known の値，もう片方が定数のときに限る．
+    '''
+    op = code.opcode
+    if op not in AFFINE:
+        return None
+    a, b = register_of(code.arg1), register_of(code.arg2)
+    if a in known and constant_of(code.arg2) is not None:
+        (scale, offset), k = known[a], code.arg2.val
+        if op == Opcode.ADD:
+            return scale, to_i32(offset + k)
+        if op == Opcode.SUB:
+            return scale, to_i32(offset - k)
+        return to_i32(scale * k), to_i32(offset * k)
+    if b in known and constant_of(code.arg1) is not None:
+        (scale, offset), k = known[b], code.arg1.val
+        if op == Opcode.ADD:
+            return scale, to_i32(offset + k)
+        if op == Opcode.SUB:
+            return to_i32(-scale), to_i32(k - offset)
+        return to_i32(scale * k), to_i32(offset * k)
+    return None
+
+
+def add_constant(value: Factor, k: int, retval: Factor) -> LLVMCode:
+    '''
+    retval = value + k (k が負なら sub で書く)
+    '''
+    if k < 0 and to_i32(-k) == -k:
+        return LLVMCodeSub(value, Factor(Scope.CONSTANT, val=-k), retval)
+    return LLVMCodeAdd(value, Factor(Scope.CONSTANT, val=k), retval)
+
+
+def basic_variables(cfg: CFG, loop: Loop, defs: Dict[int, Tuple[LLVMCode, BasicBlock]]
+                    ) -> List[Tuple[LLVMCodePhi, Factor, LLVMCode, int]]:
+    '''
+    ループの基本帰納変数 (header の phi, 初期値, 増やす命令, step)．defs はレジスタ -> それを定義する (命令, ブロック)．
+    '''
+    pre_label   = cfg.label_of(loop.preheader)
+    latch_label = cfg.label_of(loop.latches[0])
+    result = []
+    for phi in loop.header.phis():
+        if len(phi.values) != 2:
+            continue
+        incoming = dict(zip([l.val for l in phi.labels], phi.values))
+        start, value = incoming.get(pre_label), incoming.get(latch_label)
+        found = defs.get(register_of(value))
+        if start is None or found is None or found[1] not in loop:
+            continue
+        step = affine(found[0], {phi.retval.val: (1, 0)})
+        if step is not None and step[0] == 1 and step[1] != 0:
+            result.append((phi, start, found[0], step[1]))
+    return result
+
+
+class StrengthReduction(object):
+    '''
+    帰納変数の強度削減．header の phi で 1 回の繰り返しごとに定数 step ずつ増える変数 i を基本帰納変数とし，
+    i から定数との add / sub / mul で求まる値 (配列の添字の i - ptr_offset など) を，
+    preheader で初期値を計算し繰り返しごとに scale * step ずつ増やす新しい帰納変数に置き換える．
+    i の値そのものが他で使われなければ，ループの条件も新しい帰納変数との比較に書き換え (LFTR)，i を取り除く．
+    '''
+
+    def __init__(self, fn: Fundecl, cfg: CFG):
+        super().__init__()
+        self.fn      = fn
+        self.cfg     = cfg
+        self.tree    = dominator_tree(cfg)
+        self.removed: Set[int] = set()  # 削除した命令の id
+        # レジスタ -> それを定義する (命令, ブロック) / それを読む (命令, ブロック)
+        self.defs:  Dict[int, Tuple[LLVMCode, BasicBlock]]       = {}
+        self.users: Dict[int, List[Tuple[LLVMCode, BasicBlock]]] = {}
+        for block in cfg.blocks:
+            for code in block.codes:
+                self.add_code(code, block)
+        self.reduced = self.rewritten = self.retired = 0
+
+    def add_code(self, code: LLVMCode, block: BasicBlock):
+        if code.defines is not None:
+            r = register_of(getattr(code, code.defines))
+            if r is not None:
+                self.defs[r] = (code, block)
+        for value in used_values(code):
+            r = register_of(value)
+            if r is not None:
+                self.users.setdefault(r, []).append((code, block))
+
+    def users_of(self, r: int) -> List[Tuple[LLVMCode, BasicBlock]]:
+        return [(code, block) for code, block in self.users.get(r, []) if id(code) not in self.removed]
+
+    def emit(self, block: BasicBlock, index: int, code: LLVMCode) -> Factor:
+        block.codes.insert(index, code)
+        self.add_code(code, block)
+        return getattr(code, code.defines)
+
+    def materialize(self, preheader: BasicBlock, value, scale: int, offset: int):
+        '''
+        preheader で scale * value + offset を計算する (value が定数なら畳み込む)
+        '''
+        k = constant_of(value)
+        if k is not None:
+            return Factor(Scope.CONSTANT, val=to_i32(k * scale + offset))
+        if scale != 1:
+            value = self.emit(preheader, len(preheader.codes) - 1,
+                              LLVMCodeMul(value, Factor(Scope.CONSTANT, val=scale), Factor(Scope.LOCAL, val=self.fn.register())))
+        if offset != 0:
+            value = self.emit(preheader, len(preheader.codes) - 1,
+                              add_constant(value, offset, Factor(Scope.LOCAL, val=self.fn.register())))
+        return value
+
+    def invariant(self, loop: Loop, value) -> bool:
+        r = register_of(value)
+        return r is None or r not in self.defs or self.defs[r][1] not in loop
+
+    def basic_variables(self, loop: Loop) -> List[Tuple[LLVMCodePhi, Factor, LLVMCode, int]]:
+        return basic_variables(self.cfg, loop, self.defs)
+
+    def reduce(self, loop: Loop, phi: LLVMCodePhi, start: Factor, increment: LLVMCode, step: int) -> bool:
+        cfg       = self.cfg
+        preheader = loop.preheader
+        i, i_next = phi.retval, increment.retval
+        known: Dict[int, Tuple[int, int]] = {i.val: (1, 0), i_next.val: (1, step)}
+
+        # i から求まる値 (レジスタ -> (命令, ブロック))
+        derived: Dict[int, Tuple[LLVMCode, BasicBlock]] = {}
+        for block in loop.blocks:
+            for code in block.codes:
+                if code is increment:
+                    continue
+                form = affine(code, known)
+                if form is not None:
+                    known[code.retval.val] = form
+                    derived[code.retval.val] = (code, block)
+        if not len(derived) > 0:
+            return False
+        derived_ids = set(id(code) for code, _ in derived.values())
+
+        # ループの条件: ループの中で i / i_next とループ不変な値を比べる icmp
+        compares: List[LLVMCode] = []
+        others = False
+        for r, own in [(i.val, increment), (i_next.val, phi)]:
+            for code, block in self.users_of(r):
+                if code is own or id(code) in derived_ids:
+                    continue
+                if (code.opcode == Opcode.ICMP and block in loop and
+                        all(register_of(v) in (i.val, i_next.val) or self.invariant(loop, v) for v in (code.arg1, code.arg2))):
+                    if code not in compares:
+                        compares.append(code)
+                    continue
+                others = True
+
+        # 他の命令から読まれる値だけを置き換える (i から求まる値からしか読まれないものは消える)
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for r, (code, _) in derived.items():
+            if any(id(user) not in derived_ids for user, _ in self.users_of(r)):
+                groups.setdefault(known[r], []).append(r)
+        retire = not others and (1, 0) not in groups and any(scale == 1 for scale, _ in groups)
+
+        replace:   Dict[int, Factor]                          = {}
+        variables: Dict[Tuple[int, int], Tuple[Factor, Factor]] = {}
+        keep:      Set[int]                                   = set()
+        for (scale, offset), values in groups.items():
+            if (scale, offset) == (1, 0):
+                for r in values:
+                    replace[r] = i
+            elif retire or scale != 1:
+                j      = Factor(Scope.LOCAL, val=self.fn.register())
+                j_next = Factor(Scope.LOCAL, val=self.fn.register())
+                init   = self.materialize(preheader, start, scale, offset)
+                self.emit(loop.header, sum(1 for _ in loop.header.phis()),
+                          LLVMCodePhi(j, [init, j_next], [label_factor(cfg.label_of(preheader)),
+                                                          label_factor(cfg.label_of(loop.latches[0]))]))
+                block = self.defs[i_next.val][1]
+                self.emit(block, block.codes.index(increment) + 1,
+                          add_constant(j, to_i32(scale * step), j_next))
+                variables[(scale, offset)] = (j, j_next)
+                for r in values:
+                    replace[r] = j
+                self.reduced += 1
+            else:
+                # 置き換えない値は i から直接計算し，それを支配する同じ値があればそれを使う
+                computed: List[Tuple[Factor, BasicBlock]] = []
+                for r in values:
+                    code, block = derived[r]
+                    found = next((f for f, b in computed if self.tree.dominates(b, block)), None)
+                    if found is not None:
+                        replace[r] = found
+                        continue
+                    index = block.codes.index(code)
+                    self.removed.add(id(code))
+                    del block.codes[index]
+                    computed.append((self.emit(block, index, add_constant(i, offset, code.retval)), block))
+                    keep.add(r)
+
+        for r, value in replace.items():
+            for code, _ in self.users_of(r):
+                replace_uses(code, replace)
+        dead = set(id(code) for r, (code, _) in derived.items() if r not in keep)
+        self.rewritten += len(dead)
+
+        if retire:
+            (scale, offset), (j, j_next) = next((g, v) for g, v in variables.items() if g[0] == 1)
+            bounds: Dict[object, Factor] = {}
+            for code in compares:
+                for name in ('arg1', 'arg2'):
+                    value = getattr(code, name)
+                    r     = register_of(value)
+                    if r == i.val:
+                        setattr(code, name, j)
+                    elif r == i_next.val:
+                        setattr(code, name, j_next)
+                    else:
+                        key = (r, constant_of(value), getattr(value, 'name', None))
+                        if key not in bounds:
+                            bounds[key] = self.materialize(preheader, value, 1, offset)
+                        setattr(code, name, bounds[key])
+                self.add_code(code, self.defs[code.retval.val][1])
+            dead |= {id(phi), id(increment)}
+            self.retired += 1
+
+        self.removed |= dead
+        for block in loop.blocks:
+            if any(id(code) in dead for code in block.codes):
+                block.codes = [code for code in block.codes if id(code) not in dead]
+        return True
+
+
+def reduce_strength(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    帰納変数の強度削減: ループの中で帰納変数から計算する添字などを，繰り返しごとに定数ずつ増える変数に置き換える．
+    内側のループから順に調べ，header に戻るブロックが 1 つのループだけを扱う．
+    '''
+    cfg.remove_unreachable()
+    forest = loop_forest(cfg)
+    if not len(forest) > 0:
+        return False
+
+    for loop in forest.loops:
+        if loop.preheader is None and len(loop.latches) == 1:
+            insert_preheader(fn, cfg, loop)
+
+    reduction = StrengthReduction(fn, cfg)
+    for loop in forest.loops:
+        if loop.preheader is None or len(loop.latches) != 1:
+            continue
+        for phi, start, increment, step in reduction.basic_variables(loop):
+            if id(phi) not in reduction.removed:
+                reduction.reduce(loop, phi, start, increment, step)
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('indvars.summary', f"{fn.name}: {len(forest)}個のループ, {reduction.reduced}個の帰納変数を追加, "
+                    f"{reduction.rewritten}個の命令を置き換え, {reduction.retired}個の帰納変数を削除",
+                    function=fn.name, loops=len(forest), reduced=reduction.reduced,
+                    rewritten=reduction.rewritten, retired=reduction.retired)
+    return reduction.rewritten + reduction.retired > 0
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import copy
+from typing import Dict, List, Optional, Tuple
+
+from cfg import CFG, BasicBlock, label_factor, register_of, replace_uses
+from decls import Factor, Fundecl
+from llvmcodes import LLVMCode, LLVMCodeBrCond, LLVMCodeBrUncond, LLVMCodePhi, Opcode
+from symtab import Scope
+from tracing import TRACE_INFO
+
+# 展開する関数の命令数 (呼び出しの分を引いたもの) の上限
+INLINE_THRESHOLD = 40
+
+# 展開の候補にする関数の，最適化する前の命令数の上限
+INLINE_CANDIDATE_SIZE = 200
+
+# 展開した後の呼び出し元の命令数の上限
+INLINE_CALLER_MAX_SIZE = 2000
+
+# 定数を渡す引数 1 つあたりに割り引く命令数 (定数の畳み込みで消えることを見込む)
+INLINE_CONSTANT_BONUS = 2
+
+
+def body_size(codes: List[LLVMCode]) -> int:
+    '''
+    実行される命令の数の目安 (ラベル・alloca・phi を除く)
+    '''
+    return sum(1 for code in codes if code.opcode not in (Opcode.LABEL, Opcode.ALLOCA, Opcode.PHI))
+
+
+class InlineBody(object):
+    '''
+    展開できる関数の，最適化した後の本体 (複製の元にするので書き換えない)
+    '''
+
+    def __init__(self, fn: Fundecl):
+        super().__init__()
+        self.name     = fn.name
+        self.args_cnt = fn.args_cnt
+        self.cfg      = CFG.from_codes(fn.codes, fn.name)
+        self.size     = body_size(fn.codes)
+        self.returns  = any(code.opcode == Opcode.RET for code in fn.codes)
+
+
+class Inliner(object):
+    '''
+    関数の展開．呼び出される関数を先に最適化し (呼び出しグラフの帰りがけ順)，その本体を呼び出し元に複製する．
+    本体を登録するのは最適化を終えた関数だけなので，再帰する関数の呼び出しは 1 段だけ展開され，展開が止まらないことはない．
+    '''
+
+    def __init__(self, threshold: int = INLINE_THRESHOLD):
+        super().__init__()
+        self.threshold = threshold
+        self.bodies: Dict[str, InlineBody] = {}
+
+    def register(self, fn: Fundecl, size: int):
+        '''
+        最適化を終えた関数 fn を展開の候補にする．size は最適化する前の命令数
+        '''
+        if fn.name != 'main' and size <= INLINE_CANDIDATE_SIZE:
+            self.bodies[fn.name] = InlineBody(fn)
+
+    def cost(self, body: InlineBody, call: LLVMCode) -> int:
+        constants = sum(1 for arg in call.args if type(arg) is Factor and arg.scope == Scope.CONSTANT)
+        return body.size - 1 - len(call.args) - INLINE_CONSTANT_BONUS * constants
+
+    def inline(self, fn: Fundecl, cfg: CFG, block: BasicBlock, index: int, body: InlineBody,
+               results: Dict[int, Factor]) -> BasicBlock:
+        '''
+        block の index 番目の呼び出しを body の複製に置き換え，呼び出しの後の命令を移したブロックを返す
+        '''
+        call    = block.codes[index]
+        entry   = cfg.entry
+        replace = {i: arg for i, arg in enumerate(call.args)}
+        for code in body.cfg.instructions():
+            if code.defines is not None:
+                value = getattr(code, code.defines)
+                r     = register_of(value)
+                if r is not None:
+                    # alloca の結果は確保する型を持つので，複製して番号だけ付け替える
+                    replace[r]     = copy.copy(value)
+                    replace[r].val = fn.register()
+
+        # 呼び出しの後の命令は新しいブロックに移し，block の行き先の phi もそのブロックから来たことにする
+        label = cfg.label_of(block)
+        after = block
+        blocks: Dict[str, BasicBlock] = {}
+        for b in body.cfg.blocks:
+            after = blocks[b.label] = cfg.add_block(cfg.new_label(f"{body.name}.{b.label or 'entry'}"), after=after)
+        rest  = cfg.add_block(cfg.new_label(f"{body.name}.return"), after=after)
+        rest.codes = block.codes[index + 1:]
+        del block.codes[index:]
+        for succ in list(block.succs):
+            cfg.unlink(block, succ)
+            cfg.link(rest, succ)
+            cfg.rename_incoming(succ, label, rest.label)
+        labels = {l: b.label for l, b in blocks.items()}
+
+        returns: List[Tuple[Factor, str]] = []
+        terminators = []
+        for b in body.cfg.blocks:
+            new = blocks[b.label]
+            for code in b.codes:
+                if code.opcode == Opcode.RET:
+                    returns.append((replace.get(register_of(code.arg), code.arg), new.label))
+                    terminators.append((new, LLVMCodeBrUncond(label_factor(rest.label))))
+                    continue
+                if code.opcode == Opcode.BR_UNCOND:
+                    terminators.append((new, LLVMCodeBrUncond(label_factor(labels[code.arg1.val]))))
+                    continue
+                if code.opcode == Opcode.BR_COND:
+                    terminators.append((new, LLVMCodeBrCond(replace.get(register_of(code.arg1), code.arg1),
+                                                            label_factor(labels[code.arg2.val]),
+                                                            label_factor(labels[code.arg3.val]))))
+                    continue
+                clone = copy.copy(code)
+                for field in code.fields:
+                    value = getattr(code, field)
+                    if type(value) is list:
+                        setattr(clone, field, list(value))
+                replace_uses(clone, replace)
+                if code.defines is not None and register_of(getattr(code, code.defines)) is not None:
+                    setattr(clone, code.defines, replace[register_of(getattr(code, code.defines))])
+                if code.opcode == Opcode.PHI:
+                    clone.labels = [label_factor(labels[l.val]) for l in clone.labels]
+                if code.opcode == Opcode.ALLOCA:
+                    # ループの中で呼び出しても確保し直さないように，呼び出し元の入口に置く
+                    entry.codes.insert(0, clone)
+                    continue
+                new.codes.append(clone)
+
+        cfg.set_terminator(block, LLVMCodeBrUncond(label_factor(blocks[body.cfg.entry.label].label)))
+        for new, t in terminators:
+            cfg.set_terminator(new, t)
+        if len(returns) == 1:
+            results[call.retval.val] = returns[0][0]
+        else:
+            rest.codes.insert(0, LLVMCodePhi(call.retval, [v for v, _ in returns], [label_factor(l) for _, l in returns]))
+        return rest
+
+    def run(self, fn: Fundecl, cfg: CFG) -> bool:
+        size    = sum(len(block.codes) for block in cfg.blocks)
+        results: Dict[int, Factor] = {}
+        inlined = 0
+        work    = list(cfg.blocks)
+        while work:
+            block = work.pop(0)
+            for index, code in enumerate(block.codes):
+                if code.opcode != Opcode.CALL or code.func.name == fn.name:
+                    continue
+                body = self.bodies.get(code.func.name)
+                if body is None or not body.returns or self.cost(body, code) > self.threshold:
+                    continue
+                if size + body.size > INLINE_CALLER_MAX_SIZE:
+                    continue
+                work.insert(0, self.inline(fn, cfg, block, index, body, results))
+                size    += body.size
+                inlined += 1
+                break
+
+        if inlined > 0:
+            # 展開した本体のラベルは呼び出される関数のラベル番号を含み，呼び出し元の番号からはずらせないのでキャッシュしない
+            fn.fingerprint = None
+            # 展開した関数の返り値が別の展開した呼び出しの結果のこともある
+            for r, value in results.items():
+                while register_of(value) in results:
+                    value = results[register_of(value)]
+                results[r] = value
+            if len(results) > 0:
+                for code in cfg.instructions():
+                    replace_uses(code, results)
+            cfg.merge_blocks()
+
+        tracer = fn.tracer
+        if tracer.enabled(TRACE_INFO):
+            tracer.emit('inline.summary', f"{fn.name}: {inlined}個の呼び出しを展開",
+                        function=fn.name, inlined=inlined)
+        return inlined > 0
+
+
+def inline_calls(fn: Fundecl, cfg: CFG, inliner: Optional[Inliner] = None) -> bool:
+    '''
+    関数の展開: 先に最適化した小さな関数の呼び出しを，その本体の複製に置き換える (Inliner を参照)
+    '''
+    if inliner is None:
+        return False
+    return inliner.run(fn, cfg)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+'''
+このコンパイラが出力する LLVM IR を実行するインタプリタ．
+実行した命令の数を命令の種類ごとに数えるので，最適化で実行時の命令や分岐がどれだけ減ったかを測れる．
+
+    python3 interp.py out.ll < input.txt
+    python3 interp.py --source pscripts/whilewhile.p -O mem2reg -O licm
+'''
+import argparse
+import re
+import sys
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from llvmcodes import CmpType, Opcode, fold_binary, to_i32
+
+DEFINE_RE = re.compile(r"define i32 @([\w.]+)\((.*)\)\{$")
+GLOBAL_RE = re.compile(r"@([\w.]+) = common (?:dso_local )?global (?:i32 0|\[(\d+) x i32\] zeroinitializer)")
+
+OPERATORS = {'add nsw': Opcode.ADD, 'sub nsw': Opcode.SUB, 'mul nsw': Opcode.MUL, 'sdiv': Opcode.SDIV}
+CMPTYPES  = {str(c): c for c in CmpType}
+
+
+class Function(object):
+    '''
+    関数の命令列．命令は (命令の種類, オペランド...) のタプルで，blocks はラベル -> 命令の位置
+    '''
+
+    def __init__(self, name: str, args_cnt: int):
+        super().__init__()
+        self.name     = name
+        self.args_cnt = args_cnt
+        self.codes:  List[tuple]    = []
+        self.blocks: Dict[str, int] = {}
+
+
+def decode(line: str) -> tuple:
+    '''
+    1 行の命令をタプルにする
+    '''
+    retval, _, rest = line.partition(' = ') if line.startswith('%') else ('', '', line)
+    if rest.startswith('store '):
+        m = re.match(r"store i32 (\S+), i32\* (\S+), align", rest)
+        return ('store', m.group(1), m.group(2))
+    if rest.startswith('br label '):
+        return ('br', rest[len('br label %'):])
+    if rest.startswith('br i1 '):
+        m = re.match(r"br i1 (\S+), label %(\S+), label %(\S+)", rest)
+        return ('condbr', m.group(1), m.group(2), m.group(3))
+    if rest.startswith('ret i32 '):
+        return ('ret', rest[len('ret i32 '):])
+    if rest.startswith('alloca '):
+        m = re.match(r"alloca (?:i32|\[(\d+) x i32\]),", rest)
+        return ('alloca', retval, int(m.group(1) or 1))
+    if rest.startswith('load '):
+        return ('load', retval, re.match(r"load i32, i32\* (\S+), align", rest).group(1))
+    if rest.startswith('icmp '):
+        m = re.match(r"icmp (\w+) i32 (\S+), (\S+)$", rest)
+        return ('icmp', retval, CMPTYPES[m.group(1)], m.group(2), m.group(3))
+    if rest.startswith('getelementptr '):
+        m = re.match(r"getelementptr inbounds \[\d+ x i32\], \[\d+ x i32\]\* (\S+), i32 0, i32 (\S+)$", rest)
+        return ('gep', retval, m.group(1), m.group(2))
+    if rest.startswith('phi '):
+        incoming = re.findall(r"\[ (\S+), %(\S+) \]", rest)
+        return ('phi', retval, {label: value for value, label in incoming})
+    if '@printf(' in rest:
+        return ('write', re.search(r"i32 (\S+)\)$", rest).group(1))
+    if '@__isoc99_scanf(' in rest:
+        return ('read', re.search(r"i32\* (\S+)\)$", rest).group(1))
+    if rest.startswith(('tail call ', 'musttail call ')):
+        rest = rest.partition(' ')[2]
+    if rest.startswith('call i32 @'):
+        m = re.match(r"call i32 @([\w.]+)\((.*)\)$", rest)
+        args = [a[len('i32 '):] for a in m.group(2).split(', ')] if m.group(2) else []
+        return ('call', retval, m.group(1), args)
+    for name, opcode in OPERATORS.items():
+        if rest.startswith(name + ' i32 '):
+            a, b = rest[len(name + ' i32 '):].split(', ')
+            return ('binary', retval, opcode, a, b)
+    raise ValueError(f'解釈できない命令: {line}')
+
+
+def load_module(ir: str) -> Tuple[Dict[str, Function], Dict[str, list]]:
+    '''
+    LLVM IR を関数と大域変数 (名前 -> 値のリスト) に分ける
+    '''
+    functions: Dict[str, Function] = {}
+    globals_:  Dict[str, list]     = {}
+    fn: Optional[Function] = None
+    for line in ir.splitlines():
+        line = line.strip()
+        if not len(line) > 0:
+            continue
+        if fn is None:
+            m = DEFINE_RE.match(line)
+            if m is not None:
+                fn = Function(m.group(1), len(m.group(2).split(', ')) if m.group(2) else 0)
+                functions[fn.name] = fn
+                continue
+            m = GLOBAL_RE.match(line)
+            if m is not None:
+                globals_['@' + m.group(1)] = [0] * int(m.group(2) or 1)
+        elif line == '}':
+            fn = None
+        elif line.endswith(':'):
+            fn.blocks[line[:-1]] = len(fn.codes)
+        else:
+            fn.codes.append(decode(line))
+    return functions, globals_
+
+
+class Interpreter(object):
+    '''
+    LLVM IR を実行する．ポインタは (値のリスト, 添字) で表す．
+    counts は実行した命令の種類ごとの数 (br と条件付きの br は branch にもまとめて数える)．
+    '''
+
+    def __init__(self, ir: str, stdin: Optional[List[int]] = None, max_steps: int = 100_000_000):
+        super().__init__()
+        self.functions, self.globals = load_module(ir)
+        self.stdin     = list(stdin or [])
+        self.output:   List[int] = []
+        self.counts    = Counter()
+        self.steps     = 0
+        self.max_steps = max_steps
+
+    def run(self) -> List[int]:
+        self.call('main', [])
+        return self.output
+
+    @property
+    def instructions(self) -> int:
+        return sum(n for kind, n in self.counts.items() if kind != 'branch')
+
+    def call(self, name: str, args: List[int]) -> int:
+        fn   = self.functions[name]
+        regs = {f'%{i}': v for i, v in enumerate(args)}
+
+        def value(operand):
+            if operand[0] == '%':
+                return regs[operand]
+            if operand[0] == '@':
+                return (self.globals[operand], 0)
+            return int(operand)
+
+        starts = {pc: label for label, pc in fn.blocks.items()}
+        block  = starts.get(0, 'entry')
+        pc     = 0
+        while True:
+            code = fn.codes[pc]
+            kind = code[0]
+            self.counts[kind] += 1
+            self.steps += 1
+            if self.steps > self.max_steps:
+                raise RuntimeError('実行する命令の数が多すぎます')
+            pc += 1
+            if kind == 'binary':
+                result = fold_binary(code[2], value(code[3]), value(code[4]))
+                if result is None:
+                    raise ZeroDivisionError(f'{fn.name}: {code}')
+                regs[code[1]] = result
+            elif kind == 'load':
+                memory, i = value(code[2])
+                regs[code[1]] = memory[i]
+            elif kind == 'store':
+                memory, i = value(code[2])
+                memory[i] = value(code[1])
+            elif kind == 'icmp':
+                regs[code[1]] = 1 if code[2].evaluate(value(code[3]), value(code[4])) else 0
+            elif kind == 'gep':
+                memory, i = value(code[2])
+                regs[code[1]] = (memory, i + value(code[3]))
+            elif kind in ('br', 'condbr'):
+                self.counts['branch'] += 1
+                target = code[1] if kind == 'br' else (code[2] if value(code[1]) != 0 else code[3])
+                pc     = fn.blocks[target]
+                # ブロックの先頭の phi は同時に値を決める
+                phis = []
+                while fn.codes[pc][0] == 'phi':
+                    phis.append(fn.codes[pc])
+                    pc += 1
+                values = [value(phi[2][block]) for phi in phis]
+                for phi, v in zip(phis, values):
+                    regs[phi[1]] = v
+                if len(phis) > 0:
+                    self.counts['phi'] += len(phis)
+                self.steps         += len(phis)
+                block = target
+            elif kind == 'alloca':
+                regs[code[1]] = ([0] * code[2], 0)
+            elif kind == 'write':
+                self.output.append(value(code[1]))
+            elif kind == 'read':
+                memory, i = value(code[1])
+                memory[i] = to_i32(self.stdin.pop(0)) if len(self.stdin) > 0 else 0
+            elif kind == 'call':
+                regs[code[1]] = self.call(code[2], [value(a) for a in code[3]])
+            elif kind == 'ret':
+                return value(code[1])
+            else:
+                raise ValueError(f'{fn.name}: 実行できない命令 {code}')
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description='LLVM IR を実行し，実行した命令の数を数える')
+    argparser.add_argument('ir', nargs='?', help='LLVM IR のファイル (--source のときは不要)')
+    argparser.add_argument('--source', default=None, metavar='PATH', help='PL-X のソースファイルをコンパイルして実行する')
+    argparser.add_argument('-O', '--opt', action='append', default=[], metavar='NAME', help='--source の最適化')
+    args = argparser.parse_args()
+
+    if args.source is not None:
+        from parser import compile_source
+        with open(args.source) as f:
+            ir = compile_source(f.read(), {name: True for name in args.opt})
+    else:
+        with open(args.ir) as f:
+            ir = f.read()
+
+    interpreter = Interpreter(ir, [int(t) for t in sys.stdin.read().split()] if not sys.stdin.isatty() else [])
+    for v in interpreter.run():
+        print(v)
+    print(f"instructions: {interpreter.instructions}", file=sys.stderr)
+    for kind, n in sorted(interpreter.counts.items()):
+        print(f"  {kind}: {n}", file=sys.stderr)
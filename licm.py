@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Set
+
+from cfg import CFG, BasicBlock, register_of, used_values
+from decls import Factor, Fundecl
+from dominance import dominator_tree
+from gvn import MemoryModel
+from llvmcodes import LLVMCode, LLVMCodeLoad, LLVMCodeStore, Opcode
+from loops import Loop, insert_preheader, loop_forest, split_exits
+from mem2reg import place_phis, remove_dead_phis, rename, slot_key
+from symtab import Scope
+from tracing import TRACE_INFO
+
+# ループの外に出しても結果が変わらず，例外も起こさない命令 (sdiv と load は別に調べる)
+SPECULATABLE = frozenset((Opcode.ADD, Opcode.SUB, Opcode.MUL, Opcode.ICMP, Opcode.GETELEMENTPTR))
+
+
+def simplify_loops(fn: Fundecl, cfg: CFG) -> int:
+    '''
+    全てのループに preheader を作り，出口のブロックにはループの中からしか入らないようにする．
+    '''
+    changed = 0
+    for loop in loop_forest(cfg).loops:
+        if loop.preheader is None and insert_preheader(fn, cfg, loop) is not None:
+            changed += 1
+        changed += split_exits(cfg, loop)
+    return changed
+
+
+def scalar_slots(cfg: CFG) -> Set[object]:
+    '''
+    i32 の変数 (大域変数と alloca) のキー
+    '''
+    slots = set()
+    for code in cfg.instructions():
+        if code.opcode == Opcode.ALLOCA and code.retval.size == 0:
+            slots.add(slot_key(code.retval))
+        elif code.opcode in (Opcode.LOAD, Opcode.STORE):
+            f = code.arg2
+            if type(f) is Factor and f.scope == Scope.GLOBAL and f.size == 0:
+                slots.add(slot_key(f))
+    return slots
+
+
+def promote_loop(fn: Fundecl, loop: Loop, scalars: Set[object], slots: Dict[object, Factor]) -> int:
+    '''
+    ループの中で読み書きする変数を，ループの間だけ別の変数 (レジスタに昇格させるもの) に置き換える．
+    preheader で元の変数から読み込み，出口で書き戻す．ループの中で関数を呼び出すなら大域変数は置き換えない．
+    '''
+    accesses: Dict[object, List[LLVMCode]] = {}
+    stored:   Dict[object, bool]           = {}  # 書き込む変数 (順番を保つ)
+    escaped:  Set[object]                  = set()
+    calls = False
+    for block in loop.blocks:
+        for code in block.codes:
+            address = code.arg2 if code.opcode in (Opcode.LOAD, Opcode.STORE) else None
+            for value in used_values(code):
+                if value is not address:
+                    escaped.add(slot_key(value))
+            if address is not None:
+                key = slot_key(address)
+                accesses.setdefault(key, []).append(code)
+                if code.opcode == Opcode.STORE:
+                    stored[key] = True
+            calls = calls or code.opcode == Opcode.CALL
+
+    promoted  = 0
+    preheader = loop.preheader
+    for key in stored:
+        if key not in scalars or key in escaped or (calls and type(key) is str):
+            continue
+        original = accesses[key][0].arg2
+        temp     = Factor(Scope.LOCAL, val=fn.register())
+        slots[slot_key(temp)] = temp
+        for code in accesses[key]:
+            code.arg2 = temp
+
+        value = Factor(Scope.LOCAL, val=fn.register())
+        preheader.codes[-1:-1] = [LLVMCodeLoad(value, original), LLVMCodeStore(value, temp)]
+        for exit in loop.exits:
+            value = Factor(Scope.LOCAL, val=fn.register())
+            index = sum(1 for _ in exit.phis())
+            exit.codes[index:index] = [LLVMCodeLoad(value, temp), LLVMCodeStore(value, original)]
+        promoted += 1
+    return promoted
+
+
+def hoist_invariants(fn: Fundecl, cfg: CFG) -> int:
+    '''
+    ループの中で値の変わらない命令を preheader に移す．内側のループから順に調べるので，何重のループでも外に出せる．
+    sdiv は 0 や -1 でない定数で割るとき，load は i32 の変数から読むときだけ，どこでも実行してよいものとする．
+    そうでなければ，ループに入れば必ず実行されるブロック (ループを出るブロックと header に戻るブロックを全て支配するもの) の命令に限る．
+    '''
+    tree   = dominator_tree(cfg)
+    memory = MemoryModel(cfg)
+    owner: Dict[int, BasicBlock] = {}
+    for block in cfg.blocks:
+        for code in block.codes:
+            if code.defines is not None:
+                r = register_of(getattr(code, code.defines))
+                if r is not None:
+                    owner[r] = block
+
+    hoisted = 0
+    for loop in loop_forest(cfg).loops:
+        preheader = loop.preheader
+        if preheader is None:
+            continue
+        kills    = set(k for block in loop.blocks for code in block.codes for k in memory.clobbers(code))
+        exits    = loop.exiting + loop.latches if len(loop.exiting) > 0 else None
+        moved: List[LLVMCode] = []
+
+        def invariant(value) -> bool:
+            r = register_of(value)
+            return r is None or r not in owner or owner[r] not in loop
+
+        for block in loop.blocks:
+            guaranteed = exits is not None and all(tree.dominates(block, e) for e in exits)
+            codes = []
+            for code in block.codes:
+                op = code.opcode
+                ok = op in SPECULATABLE or op in (Opcode.SDIV, Opcode.LOAD)
+                if ok and not all(invariant(v) for v in used_values(code)):
+                    ok = False
+                if ok and op == Opcode.SDIV and not guaranteed:
+                    divisor = code.arg2
+                    ok = divisor.scope == Scope.CONSTANT and divisor.val not in (0, -1)
+                if ok and op == Opcode.LOAD:
+                    address = memory.address(code.arg2)
+                    ok = not any(memory.may_alias(k, address) for k in kills) and (address[0] == 'slot' or guaranteed)
+                if not ok:
+                    codes.append(code)
+                    continue
+                moved.append(code)
+                owner[register_of(getattr(code, code.defines))] = preheader
+            block.codes = codes
+        if len(moved) > 0:
+            preheader.codes[-1:-1] = moved
+            hoisted += len(moved)
+    return hoisted
+
+
+def hoist_loop_invariants(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    LICM: ループに preheader を作り，ループの中で読み書きする変数をレジスタに昇格させてから，
+    ループの中で値の変わらない命令を preheader に移す．
+    '''
+    cfg.remove_unreachable()
+    forest = loop_forest(cfg)
+    if not len(forest) > 0:
+        return False
+    simplified = simplify_loops(fn, cfg)
+
+    slots: Dict[object, Factor] = {}
+    scalars  = scalar_slots(cfg)
+    promoted = 0
+    for loop in loop_forest(cfg).loops:
+        promoted += promote_loop(fn, loop, scalars, slots)
+    if len(slots) > 0:
+        phis = place_phis(fn, cfg, slots)
+        rename(cfg, slots, phis)
+        remove_dead_phis(cfg, phis)
+
+    hoisted = hoist_invariants(fn, cfg)
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('licm.summary', f"{fn.name}: {len(forest)}個のループ, {promoted}個の変数をレジスタに昇格, "
+                    f"{hoisted}個の命令をループの外へ移動",
+                    function=fn.name, loops=len(forest), simplified=simplified, promoted=promoted, hoisted=hoisted)
+    return simplified + promoted + hoisted > 0
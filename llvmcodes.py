@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from enum import Enum
+from enum import Enum, IntEnum
+from typing import Optional
 
 
 class CmpType(Enum):
@@ -42,14 +43,108 @@ class CmpType(Enum):
             return 'sle'
         return super().__str__()
 
+    def evaluate(self, a: int, b: int) -> bool:
+        '''
+        符号付き整数 a, b を比較する (定数の畳み込み用)
+        '''
+        if self == CmpType.EQ:
+            return a == b
+        if self == CmpType.NE:
+            return a != b
+        if self == CmpType.SGT:
+            return a > b
+        if self == CmpType.SGE:
+            return a >= b
+        if self == CmpType.SLT:
+            return a < b
+        if self == CmpType.SLE:
+            return a <= b
+        raise ValueError(f'KeyError: {self}')
+
+
+class Opcode(IntEnum):
+    '''
+    命令の種類．最適化はクラスではなくこの番号で命令を見分ける．
+    '''
+    ALLOCA          = 0
+    GLOBAL          = 1
+    STORE           = 2
+    LOAD            = 3
+    BR_UNCOND       = 4
+    BR_COND         = 5
+    ICMP            = 6
+    ADD             = 7
+    SUB             = 8
+    MUL             = 9
+    SDIV            = 10
+    RET             = 11
+    LABEL           = 12
+    WRITE_FORMAT    = 13
+    READ_FORMAT     = 14
+    WRITE           = 15
+    READ            = 16
+    DECLARE_PRINTF  = 17
+    DECLARE_SCANF   = 18
+    CALL            = 19
+    GETELEMENTPTR   = 20
+    PHI             = 21
+
+
+INT32_MIN = -(1 << 31)
+INT32_MAX = (1 << 31) - 1
+
+
+def to_i32(v: int) -> int:
+    '''
+    v を i32 の範囲に折り返す (2 の補数)
+    '''
+    return (v - INT32_MIN) % (1 << 32) + INT32_MIN
+
+
+def fold_binary(opcode: Opcode, a: int, b: int) -> Optional[int]:
+    '''
+    i32 の二項演算を計算する．sdiv は 0 の方向に切り捨てる．
+    結果が未定義になる 0 除算と INT32_MIN / -1 は畳み込まずに None を返す．
+    '''
+    if opcode == Opcode.ADD:
+        return to_i32(a + b)
+    if opcode == Opcode.SUB:
+        return to_i32(a - b)
+    if opcode == Opcode.MUL:
+        return to_i32(a * b)
+    if opcode == Opcode.SDIV:
+        if b == 0 or (a == INT32_MIN and b == -1):
+            return None
+        q = abs(a) // abs(b)
+        return q if (a < 0) == (b < 0) else -q
+    raise ValueError(f'KeyError: {opcode}')
+
 
 class LLVMCode(object):
+    '''
+    命令の基底クラス．
+    命令は大量に作られるので，全てのクラスで __slots__ を使って __dict__ を持たないようにする．
+    opcode は命令の種類，fields はオペランドの属性名 (宣言した順)．
+    defines は結果を書き込むレジスタの属性名，uses は値として読み出すオペランドの属性名 (ラベルは含めない)．
+    '''
+    __slots__ = ()
+    opcode: Opcode
+    fields: tuple = ()
+    defines: Optional[str] = None
+    uses: tuple = ()
+
     def __init__(self):
         pass
 
-    def __str__(self) -> str:
+    def format(self, reg=str) -> str:
+        '''
+        命令を文字列にする．オペランドは reg で文字列にする (レジスタ番号の付け直しに使う)．
+        '''
         raise NotImplementedError()
 
+    def __str__(self) -> str:
+        return self.format()
+
     def __repr__(self) -> str:
         return self.__str__()
 
@@ -59,13 +154,17 @@ class LLVMCodeAlloca(LLVMCode):
     %i = alloca i32, align 4
     現在実行中の関数のスタックフレーム上に int 型の変数を確保し，そのメモリ番地を返す
     '''
+    __slots__ = ('retval',)
+    fields    = __slots__
+    defines   = 'retval'
+    opcode    = Opcode.ALLOCA
 
     def __init__(self, retval):
         super().__init__()
         self.retval = retval
 
-    def __str__(self) -> str:
-        return f"{self.retval} = alloca {self.retval.vartype}, align {16 if self.retval.size > 0 else 4}"
+    def format(self, reg=str) -> str:
+        return f"{reg(self.retval)} = alloca {self.retval.vartype}, align {16 if self.retval.size > 0 else 4}"
 
 
 class LLVMCodeGlobal(LLVMCode):
@@ -73,16 +172,19 @@ class LLVMCodeGlobal(LLVMCode):
     @n = common global i32 0, align 4
     i32 型の大域変数を確保し（0 で初期化），そのメモリ番地を返す．
     '''
+    __slots__ = ('retval',)
+    fields    = __slots__
+    opcode    = Opcode.GLOBAL
 
     def __init__(self, retval):
         super().__init__()
         self.retval = retval
 
-    def __str__(self) -> str:
+    def format(self, reg=str) -> str:
         if self.retval.size > 0:
-            return f"{self.retval} = common dso_local global [{self.retval.size} x i32] zeroinitializer, align 16"
+            return f"{reg(self.retval)} = common dso_local global [{self.retval.size} x i32] zeroinitializer, align 16"
         else:
-            return f"{self.retval} = common global i32 0, align 4"
+            return f"{reg(self.retval)} = common global i32 0, align 4"
 
 
 class LLVMCodeStore(LLVMCode):
@@ -90,14 +192,18 @@ class LLVMCodeStore(LLVMCode):
     store i32 1234, i32* p, align 4
     i32 型の値 1234 を，p が指しているメモリ番地に格納している
     '''
+    __slots__ = ('arg1', 'arg2')
+    fields    = __slots__
+    opcode    = Opcode.STORE
+    uses      = ('arg1', 'arg2')
 
     def __init__(self, arg1, arg2):
         super().__init__()
         self.arg1 = arg1
         self.arg2 = arg2
 
-    def __str__(self) -> str:
-        return f"store i32 {self.arg1}, i32* {self.arg2}, align 4"
+    def format(self, reg=str) -> str:
+        return f"store i32 {reg(self.arg1)}, i32* {reg(self.arg2)}, align 4"
 
 
 class LLVMCodeLoad(LLVMCode):
@@ -105,14 +211,19 @@ class LLVMCodeLoad(LLVMCode):
     r = load i32, i32* p, align 4
     メモリ p が指すメモリ番地から値を読み出し，レジスタ r に格納する
     '''
+    __slots__ = ('arg1', 'arg2')
+    fields    = __slots__
+    defines   = 'arg1'
+    opcode    = Opcode.LOAD
+    uses      = ('arg2',)
 
     def __init__(self, arg1, arg2):
         super().__init__()
         self.arg1 = arg1
         self.arg2 = arg2
 
-    def __str__(self) -> str:
-        return f"{self.arg1} = load i32, i32* {self.arg2}, align 4"
+    def format(self, reg=str) -> str:
+        return f"{reg(self.arg1)} = load i32, i32* {reg(self.arg2)}, align 4"
 
 
 class LLVMCodeBrUncond(LLVMCode):
@@ -120,19 +231,26 @@ class LLVMCodeBrUncond(LLVMCode):
     br label dest
     無条件でラベル dest へとジャンプする．
     '''
+    __slots__ = ('arg1',)
+    fields    = __slots__
+    opcode    = Opcode.BR_UNCOND
 
     def __init__(self, arg1):
         super().__init__()
         self.arg1 = arg1
 
-    def __str__(self) -> str:
-        return f"br label {self.arg1}"
+    def format(self, reg=str) -> str:
+        return f"br label {reg(self.arg1)}"
 
 class LLVMCodeBrCond(LLVMCode):
     '''
     br i1 %0 label %loop.end, label %loop.body
     条件付きでラベルへとジャンプする．
     '''
+    __slots__ = ('arg1', 'arg2', 'arg3')
+    fields    = __slots__
+    opcode    = Opcode.BR_COND
+    uses      = ('arg1',)
 
     def __init__(self, arg1, arg2, arg3):
         super().__init__()
@@ -140,8 +258,8 @@ class LLVMCodeBrCond(LLVMCode):
         self.arg2 = arg2
         self.arg3 = arg3
 
-    def __str__(self) -> str:
-        return f"br i1 {self.arg1}, label {self.arg2}, label {self.arg3}"
+    def format(self, reg=str) -> str:
+        return f"br i1 {reg(self.arg1)}, label {reg(self.arg2)}, label {reg(self.arg3)}"
 
 
 class LLVMCodeIcmp(LLVMCode):
@@ -150,6 +268,11 @@ class LLVMCodeIcmp(LLVMCode):
     cond で指定された比較を行い，true/false の 2 値（型は i1）を返す．比較演算には以下の 10 種類がある．
     eq, ne, ugt, uge, ult, ule, sgt, sge, slt, sle
     '''
+    __slots__ = ('cmptype', 'arg1', 'arg2', 'retval')
+    fields    = __slots__
+    defines   = 'retval'
+    opcode    = Opcode.ICMP
+    uses      = ('arg1', 'arg2')
 
     def __init__(self, cmptype: CmpType, arg1, arg2, retval):
         super().__init__()
@@ -158,125 +281,199 @@ class LLVMCodeIcmp(LLVMCode):
         self.arg2 = arg2
         self.retval = retval
 
-    def __str__(self) -> str:
-        return f"{self.retval} = icmp {self.cmptype} i32 {self.arg1}, {self.arg2}"
+    def format(self, reg=str) -> str:
+        return f"{reg(self.retval)} = icmp {self.cmptype} i32 {reg(self.arg1)}, {reg(self.arg2)}"
 
 
 class LLVMCodeOperator(LLVMCode):
+    '''
+    二項演算の基底クラス．演算の名前 operator はクラスごとに決まる．
+    '''
+    __slots__ = ('arg1', 'arg2', 'retval')
+    fields    = __slots__
+    defines   = 'retval'
+    uses      = ('arg1', 'arg2')
+    operator  = ""
 
-    def __init__(self, arg1, arg2, retval, operator: str = ""):
+    def __init__(self, arg1, arg2, retval):
         super().__init__()
         self.arg1 = arg1
         self.arg2 = arg2
         self.retval = retval
-        self.operator = operator
 
-    def __str__(self) -> str:
-        return f"{self.retval} = {self.operator} i32 {self.arg1}, {self.arg2}"
+    def format(self, reg=str) -> str:
+        return f"{reg(self.retval)} = {self.operator} i32 {reg(self.arg1)}, {reg(self.arg2)}"
 
 
 class LLVMCodeAdd(LLVMCodeOperator):
     '''
     %3 = add nsw i32 %2, 10
     '''
+    __slots__ = ()
+    opcode    = Opcode.ADD
+    operator  = "add nsw"
 
     def __init__(self, arg1: int, arg2: int, retval):
-        super().__init__(arg1, arg2, retval, "add nsw")
+        super().__init__(arg1, arg2, retval)
 
 
 class LLVMCodeSub(LLVMCodeOperator):
     '''
     %4 = sub nsw i32 100, %3
     '''
+    __slots__ = ()
+    opcode    = Opcode.SUB
+    operator  = "sub nsw"
 
     def __init__(self, arg1: int, arg2: int, retval):
-        super().__init__(arg1, arg2, retval, "sub nsw")
+        super().__init__(arg1, arg2, retval)
 
 
 class LLVMCodeMul(LLVMCodeOperator):
     '''
     %5 = mul nsw i32 %4, 2
     '''
+    __slots__ = ()
+    opcode    = Opcode.MUL
+    operator  = "mul nsw"
 
     def __init__(self, arg1: int, arg2: int, retval):
-        super().__init__(arg1, arg2, retval, "mul nsw")
+        super().__init__(arg1, arg2, retval)
 
 
 class LLVMCodeDiv(LLVMCodeOperator):
     '''
     %6 = sdiv i32 %5, %2
     '''
+    __slots__ = ()
+    opcode    = Opcode.SDIV
+    operator  = "sdiv"
 
     def __init__(self, arg1: int, arg2: int, retval):
-        super().__init__(arg1, arg2, retval, "sdiv")
+        super().__init__(arg1, arg2, retval)
 
 
 class LLVMCodeProcReturn(LLVMCode):
+    __slots__ = ('arg',)
+    fields    = __slots__
+    opcode    = Opcode.RET
+    uses      = ('arg',)
+
     def __init__(self, arg = 0):
         self.arg = arg
-    def __str__(self) -> str:
-        return f"ret i32 {self.arg}"
+    def format(self, reg=str) -> str:
+        return f"ret i32 {reg(self.arg)}"
 
 class LLVMCodeRegisterLabel(LLVMCode):
+    __slots__ = ('label',)
+    fields    = __slots__
+    opcode    = Opcode.LABEL
+
     def __init__(self, label):
         super().__init__()
         self.label = label
 
-    def __str__(self) -> str:
+    def format(self, reg=str) -> str:
         return f"{self.label}:"
 
 class LLVMCodeWriteFormat(LLVMCode):
+    __slots__ = ()
+    fields    = __slots__
+    opcode    = Opcode.WRITE_FORMAT
+
     def __init__(self):
         super().__init__()
 
-    def __str__(self) -> str:
+    def format(self, reg=str) -> str:
         return '@.str.write = private unnamed_addr constant [4 x i8] c"%d\\0A\\00", align 1'
 
 class LLVMCodeReadFormat(LLVMCode):
+    __slots__ = ()
+    fields    = __slots__
+    opcode    = Opcode.READ_FORMAT
+
     def __init__(self):
         super().__init__()
 
-    def __str__(self) -> str:
+    def format(self, reg=str) -> str:
         return '@.str.read = private unnamed_addr constant [3 x i8] c"%d\\00", align 1'
 
 class LLVMCodeWrite(LLVMCode):
+    __slots__ = ('arg', 'retval')
+    fields    = __slots__
+    defines   = 'retval'
+    opcode    = Opcode.WRITE
+    uses      = ('arg',)
+
     def __init__(self, arg, retval):
         super().__init__()
         self.arg = arg
         self.retval = retval
 
-    def __str__(self) -> str:
-        return f'{self.retval} = call i32 (i8*, ...) @printf(i8* getelementptr inbounds ([4 x i8], [4 x i8]* @.str.write, i64 0, i64 0), i32 {self.arg})'
+    def format(self, reg=str) -> str:
+        return f'{reg(self.retval)} = call i32 (i8*, ...) @printf(i8* getelementptr inbounds ([4 x i8], [4 x i8]* @.str.write, i64 0, i64 0), i32 {reg(self.arg)})'
 
 class LLVMCodeRead(LLVMCode):
+    __slots__ = ('arg', 'retval')
+    fields    = __slots__
+    defines   = 'retval'
+    opcode    = Opcode.READ
+    uses      = ('arg',)
+
     def __init__(self, arg, retval):
         super().__init__()
         self.arg = arg
         self.retval = retval
 
-    def __str__(self) -> str:
-        return f'{self.retval} = call i32 (i8*, ...) @__isoc99_scanf(i8* getelementptr inbounds ([3 x i8], [3 x i8]* @.str.read, i64 0, i64 0), i32* {self.arg})'
+    def format(self, reg=str) -> str:
+        return f'{reg(self.retval)} = call i32 (i8*, ...) @__isoc99_scanf(i8* getelementptr inbounds ([3 x i8], [3 x i8]* @.str.read, i64 0, i64 0), i32* {reg(self.arg)})'
 
 class LLVMCodeDeclarePrintf(LLVMCode):
-    def __str__(self) -> str:
+    __slots__ = ()
+    fields    = __slots__
+    opcode    = Opcode.DECLARE_PRINTF
+
+    def format(self, reg=str) -> str:
         return 'declare dso_local i32 @printf(i8*, ...) #1'
 
 class LLVMCodeDeclareScanf(LLVMCode):
-    def __str__(self) -> str:
+    __slots__ = ()
+    fields    = __slots__
+    opcode    = Opcode.DECLARE_SCANF
+
+    def format(self, reg=str) -> str:
         return 'declare dso_local i32 @__isoc99_scanf(i8*, ...) #1'
 
 class LLVMCodeCallProc(LLVMCode):
-    def __init__(self, func, args, retval):
+    '''
+    %r = call i32 @f(i32 %a, ...)
+    tail が 'tail' / 'musttail' のときは末尾呼び出しの印を付けて出力する (tailcall.py)
+    '''
+    __slots__ = ('func', 'args', 'retval', 'tail')
+    fields    = ('func', 'args', 'retval')
+    defines   = 'retval'
+    opcode    = Opcode.CALL
+    uses      = ('args',)
+
+    def __init__(self, func, args, retval, tail=None):
         super().__init__()
         self.func = func
         self.args = args
         self.retval = retval
+        self.tail = tail
 
-    def __str__(self) -> str:
-        args = ', '.join([f"i32 {arg}" for arg in self.args])
-        return f'{self.retval} = call i32 {self.func}({args})'
+    def format(self, reg=str) -> str:
+        args = ', '.join([f"i32 {reg(arg)}" for arg in self.args])
+        call = 'call' if self.tail is None else f'{self.tail} call'
+        return f'{reg(self.retval)} = {call} i32 {reg(self.func)}({args})'
 
 class LLVMCodeGetPointer(LLVMCode):
+    __slots__ = ('arg1', 'arg2', 'index', 'size')
+    fields    = __slots__
+    defines   = 'arg1'
+    opcode    = Opcode.GETELEMENTPTR
+    uses      = ('arg2', 'index')
+
     def __init__(self, arg1, arg2, index, size):
         super().__init__()
         self.arg1 = arg1
@@ -284,5 +481,30 @@ class LLVMCodeGetPointer(LLVMCode):
         self.index = index
         self.size = size
 
-    def __str__(self) -> str:
-        return f'{self.arg1} = getelementptr inbounds [{self.size} x i32], [{self.size} x i32]* {self.arg2}, i32 0, i32 {self.index}'
+    def format(self, reg=str) -> str:
+        return f'{reg(self.arg1)} = getelementptr inbounds [{self.size} x i32], [{self.size} x i32]* {reg(self.arg2)}, i32 0, i32 {reg(self.index)}'
+
+class LLVMCodePhi(LLVMCode):
+    '''
+    %r = phi i32 [ %a, %while.init.0 ], [ %b, %while.body.0 ]
+    直前に実行したブロックが labels[i] のとき values[i] を r に格納する．mem2reg が局所変数の代わりに作る．
+    '''
+    __slots__ = ('retval', 'values', 'labels')
+    fields    = __slots__
+    defines   = 'retval'
+    opcode    = Opcode.PHI
+    uses      = ('values',)
+
+    def __init__(self, retval, values=None, labels=None):
+        super().__init__()
+        self.retval = retval
+        self.values = values if values is not None else []
+        self.labels = labels if labels is not None else []
+
+    def add_incoming(self, value, label):
+        self.values.append(value)
+        self.labels.append(label)
+
+    def format(self, reg=str) -> str:
+        incoming = ', '.join([f"[ {reg(v)}, {reg(l)} ]" for v, l in zip(self.values, self.labels)])
+        return f"{reg(self.retval)} = phi i32 {incoming}"
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Optional, Tuple
+
+from cfg import CFG, BasicBlock, label_factor
+from decls import Factor, Fundecl
+from dominance import dominator_tree
+from llvmcodes import LLVMCodeBrUncond, LLVMCodePhi
+from symtab import Scope
+
+
+class Loop(object):
+    '''
+    自然ループ．header は入口のブロック，latches は header に戻る辺 (後退辺) の元のブロック．
+    blocks は内側のループのブロックも含み，逆後順に並ぶ．
+    '''
+
+    def __init__(self, header: BasicBlock):
+        super().__init__()
+        self.header   = header
+        self.latches: List[BasicBlock] = []
+        self.blocks:  List[BasicBlock] = [header]
+        self.ids                       = {id(header)}
+        self.parent:   Optional['Loop'] = None
+        self.children: List['Loop']     = []
+
+    def __contains__(self, block: BasicBlock) -> bool:
+        return id(block) in self.ids
+
+    @property
+    def depth(self) -> int:
+        depth, loop = 1, self.parent
+        while loop is not None:
+            depth, loop = depth + 1, loop.parent
+        return depth
+
+    @property
+    def kind(self) -> Optional[str]:
+        '''
+        コード生成器が作ったループなら while / for (header のラベルの先頭)
+        '''
+        label = self.header.label or ''
+        prefix = label.split('.')[0]
+        return prefix if prefix in ('while', 'for') else None
+
+    @property
+    def preheader(self) -> Optional[BasicBlock]:
+        '''
+        ループの外から header に入る唯一のブロックで，header にしか分岐しないもの (なければ None)
+        '''
+        outside = [p for p in self.header.preds if p not in self]
+        if len(outside) == 1 and outside[0].succs == [self.header]:
+            return outside[0]
+        return None
+
+    @property
+    def exiting(self) -> List[BasicBlock]:
+        '''
+        ループの外へ出る辺を持つループ内のブロック
+        '''
+        return [b for b in self.blocks if any(s not in self for s in b.succs)]
+
+    @property
+    def exits(self) -> List[BasicBlock]:
+        '''
+        ループを出た直後に実行されるループ外のブロック
+        '''
+        exits, seen = [], set()
+        for block in self.blocks:
+            for succ in block.succs:
+                if succ not in self and id(succ) not in seen:
+                    seen.add(id(succ))
+                    exits.append(succ)
+        return exits
+
+    def __repr__(self) -> str:
+        return f"<Loop {self.header} depth={self.depth} blocks={len(self.blocks)}>"
+
+
+class LoopForest(object):
+    '''
+    関数の中の自然ループの入れ子．LLVM の LoopInfo と同じく，内側の header が先になるように逆後順の逆順で header を調べ，
+    後退辺から逆向きにたどってループのブロックを集める．内側のループは header に飛んでまとめて扱うので，
+    ブロックの数にほぼ比例する時間で求まる．
+    '''
+
+    def __init__(self, cfg: CFG):
+        super().__init__()
+        self.cfg        = cfg
+        self.roots:      List[Loop]                          = []
+        self.loops:      List[Loop]                          = []  # 内側のループが先
+        self.back_edges: List[Tuple[BasicBlock, BasicBlock]] = []
+        self.innermost:  Dict[int, Loop]                     = {}
+        self._build()
+
+    def _build(self):
+        cfg   = self.cfg
+        tree  = dominator_tree(cfg)
+        index = cfg.rpo_index()
+
+        for header in reversed(tree.blocks):
+            latches = [p for p in header.preds if id(p) in index and tree.dominates(header, p)]
+            if not len(latches) > 0:
+                continue
+            loop         = Loop(header)
+            loop.latches = latches
+            self.back_edges += [(latch, header) for latch in latches]
+            self.innermost[id(header)] = loop
+
+            work = [latch for latch in latches if latch is not header]
+            while work:
+                block = work.pop()
+                inner = self.innermost.get(id(block))
+                if inner is None:
+                    self.innermost[id(block)] = loop
+                    loop.blocks.append(block)
+                    loop.ids.add(id(block))
+                    work.extend(p for p in block.preds if id(p) in index)
+                    continue
+                while inner.parent is not None:
+                    inner = inner.parent
+                if inner is loop:
+                    continue
+                # 内側のループを取り込み，その header のループ外からの辺をたどる
+                inner.parent = loop
+                loop.children.append(inner)
+                loop.blocks += inner.blocks
+                loop.ids    |= inner.ids
+                work.extend(p for p in inner.header.preds if id(p) in index and p not in inner)
+
+            loop.blocks.sort(key=lambda b: index[id(b)])
+            self.loops.append(loop)
+
+        self.roots = [loop for loop in self.loops if loop.parent is None]
+        self.roots.sort(key=lambda loop: index[id(loop.header)])
+        for loop in self.loops:
+            loop.children.sort(key=lambda child: index[id(child.header)])
+
+    def loop_for(self, block: BasicBlock) -> Optional[Loop]:
+        '''
+        block を含む最も内側のループ
+        '''
+        return self.innermost.get(id(block))
+
+    def depth(self, block: BasicBlock) -> int:
+        loop = self.loop_for(block)
+        return loop.depth if loop is not None else 0
+
+    def is_back_edge(self, pred: BasicBlock, succ: BasicBlock) -> bool:
+        loop = self.innermost.get(id(succ))
+        return loop is not None and loop.header is succ and pred in loop.latches
+
+    def __iter__(self):
+        return iter(self.loops)
+
+    def __len__(self) -> int:
+        return len(self.loops)
+
+
+def loop_forest(cfg: CFG) -> LoopForest:
+    '''
+    cfg のループの入れ子．グラフを変えるまでは同じものを使い回す
+    '''
+    return cfg.cached('loops', lambda: LoopForest(cfg))
+
+
+def loop_label(cfg: CFG, loop: Loop, part: str) -> str:
+    '''
+    ループに追加するブロックのラベル．コード生成器のループなら header と同じ番号を使う (while.init.3 -> while.preheader.3)
+    '''
+    parts = (loop.header.label or '').split('.')
+    if loop.kind is not None and len(parts) == 3:
+        label = f"{parts[0]}.{part}.{parts[2]}"
+        if label not in cfg.labels:
+            return label
+    return cfg.new_label(part)
+
+
+def insert_preheader(fn: Fundecl, cfg: CFG, loop: Loop) -> Optional[BasicBlock]:
+    '''
+    loop に preheader がなければ header の直前に作り，ループの外から header への分岐をそこに集める．
+    header の phi のループの外からの値は preheader の phi にまとめる (値が 1 つなら phi は作らない)．
+    作ったブロックは外側のループにも加える．ループの外から入れない (入口の) ループでは None を返す．
+    '''
+    if loop.preheader is not None:
+        return loop.preheader
+    header  = loop.header
+    outside = []
+    for pred in header.preds:
+        if pred not in loop and pred not in outside:
+            outside.append(pred)
+    if not len(outside) > 0:
+        return None
+
+    block = cfg.add_block(loop_label(cfg, loop, 'preheader'), after=cfg.previous(header))
+
+    if next(header.phis(), None) is not None:
+        labels = set(cfg.label_of(p) for p in outside)
+        for phi in header.phis():
+            incoming = [(v, l) for v, l in zip(phi.values, phi.labels) if l.val in labels]
+            inside   = [(v, l) for v, l in zip(phi.values, phi.labels) if l.val not in labels]
+            if len(set((v.scope, v.name, v.val) for v, _ in incoming)) == 1:
+                value = incoming[0][0]
+            else:
+                merged = LLVMCodePhi(Factor(Scope.LOCAL, val=fn.register()),
+                                     [v for v, _ in incoming], [l for _, l in incoming])
+                block.codes.append(merged)
+                value = merged.retval
+            phi.values = [value] + [v for v, _ in inside]
+            phi.labels = [label_factor(block.label)] + [l for _, l in inside]
+
+    for pred in outside:
+        cfg.retarget(pred, header, block)
+    cfg.set_terminator(block, LLVMCodeBrUncond(label_factor(header.label)))
+
+    parent = loop.parent
+    while parent is not None:
+        parent.blocks.append(block)
+        parent.ids.add(id(block))
+        parent = parent.parent
+    return block
+
+
+def split_exits(cfg: CFG, loop: Loop) -> int:
+    '''
+    ループの外からも入る出口のブロックへの辺を分け，出口のブロックにはループの中からしか入らないようにする．
+    分けた数を返す．ラベルは preheader と同じく header の番号を使う (関数ごとのキャッシュで番号をずらせるように)．
+    '''
+    split = 0
+    for exit in loop.exits:
+        if all(p in loop for p in exit.preds):
+            continue
+        for pred in [p for p in exit.preds if p in loop]:
+            block = cfg.split_edge(pred, exit, label=loop_label(cfg, loop, 'exit'))
+            split += 1
+            parent = loop.parent
+            while parent is not None and exit in parent:
+                parent.blocks.append(block)
+                parent.ids.add(id(block))
+                parent = parent.parent
+    return split
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Optional, Tuple
+
+from cfg import CFG, label_factor, register_of, replace_uses, used_values
+from decls import Factor, Fundecl
+from dominance import dominator_tree
+from llvmcodes import LLVMCodePhi, Opcode
+from symtab import Scope
+from tracing import TRACE_INFO
+
+
+def slot_key(f):
+    '''
+    変数のメモリ番地を表すオペランドを見分けるキー．
+    局所変数 (alloca) は仮想レジスタ番号，大域変数は @名前 になる．
+    '''
+    if type(f) is not Factor:
+        return None
+    if f.scope == Scope.GLOBAL:
+        return str(f)
+    return register_of(f)
+
+
+def promotable_slots(fn: Fundecl, cfg: CFG) -> Dict[object, Factor]:
+    '''
+    レジスタに昇格できる変数．load / store の番地としてしか使われない i32 の変数に限る．
+    大域変数は，関数を呼び出さない main の中でだけ昇格する (他の関数から読み書きされず，初期値は 0)．
+    '''
+    slots: Dict[object, Factor] = {}
+    calls = False
+    for code in cfg.instructions():
+        if code.opcode == Opcode.ALLOCA and code.retval.size == 0:
+            slots[slot_key(code.retval)] = code.retval
+        calls = calls or code.opcode == Opcode.CALL
+
+    if fn.name == 'main' and not calls:
+        for code in cfg.instructions():
+            if code.opcode in (Opcode.LOAD, Opcode.STORE):
+                f = code.arg2
+                if type(f) is Factor and f.scope == Scope.GLOBAL and f.size == 0:
+                    slots.setdefault(slot_key(f), f)
+
+    # 番地そのものを値として使う変数 (scanf に渡すものなど) は昇格しない
+    for code in cfg.instructions():
+        address = code.arg2 if code.opcode in (Opcode.LOAD, Opcode.STORE) else None
+        for value in used_values(code):
+            if value is not address:
+                slots.pop(slot_key(value), None)
+    return slots
+
+
+def place_phis(fn: Fundecl, cfg: CFG, slots: Dict[object, Factor]) -> Dict[int, List[Tuple[object, LLVMCodePhi]]]:
+    '''
+    変数を書き込むブロックの反復支配辺境に phi を置く．
+    入口のブロックは初期値を書き込むブロックとして扱う．
+    '''
+    tree      = dominator_tree(cfg)
+    defblocks = {key: [cfg.entry] for key in slots}
+    for block in cfg.blocks:
+        for code in block.codes:
+            if code.opcode == Opcode.STORE:
+                key = slot_key(code.arg2)
+                if key in defblocks and defblocks[key][-1] is not block:
+                    defblocks[key].append(block)
+
+    phis: Dict[int, List[Tuple[object, LLVMCodePhi]]] = {}
+    for key, blocks in defblocks.items():
+        queued = set(id(b) for b in blocks)
+        placed = set()
+        work   = list(blocks)
+        while work:
+            block = work.pop()
+            for df in tree.frontier(block):
+                if id(df) in placed:
+                    continue
+                placed.add(id(df))
+                phi = LLVMCodePhi(Factor(Scope.LOCAL, val=fn.register()))
+                phis.setdefault(id(df), []).append((key, phi))
+                if id(df) not in queued:
+                    queued.add(id(df))
+                    work.append(df)
+
+    for block in cfg.blocks:
+        if id(block) in phis:
+            block.codes = [phi for _, phi in phis[id(block)]] + block.codes
+    return phis
+
+
+def rename(cfg: CFG, slots: Dict[object, Factor], phis: Dict[int, List[Tuple[object, LLVMCodePhi]]]):
+    '''
+    支配木を上からたどり，load を直前に書き込まれた値に置き換えて，変数の alloca / load / store を削除する．
+    '''
+    tree      = dominator_tree(cfg)
+    phi_slots = {id(phi): key for placed in phis.values() for key, phi in placed}
+    stacks    = {key: [Factor(Scope.CONSTANT, val=0)] for key in slots}
+    replace: Dict[int, Factor] = {}  # load の結果 -> その時点の変数の値
+
+    work: List[Tuple[object, Optional[list]]] = [(cfg.entry, None)]
+    while work:
+        block, pushed = work.pop()
+        if pushed is not None:
+            # 子を全て処理し終えたので，このブロックで積んだ値を戻す
+            for key in pushed:
+                stacks[key].pop()
+            continue
+
+        pushed = []
+        codes  = []
+        for code in block.codes:
+            key = phi_slots.get(id(code))
+            if key is not None:
+                stacks[key].append(code.retval)
+                pushed.append(key)
+                codes.append(code)
+                continue
+
+            replace_uses(code, replace)
+            if code.opcode == Opcode.ALLOCA and slot_key(code.retval) in slots:
+                continue
+            if code.opcode == Opcode.LOAD and slot_key(code.arg2) in slots:
+                replace[code.arg1.val] = stacks[slot_key(code.arg2)][-1]
+                continue
+            if code.opcode == Opcode.STORE and slot_key(code.arg2) in slots:
+                stacks[slot_key(code.arg2)].append(code.arg1)
+                pushed.append(slot_key(code.arg2))
+                continue
+            codes.append(code)
+        block.codes = codes
+
+        for succ in block.succs:
+            for key, phi in phis.get(id(succ), []):
+                phi.add_incoming(stacks[key][-1], label_factor(cfg.label_of(block)))
+
+        work.append((block, pushed))
+        for child in reversed(tree.children(block)):
+            work.append((child, None))
+
+    # 既にある phi は，支配木で後に来るブロックの load の結果を受け取ることがある
+    for block in cfg.blocks:
+        for phi in block.phis():
+            if id(phi) not in phi_slots:
+                replace_uses(phi, replace)
+
+
+def remove_dead_phis(cfg: CFG, phis: Dict[int, List[Tuple[object, LLVMCodePhi]]]) -> int:
+    '''
+    使われない phi (他の不要な phi からしか使われないものを含む) を削除し，残った数を返す
+    '''
+    placed = {phi.retval.val: phi for found in phis.values() for _, phi in found}
+    users  = {r: 0 for r in placed}
+    for code in cfg.instructions():
+        for value in used_values(code):
+            r = register_of(value)
+            # phi 自身への参照は数えない (ループで値が変わらない変数)
+            if r in users and not (code.opcode == Opcode.PHI and code.retval.val == r):
+                users[r] += 1
+
+    work = [phi for r, phi in placed.items() if users[r] == 0]
+    dead = set()
+    while work:
+        phi = work.pop()
+        dead.add(id(phi))
+        for value in phi.values:
+            r = register_of(value)
+            if r in users and r != phi.retval.val:
+                users[r] -= 1
+                if users[r] == 0:
+                    work.append(placed[r])
+
+    if len(dead) > 0:
+        for block in cfg.blocks:
+            if id(block) in phis:
+                block.codes = [c for c in block.codes if id(c) not in dead]
+    return len(placed) - len(dead)
+
+
+def promote(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    mem2reg: 局所変数 (と main の大域変数) を SSA 形式のレジスタと phi に置き換える
+    '''
+    cfg.remove_unreachable()
+    slots = promotable_slots(fn, cfg)
+    if not len(slots) > 0:
+        return False
+
+    phis = place_phis(fn, cfg, slots)
+    rename(cfg, slots, phis)
+    remaining = remove_dead_phis(cfg, phis)
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('mem2reg.summary', f"{fn.name}: {len(slots)}個の変数をレジスタに昇格 (phi {remaining}個)",
+                    function=fn.name, promoted=len(slots), phis=remaining)
+    return True
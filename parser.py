@@ -1,23 +1,46 @@
 # -*- coding: utf-8 -*-
+import argparse
+import hashlib
+import importlib.util
+import os
+import re
 import sys
+from typing import Optional, TextIO
 
 import ply.lex as lex
 import ply.yacc as yacc
 
 import llvmcodes
-from codegen import CodeGenerator
-from decls import Factor, Fundecl
+from cache import FUNCTION_CACHE_DIR, CompileCache
+from cfg import clone_code, register_of
+from codegen import WRITE_BUFFER_SIZE, CodeGenerator
+from decls import Factor
+from fastlexer import FastLexer
+from rdparser import RecursiveDescentParser
 from symtab import Scope, SymbolTable
+from tracing import TRACE_FORMATS, TRACE_OFF, Tracer
 
-optimization = {
+# 選択できる字句解析器・構文解析器
+LEXERS  = ('ply', 'fast')
+ENGINES = ('ply', 'rd')
+
+IDENT_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9]*')
+
+DEFAULT_OPTIMIZATION = {
     "constant_folding": False,
-    "remove_deadcode": False
+    "remove_deadcode": False,
+    "inline": False,
+    "mem2reg": False,
+    "sccp": False,
+    "tail_calls": False,
+    "unroll": False,
+    "gvn": False,
+    "loop_rotation": False,
+    "licm": False,
+    "strength_reduction": False,
+    "while_rotation": False,
 }
 
-symtab = SymbolTable()
-codegen = CodeGenerator(optimization)
-main_fundecl = Fundecl(name='main', optimize_deadcode=optimization["remove_deadcode"])
-
 
 # トークンの定義
 tokens = (
@@ -96,6 +119,8 @@ def t_error(t):
     print("不正な文字", t.value[0])
     t.lexer.skip(1)
 
+
+
 #################################################################
 # NOTE: 構文規則
 #################################################################
@@ -105,7 +130,7 @@ def p_program(p):
     '''
     program : PROGRAM IDENT SEMICOLON outblock finalize_function PERIOD
     '''
-    codegen.export("result.ll", verbose=True)
+    p.parser.compiler.program()
 
 
 def p_outblock(p):
@@ -119,10 +144,7 @@ def p_var_decl_part(p):
     var_decl_part : var_decl_list SEMICOLON
                   |
     '''
-    if codegen.current_function.is_func:
-        var = Factor(Scope.LOCAL, name=codegen.current_function.name, val=codegen.register())
-        symtab.insert(var.name, scope=Scope.LOCAL, register=var.val)
-        codegen.push_code(llvmcodes.LLVMCodeAlloca(var))
+    p.parser.compiler.var_decl_part()
 
 
 def p_var_decl_list(p):
@@ -136,13 +158,7 @@ def p_var_decl(p):
     '''
     var_decl : VAR id_list
     '''
-    for var in codegen.pop_all_factor():
-        if var.scope == Scope.GLOBAL:
-            symtab.insert(var.name, scope=Scope.GLOBAL, size=var.size, ptr_offset=var.ptr_offset)
-            codegen.push_code(llvmcodes.LLVMCodeGlobal(var), func_idx=0)
-        if var.scope == Scope.LOCAL:
-            symtab.insert(var.name, scope=Scope.LOCAL, register=var.val, size=var.size, ptr_offset=var.ptr_offset)
-            codegen.push_code(llvmcodes.LLVMCodeAlloca(var))
+    p.parser.compiler.var_decl()
 
 def p_subprog_decl_part(p):
     '''
@@ -196,12 +212,12 @@ def p_func_name(p):
     '''
     func_name : IDENT link_proc
     '''
-    codegen.current_function.is_func = True
+    p.parser.compiler.func_name()
 
 def p_args(p):
     '''
     args : LPAREN enter_block id_list link_args RPAREN
-         | 
+         |
     '''
 
 
@@ -221,7 +237,7 @@ def p_statement_list(p):
     statement_list : statement_list SEMICOLON statement
                    | statement
     '''
-    codegen.clear_factorstack()
+    p.parser.compiler.statement_list()
 
 def p_statement(p):
     '''
@@ -242,17 +258,7 @@ def p_assignment_statement(p):
     assignment_statement : IDENT ASSIGN expression
                          | IDENT LBRACKET expression RBRACKET ASSIGN expression
     '''
-    ident = p[1]
-
-    if len(p) == 4:
-        arg1 = codegen.pop_factor()
-        arg2 = parse_variable(ident)
-    else:
-        arg1  = codegen.pop_factor()
-        index = codegen.pop_factor()
-        arg2  = parse_variable(ident, index)
-
-    codegen.push_code(llvmcodes.LLVMCodeStore(arg1, arg2))
+    p.parser.compiler.assignment_statement(p[1], indexed=len(p) != 4)
 
 
 def p_if_statement(p):
@@ -291,11 +297,7 @@ def p_proc_call_name(p):
     '''
     proc_call_name : IDENT
     '''
-    ident  = p[1]
-    symbol = symtab.lookup(ident, [Scope.FUNC])
-    arg    = Factor(symbol.scope, name=ident)
-    
-    codegen.push_factor(arg)
+    p.parser.compiler.proc_call_name(p[1])
 
 def p_block_statement(p):
     '''
@@ -307,30 +309,13 @@ def p_read_statement(p):
     '''
     read_statement : READ LPAREN var_name RPAREN
     '''
-    val = codegen.pop_factor()
-
-    # read_value_addr: i32* read で読み取った内容を持つアメモリ番地
-    read_value_addr = Factor(Scope.LOCAL, val=codegen.register())
-    retval          = Factor(Scope.LOCAL, val=codegen.register())
-    read_value      = Factor(Scope.LOCAL, val=codegen.register())
-    # read -> read_value_addr -> read_value
-    codegen.push_code(llvmcodes.LLVMCodeAlloca(read_value_addr))
-    codegen.push_code(llvmcodes.LLVMCodeRead(read_value_addr, retval))
-    codegen.push_code(llvmcodes.LLVMCodeLoad(read_value, read_value_addr))
-    codegen.push_code(llvmcodes.LLVMCodeStore(read_value, val))
-    
-    codegen.enable_read()
+    p.parser.compiler.read_statement()
 
 def p_write_statement(p):
     '''
     write_statement : WRITE LPAREN expression RPAREN
     '''
-
-    arg    = codegen.pop_factor()
-    retval = Factor(Scope.LOCAL, val=codegen.register())
-
-    codegen.push_code(llvmcodes.LLVMCodeWrite(arg, retval))
-    codegen.enable_write()
+    p.parser.compiler.write_statement()
 
 
 def p_null_statement(p):
@@ -348,13 +333,7 @@ def p_condition(p):
               | expression GT expression
               | expression GE expression
     '''
-    arg2   = codegen.pop_factor()
-    arg1   = codegen.pop_factor()
-    retval = Factor(Scope.LOCAL, val=codegen.register())
-    ope    = llvmcodes.CmpType.from_str(p[2])
-
-    codegen.push_code(llvmcodes.LLVMCodeIcmp(ope, arg1, arg2, retval))
-    codegen.push_factor(retval)
+    p.parser.compiler.condition(p[2])
 
 
 def p_expression(p):
@@ -366,35 +345,13 @@ def p_expression(p):
                | expression MINUS term
     '''
 
-    if len(p) < 3: 
+    if len(p) < 3:
         return
 
     if len(p) == 3:
-        arg2 = codegen.pop_factor()
-        arg1 = Factor(Scope.CONSTANT, val=0)
+        p.parser.compiler.expression(p[1], unary=True)
     else:
-        arg2 = codegen.pop_factor()
-        arg1 = codegen.pop_factor()
-
-    operator = p[2]
-    assert operator == '+' or operator == '-'
-
-    # 定数伝搬
-    if optimization['constant_folding'] and \
-        arg1.scope == Scope.CONSTANT and arg2.scope == Scope.CONSTANT:
-
-        val = arg1.val + arg2.val \
-            if operator == '+' else arg1.val - arg2.val
-        codegen.push_factor(Factor(Scope.CONSTANT, val=val))
-        return
-
-    LLVMCodeClass = llvmcodes.LLVMCodeAdd \
-        if operator == '+' else llvmcodes.LLVMCodeSub
-
-    retval = Factor(Scope.LOCAL, val=codegen.register())
-
-    codegen.push_code(LLVMCodeClass(arg1, arg2, retval))
-    codegen.push_factor(retval)
+        p.parser.compiler.expression(p[2])
 
 
 def p_term(p):
@@ -406,27 +363,7 @@ def p_term(p):
     if len(p) < 3:
         return
 
-    arg2 = codegen.pop_factor()
-    arg1 = codegen.pop_factor()
-    retval = Factor(Scope.LOCAL, val=codegen.register())
-
-    operator = p[2]
-    assert operator == '*' or operator == 'div'
-
-        # 定数伝搬
-    if optimization['constant_folding'] and \
-        arg1.scope == Scope.CONSTANT and arg2.scope == Scope.CONSTANT:
-
-        val = arg1.val * arg2.val \
-            if operator == '*' else arg1.val / arg2.val
-        codegen.push_factor(Factor(Scope.CONSTANT, val=val))
-        return
-
-    LLVMCodeClass = llvmcodes.LLVMCodeMul \
-        if p[2] == '*' else llvmcodes.LLVMCodeDiv
-
-    codegen.push_code(LLVMCodeClass(arg1, arg2, retval))
-    codegen.push_factor(retval)
+    p.parser.compiler.term(p[2])
 
 
 def p_factor(p):
@@ -438,18 +375,14 @@ def p_factor(p):
     '''
     if len(p) != 2:
         return
-    
+
     # NUMBER
     if p[1] is not None:
-        val = Factor(Scope.CONSTANT, val=p[1])
-        codegen.push_factor(val)
+        p.parser.compiler.factor_number(p[1])
 
     # var_name
     else:
-        var = codegen.pop_factor()
-        retval = Factor(Scope.LOCAL, val=codegen.register())
-        codegen.push_code(llvmcodes.LLVMCodeLoad(retval, var))
-        codegen.push_factor(retval)
+        p.parser.compiler.factor_variable()
 
 
 def p_var_name(p):
@@ -457,13 +390,7 @@ def p_var_name(p):
     var_name : IDENT
              | IDENT LBRACKET expression RBRACKET
     '''
-    ident = p[1]
-
-    if len(p) > 2:
-        index = codegen.pop_factor()
-        codegen.push_factor(parse_variable(ident, index))
-    else:
-        codegen.push_factor(parse_variable(ident))
+    p.parser.compiler.var_name(p[1], indexed=len(p) > 2)
 
 
 def p_arg_list(p):
@@ -487,99 +414,53 @@ def p_link_proc(p):
     '''
     link_proc :
     '''
-    symtab.insert(latest_id_name(p), 'proc')
-    codegen.add_function(latest_id_name(p))
+    p.parser.compiler.link_proc(latest_id_name(p))
 
 def p_enter_block(p):
     '''
     enter_block :
     '''
-    symtab.increase_depth()
+    p.parser.compiler.enter_block()
 
 def p_leave_block(p):
     '''
     leave_block :
     '''
-    symtab.decrease_depth()
+    p.parser.compiler.leave_block()
 
 def p_link_id(p):
     '''
     link_id :
             | LBRACKET NUMBER INTERVAL NUMBER RBRACKET
-    '''    
-    ident      = latest_id_name(p)
-    scope      = symtab.scope()
-    size       = 0
-    ptr_offset = 0
-
+    '''
     if len(p) == 6:
-        i_from     = p[2]
-        i_to       = p[4]
-        size       = i_to - i_from + 1
-        ptr_offset = i_from
-
-    assert scope == Scope.GLOBAL or scope == Scope.LOCAL
-
-    if scope == Scope.GLOBAL:
-        val = Factor(scope, name=ident, size=size, ptr_offset=ptr_offset)
-
-    if scope == Scope.LOCAL:
-        val = Factor(scope, name=ident, val=codegen.register(), size=size, ptr_offset=ptr_offset)
-
-    codegen.push_factor(val)
+        p.parser.compiler.link_id(latest_id_name(p), p[2], p[4])
+    else:
+        p.parser.compiler.link_id(latest_id_name(p))
 
 def p_link_args(p):
     '''
     link_args :
     '''
-    args = codegen.pop_all_factor()
-    codegen.current_function.args_cnt = len(args)
-    
-    for arg in args:
-        arg_var = Factor(scope=Scope.LOCAL, val=codegen.register())
-        symtab.insert(arg.name, scope=Scope.LOCAL, register=arg_var.val)
-        codegen.push_code(llvmcodes.LLVMCodeAlloca(arg_var))
-        codegen.push_code(llvmcodes.LLVMCodeStore(arg.replace(val=arg.val - 1), arg_var))
-        
-    # 記号表の関数の引数の数を更新する
-    func = symtab.lookup(codegen.current_function.name, [Scope.FUNC])
-    symtab.update_args_cnt(func, cnt=len(args))
+    p.parser.compiler.link_args()
 
 def p_unlink_current_function(p):
     '''
     unlink_current_function :
     '''
-    codegen.functions.pop()
+    p.parser.compiler.unlink_current_function()
 
 def p_remove_local_var(p):
     '''
     remove_local_var :
     '''
-    symtab.remove_local_var()
+    p.parser.compiler.remove_local_var()
 
 def p_proc_call(p):
     '''
     proc_call :
     '''
-
-    factors    = codegen.pop_all_factor()
-    found_func = [i for i, f in enumerate(factors) if f.scope == Scope.FUNC]
-    if not len(found_func) > 0:
-        raise RuntimeError("呼び出された関数が見つかりませんでした")
-    func_index = found_func[0]
-
-    # 関係ない部分は戻す
-    for f in factors[:func_index]:
-        codegen.push_factor(f)
-
-    func   = factors[func_index]
-    args   = factors[func_index + 1:]
-    retval = Factor(Scope.LOCAL, val=codegen.register())
-
-    # 引数に対応した関数があるかチェック
-    symtab.lookup(func.name, [Scope.FUNC], args_cnt = len(args))
-    codegen.push_code(llvmcodes.LLVMCodeCallProc(func, args, retval))
-    codegen.push_factor(retval)
+    p.parser.compiler.proc_call()
 
 #################################################################
 # NOTE: コード生成用
@@ -590,20 +471,13 @@ def p_link_main_function(p):
     '''
     link_main_function :
     '''
-    codegen.add_function("main")
+    p.parser.compiler.link_main_function()
 
 def p_finalize_function(p):
     '''
     finalize_function :
     '''
-    if not codegen.current_function.is_func:
-        codegen.push_code(llvmcodes.LLVMCodeProcReturn())
-    else:
-        var    = parse_variable(codegen.current_function.name)
-        retval = Factor(Scope.LOCAL, val=codegen.register())
-
-        codegen.push_code(llvmcodes.LLVMCodeLoad(retval, var))
-        codegen.push_code(llvmcodes.LLVMCodeProcReturn(retval))
+    p.parser.compiler.finalize_function()
 
 # NOTE: WHILE
 
@@ -611,34 +485,19 @@ def p_while_init(p):
     '''
     while_init :
     '''
-    label_index = codegen.label_index()
-    l_init      = Factor(Scope.LOCAL, val=f"while.init.{label_index}")
-    
-    codegen.push_code(llvmcodes.LLVMCodeBrUncond(l_init))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"while.init.{label_index}"))
+    p.parser.compiler.while_init()
 
 def p_while_condition(p):
     '''
     while_condition :
     '''
-    label_index = codegen.pop_label_stack(keep=True)
-    cond        = codegen.pop_factor()
-
-    l1 = Factor(Scope.LOCAL, val=f"while.body.{label_index}")
-    l2 = Factor(Scope.LOCAL, val=f"while.end.{label_index}")
-
-    codegen.push_code(llvmcodes.LLVMCodeBrCond(cond, l1, l2))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"while.body.{label_index}"))
+    p.parser.compiler.while_condition()
 
 def p_while_end(p):
     '''
     while_end :
     '''
-    label_index = codegen.pop_label_stack()
-    l1          = Factor(Scope.LOCAL, val=f"while.init.{label_index}")
-    
-    codegen.push_code(llvmcodes.LLVMCodeBrUncond(l1))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"while.end.{label_index}"))
+    p.parser.compiler.while_end()
 
 # NOTE: IF - ELSE
 
@@ -646,90 +505,33 @@ def p_if_condition(p):
     '''
     if_condition :
     '''
-    label_index = codegen.label_index()
-    cond        = codegen.pop_factor()
-    
-    l1 = Factor(Scope.LOCAL, val=f"if.true.{label_index}")
-    l2 = Factor(Scope.LOCAL, val=f"if.else.{label_index}")
-    
-    codegen.push_code(llvmcodes.LLVMCodeBrCond(cond, l1, l2))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"if.true.{label_index}"))
+    p.parser.compiler.if_condition()
 
 def p_if_else(p):
     '''
     if_else :
     '''
-    label_index = codegen.pop_label_stack(keep=True)
-    l1          = Factor(Scope.LOCAL, val=f"if.end.{label_index}")
-    
-    codegen.push_code(llvmcodes.LLVMCodeBrUncond(l1))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"if.else.{label_index}"))
+    p.parser.compiler.if_else()
 
 def p_if_end(p):
     '''
     if_end :
     '''
-    label_index = codegen.pop_label_stack()
-    l1          = Factor(Scope.LOCAL, val=f"if.end.{label_index}")
-    
-    codegen.push_code(llvmcodes.LLVMCodeBrUncond(l1))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"if.end.{label_index}"))
+    p.parser.compiler.if_end()
 
-# NOTE: FOR 
+# NOTE: FOR
 
 def p_for_init(p):
     '''
     for_init :
     '''
-
-    # for n:= 2 to 100
-    # ↓
-    # for ident := range_from to range_to
-
-    ident       = latest_id_name(p)
-    range_to    = codegen.pop_factor()
-    range_from  = codegen.pop_factor()
-    var         = parse_variable(ident)
-    label_index = codegen.label_index()
-
-    # n := 2
-    codegen.push_code(llvmcodes.LLVMCodeStore(range_from, var))
-    # 初期化時は無条件で statement に移動
-    l_body = Factor(Scope.LOCAL, val=f"for.body.{label_index}")
-    codegen.push_code(llvmcodes.LLVMCodeBrUncond(l_body))
-    # statement が終わったあとに戻ってくる for.condition のポイントを作成
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"for.condition.{label_index}"))
-
-    # n++ 
-    ## n をレジスタに読み込み
-    reg_ident = Factor(Scope.LOCAL, val=codegen.register())
-    codegen.push_code(llvmcodes.LLVMCodeLoad(reg_ident, var))
-    ## n + 1
-    one = Factor(Scope.CONSTANT, val=1)
-    reg_ident_increased = Factor(Scope.LOCAL, val=codegen.register())
-    codegen.push_code(llvmcodes.LLVMCodeAdd(reg_ident, one, reg_ident_increased))
-    ## レジスタの内容を n に戻す
-    codegen.push_code(llvmcodes.LLVMCodeStore(reg_ident_increased, var))
-
-    # n が range_from に到達したかのチェック
-    ## n <= range_to
-    cond = Factor(Scope.LOCAL, val=codegen.register())
-    codegen.push_code(llvmcodes.LLVMCodeIcmp(llvmcodes.CmpType.SLE, reg_ident_increased, range_to, cond))
-    l_end = Factor(Scope.LOCAL, val=f"for.end.{label_index}")
-    
-    codegen.push_code(llvmcodes.LLVMCodeBrCond(cond, l_body, l_end))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"for.body.{label_index}"))
+    p.parser.compiler.for_init(latest_id_name(p))
 
 def p_for_end(p):
     '''
     for_end :
     '''
-    # statement 終了後は強制的に for.condition に戻して n < range_to を評価する
-    label_index = codegen.pop_label_stack()
-    l_cond      = Factor(Scope.LOCAL, val=f"for.condition.{label_index}")
-    
-    codegen.push_code(llvmcodes.LLVMCodeBrUncond(l_cond))
-    codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"for.end.{label_index}"))
+    p.parser.compiler.for_end()
 
 
 #################################################################
@@ -743,30 +545,6 @@ def latest_id_name(p):
         raise RuntimeError('IDENTが見つかりませんでした')
     return ids[-1].value
 
-def _parse_variable(v):
-    symbol = symtab.lookup(v)
-    scope  = symbol.scope
-
-    if scope == Scope.GLOBAL:
-        return Factor(scope, name=v, size=symbol.size, ptr_offset=symbol.ptr_offset)
-    if scope == Scope.LOCAL:
-        return Factor(scope, val=symbol.register, size=symbol.size, ptr_offset=symbol.ptr_offset)
-    
-    raise ValueError()
-
-def parse_variable(v, index=None):
-    var = _parse_variable(v)
-    if index is not None:
-        symbol    = symtab.lookup(v)
-        index_var = Factor(Scope.LOCAL, val=codegen.register())
-        retval    = Factor(Scope.LOCAL, val=codegen.register())
-        
-        codegen.push_code(llvmcodes.LLVMCodeSub(index, Factor(Scope.CONSTANT, val=symbol.ptr_offset), index_var))
-        codegen.push_code(llvmcodes.LLVMCodeGetPointer(retval, var, index_var, symbol.size))
-        return retval
-    else:
-        return var
-
 
 #################################################################
 # NOTE: 構文解析エラー時の処理
@@ -777,18 +555,711 @@ def p_error(p):
         print(f'{p.lineno} 行目: 構文エラー 予期しない文字 "{p.value}" (type: {p.type})')
 
 
+#################################################################
+# NOTE: 字句解析器・構文解析器の構築
+#################################################################
+
+# 生成した字句解析表・構文解析表を置くディレクトリ
+TABLE_DIR     = os.path.dirname(os.path.abspath(__file__))
+LEXTAB_NAME   = 'plx_lextab'
+PARSETAB_NAME = 'plx_parsetab'
+
+_lexer  = None
+_parser = None
+
+
+def grammar_signature() -> str:
+    '''
+    トークン・字句規則・構文規則から求めたハッシュ値．
+    生成済みの表のモジュール名に含めることで，文法を変更したときに古い表を読み込まないようにする．
+    '''
+    g     = globals()
+    rules = [v for k, v in g.items() if callable(v) and (k.startswith('t_') or k.startswith('p_'))]
+    rules.sort(key=lambda f: f.__code__.co_firstlineno)
+
+    parts = [lex.__version__, yacc.__tabversion__, repr(tokens), repr(sorted(reserved.items()))]
+    parts += [f"{k}={v}" for k, v in sorted(g.items()) if k.startswith('t_') and isinstance(v, str)]
+    parts += [f"{f.__name__}:{f.__doc__}" for f in rules]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def _load_table(name: str):
+    '''
+    生成済みの表をファイルから直接読み込む．存在しない・壊れている場合は None を返す．
+    '''
+    path = os.path.join(TABLE_DIR, f"{name}.py")
+    if not os.path.exists(path):
+        return None
+    try:
+        spec   = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    except Exception:
+        # 書き込み途中などで壊れている表は作り直す
+        os.remove(path)
+        return None
+
+
+def _remove_stale_tables(signature: str):
+    current = [f"{prefix}_{signature}.py" for prefix in [LEXTAB_NAME, PARSETAB_NAME]]
+    for filename in os.listdir(TABLE_DIR):
+        is_table = filename.startswith(LEXTAB_NAME) or filename.startswith(PARSETAB_NAME)
+        if is_table and filename.endswith('.py') and filename not in current:
+            try:
+                os.remove(os.path.join(TABLE_DIR, filename))
+            except OSError:
+                pass
+
+
+def get_lexer():
+    global _lexer
+    if _lexer is None:
+        signature = grammar_signature()
+        name      = f"{LEXTAB_NAME}_{signature}"
+        lextab    = _load_table(name)
+        if lextab is None:
+            _remove_stale_tables(signature)
+        # 字句解析器
+        _lexer = lex.lex(debug=0, optimize=1, lextab=lextab or name, outputdir=TABLE_DIR)
+    return _lexer
+
+
+def get_parser():
+    global _parser
+    if _parser is None:
+        signature = grammar_signature()
+        name      = f"{PARSETAB_NAME}_{signature}"
+        parsetab  = _load_table(name)
+        if parsetab is None:
+            _remove_stale_tables(signature)
+        # 構文解析器
+        _parser = yacc.yacc(debug=False, optimize=True, write_tables=True,
+                            tabmodule=parsetab or name, outputdir=TABLE_DIR)
+    return _parser
+
+
+def build_tables():
+    '''
+    字句解析器と構文解析器を作り直す．表が古い・存在しない場合はここで生成される．
+    '''
+    global _lexer, _parser
+    _lexer  = None
+    _parser = None
+    return get_lexer(), get_parser()
+
+
+#################################################################
+# NOTE: コンパイラ本体
+#################################################################
+
+
+class Compiler(object):
+    '''
+    PL-X のソースコードを LLVM IR に変換する．
+    記号表・コード生成器・最適化オプションをインスタンスごとに持つため，
+    1 つのプロセスの中で何度でもコンパイルできる．
+    構文規則の各アクションはこのクラスのメソッドを呼び出す．
+    '''
+
+    def __init__(self, optimization: Optional[dict] = None, lexer: str = 'ply', engine: str = 'ply',
+                 tracer: Optional[Tracer] = None, function_cache: Optional[CompileCache] = None):
+        super().__init__()
+        if lexer not in LEXERS:
+            raise ValueError(f'KeyError: {lexer}')
+        if engine not in ENGINES:
+            raise ValueError(f'KeyError: {engine}')
+        self.optimization = dict(DEFAULT_OPTIMIZATION)
+        self.optimization.update(optimization or {})
+        self.lexer        = lexer
+        self.engine       = engine
+        self.tracer       = tracer or Tracer()
+        # 関数ごとの LLVM IR のキャッシュ (None のときは使わない)
+        self.function_cache = function_cache
+        self.reset()
+
+    def reset(self, stream: Optional[TextIO] = None):
+        self.symtab  = SymbolTable(self.tracer)
+        self.codegen = CodeGenerator(self.optimization, self.tracer, self.function_cache, stream)
+        self.output  = None
+        # 関数ごとのキャッシュ用: ソースコードと，直前の関数の終わりの位置
+        self.source     = ''
+        self.span_start = 0
+        self.scanner    = None
+
+    def compile(self, data: str) -> str:
+        self.reset()
+        self.parse(data)
+        return self.output
+
+    def compile_to(self, data: str, stream: TextIO):
+        '''
+        data をコンパイルし，関数が完成するたびに stream に書き出す．
+        メモリには書き出し中の関数 1 つ分の命令しか残らない．
+        printf / scanf の宣言はモジュールの末尾に置くため，compile() と出力の順番が少し異なる．
+        '''
+        self.reset(stream)
+        self.parse(data)
+
+    def parse(self, data: str):
+        self.source = data
+
+        if self.lexer == 'fast':
+            lexer = FastLexer(reserved)
+        else:
+            lexer = get_lexer().clone()
+            lexer.lineno = 1
+        self.scanner = lexer
+
+        if self.engine == 'rd':
+            RecursiveDescentParser(self, lexer).parse(data)
+        else:
+            parser = get_parser()
+            parser.compiler = self
+            try:
+                parser.parse(data, lexer=lexer)
+            finally:
+                parser.compiler = None
+
+        if self.output is None:
+            raise RuntimeError('構文エラー: プログラムを最後まで解析できませんでした')
+
+    # NOTE: 宣言・文
+
+    def program(self):
+        if self.codegen.stream is not None:
+            self.codegen.finish()
+            self.output = ''
+        else:
+            self.output = self.codegen.to_string()
+
+    def var_decl_part(self):
+        codegen, symtab = self.codegen, self.symtab
+        if codegen.current_function.is_func:
+            var = Factor(Scope.LOCAL, name=codegen.current_function.name, val=codegen.register())
+            symtab.insert(var.name, scope=Scope.LOCAL, register=var.val)
+            codegen.push_code(llvmcodes.LLVMCodeAlloca(var))
+
+    def var_decl(self):
+        codegen, symtab = self.codegen, self.symtab
+        for var in codegen.pop_all_factor():
+            if var.scope == Scope.GLOBAL:
+                symtab.insert(var.name, scope=Scope.GLOBAL, size=var.size, ptr_offset=var.ptr_offset)
+                codegen.push_code(llvmcodes.LLVMCodeGlobal(var), func_idx=0)
+            if var.scope == Scope.LOCAL:
+                symtab.insert(var.name, scope=Scope.LOCAL, register=var.val, size=var.size, ptr_offset=var.ptr_offset)
+                codegen.push_code(llvmcodes.LLVMCodeAlloca(var))
+
+    def func_name(self):
+        self.codegen.current_function.is_func = True
+
+    def statement_list(self):
+        self.codegen.clear_factorstack()
+
+    def assignment_statement(self, ident: str, indexed=False):
+        codegen = self.codegen
+
+        if not indexed:
+            arg1 = codegen.pop_factor()
+            arg2 = self.parse_variable(ident)
+        else:
+            arg1  = codegen.pop_factor()
+            index = codegen.pop_factor()
+            arg2  = self.parse_variable(ident, index)
+
+        codegen.push_code(llvmcodes.LLVMCodeStore(arg1, arg2))
+
+    def proc_call_name(self, ident: str):
+        symbol = self.symtab.lookup(ident, [Scope.FUNC])
+        arg    = Factor(symbol.scope, name=ident)
+
+        self.codegen.push_factor(arg)
+
+    def read_statement(self):
+        codegen = self.codegen
+        val     = codegen.pop_factor()
+
+        # read_value_addr: i32* read で読み取った内容を持つアメモリ番地
+        read_value_addr = Factor(Scope.LOCAL, val=codegen.register())
+        retval          = Factor(Scope.LOCAL, val=codegen.register())
+        read_value      = Factor(Scope.LOCAL, val=codegen.register())
+        # read -> read_value_addr -> read_value
+        codegen.push_code(llvmcodes.LLVMCodeAlloca(read_value_addr))
+        codegen.push_code(llvmcodes.LLVMCodeRead(read_value_addr, retval))
+        codegen.push_code(llvmcodes.LLVMCodeLoad(read_value, read_value_addr))
+        codegen.push_code(llvmcodes.LLVMCodeStore(read_value, val))
+
+        codegen.enable_read()
+
+    def write_statement(self):
+        codegen = self.codegen
+        arg     = codegen.pop_factor()
+        retval  = Factor(Scope.LOCAL, val=codegen.register())
+
+        codegen.push_code(llvmcodes.LLVMCodeWrite(arg, retval))
+        codegen.enable_write()
+
+    # NOTE: 式
+
+    def condition(self, operator: str):
+        codegen = self.codegen
+        arg2    = codegen.pop_factor()
+        arg1    = codegen.pop_factor()
+        retval  = Factor(Scope.LOCAL, val=codegen.register())
+        ope     = llvmcodes.CmpType.from_str(operator)
+
+        codegen.push_code(llvmcodes.LLVMCodeIcmp(ope, arg1, arg2, retval))
+        codegen.push_factor(retval)
+
+    def expression(self, operator: str, unary=False):
+        codegen = self.codegen
+
+        if unary:
+            arg2 = codegen.pop_factor()
+            arg1 = Factor(Scope.CONSTANT, val=0)
+        else:
+            arg2 = codegen.pop_factor()
+            arg1 = codegen.pop_factor()
+
+        assert operator == '+' or operator == '-'
+
+        # 定数伝搬
+        if self.optimization['constant_folding'] and \
+            arg1.scope == Scope.CONSTANT and arg2.scope == Scope.CONSTANT:
+
+            opcode = llvmcodes.Opcode.ADD if operator == '+' else llvmcodes.Opcode.SUB
+            codegen.push_factor(Factor(Scope.CONSTANT, val=llvmcodes.fold_binary(opcode, arg1.val, arg2.val)))
+            return
+
+        LLVMCodeClass = llvmcodes.LLVMCodeAdd \
+            if operator == '+' else llvmcodes.LLVMCodeSub
+
+        retval = Factor(Scope.LOCAL, val=codegen.register())
+
+        codegen.push_code(LLVMCodeClass(arg1, arg2, retval))
+        codegen.push_factor(retval)
+
+    def term(self, operator: str):
+        codegen = self.codegen
+        arg2    = codegen.pop_factor()
+        arg1    = codegen.pop_factor()
+        retval  = Factor(Scope.LOCAL, val=codegen.register())
+
+        assert operator == '*' or operator == 'div'
+
+        # 定数伝搬 (i32 として計算し，div は 0 の方向に切り捨てる．0 除算は実行時まで残す)
+        if self.optimization['constant_folding'] and \
+            arg1.scope == Scope.CONSTANT and arg2.scope == Scope.CONSTANT:
+
+            opcode = llvmcodes.Opcode.MUL if operator == '*' else llvmcodes.Opcode.SDIV
+            val    = llvmcodes.fold_binary(opcode, arg1.val, arg2.val)
+            if val is not None:
+                codegen.push_factor(Factor(Scope.CONSTANT, val=val))
+                return
+
+        LLVMCodeClass = llvmcodes.LLVMCodeMul \
+            if operator == '*' else llvmcodes.LLVMCodeDiv
+
+        codegen.push_code(LLVMCodeClass(arg1, arg2, retval))
+        codegen.push_factor(retval)
+
+    def factor_number(self, value: int):
+        self.codegen.push_factor(Factor(Scope.CONSTANT, val=value))
+
+    def factor_variable(self):
+        codegen = self.codegen
+        var     = codegen.pop_factor()
+        retval  = Factor(Scope.LOCAL, val=codegen.register())
+        codegen.push_code(llvmcodes.LLVMCodeLoad(retval, var))
+        codegen.push_factor(retval)
+
+    def var_name(self, ident: str, indexed=False):
+        codegen = self.codegen
+
+        if indexed:
+            index = codegen.pop_factor()
+            codegen.push_factor(self.parse_variable(ident, index))
+        else:
+            codegen.push_factor(self.parse_variable(ident))
+
+    # NOTE: 記号表
+
+    def link_proc(self, ident: str):
+        self.symtab.insert(ident, 'proc')
+        self.codegen.add_function(ident)
+        self.codegen.current_function.label_base = self.codegen.lbl_cnt
+
+    def enter_block(self):
+        self.symtab.increase_depth()
+
+    def leave_block(self):
+        self.symtab.decrease_depth()
+
+    def link_id(self, ident: str, i_from: Optional[int] = None, i_to: Optional[int] = None):
+        codegen    = self.codegen
+        scope      = self.symtab.scope()
+        size       = 0
+        ptr_offset = 0
+
+        if i_from is not None:
+            size       = i_to - i_from + 1
+            ptr_offset = i_from
+
+        assert scope == Scope.GLOBAL or scope == Scope.LOCAL
+
+        if scope == Scope.GLOBAL:
+            val = Factor(scope, name=ident, size=size, ptr_offset=ptr_offset)
+
+        if scope == Scope.LOCAL:
+            val = Factor(scope, name=ident, val=codegen.register(), size=size, ptr_offset=ptr_offset)
+
+        codegen.push_factor(val)
+
+    def link_args(self):
+        codegen, symtab = self.codegen, self.symtab
+        args = codegen.pop_all_factor()
+        codegen.current_function.args_cnt = len(args)
+
+        for arg in args:
+            arg_var = Factor(scope=Scope.LOCAL, val=codegen.register())
+            symtab.insert(arg.name, scope=Scope.LOCAL, register=arg_var.val)
+            codegen.push_code(llvmcodes.LLVMCodeAlloca(arg_var))
+            codegen.push_code(llvmcodes.LLVMCodeStore(arg.replace(val=arg.val - 1), arg_var))
+
+        # 記号表の関数の引数の数を更新する
+        func = symtab.lookup(codegen.current_function.name, [Scope.FUNC])
+        symtab.update_args_cnt(func, cnt=len(args))
+
+    def unlink_current_function(self):
+        self.codegen.functions.pop()
+
+    def remove_local_var(self):
+        self.symtab.remove_local_var()
+
+    def proc_call(self):
+        codegen    = self.codegen
+        factors    = codegen.pop_all_factor()
+        found_func = [i for i, f in enumerate(factors) if f.scope == Scope.FUNC]
+        if not len(found_func) > 0:
+            raise RuntimeError("呼び出された関数が見つかりませんでした")
+        func_index = found_func[0]
+
+        # 関係ない部分は戻す
+        for f in factors[:func_index]:
+            codegen.push_factor(f)
+
+        func   = factors[func_index]
+        args   = factors[func_index + 1:]
+        retval = Factor(Scope.LOCAL, val=codegen.register())
+
+        # 引数に対応した関数があるかチェック
+        self.symtab.lookup(func.name, [Scope.FUNC], args_cnt = len(args))
+        codegen.push_code(llvmcodes.LLVMCodeCallProc(func, args, retval))
+        codegen.push_factor(retval)
+
+    # NOTE: コード生成
+
+    def link_main_function(self):
+        self.codegen.add_function("main")
+        self.codegen.current_function.label_base = self.codegen.lbl_cnt
+
+    def finalize_function(self):
+        codegen = self.codegen
+        if not codegen.current_function.is_func:
+            codegen.push_code(llvmcodes.LLVMCodeProcReturn())
+        else:
+            var    = self.parse_variable(codegen.current_function.name)
+            retval = Factor(Scope.LOCAL, val=codegen.register())
+
+            codegen.push_code(llvmcodes.LLVMCodeLoad(retval, var))
+            codegen.push_code(llvmcodes.LLVMCodeProcReturn(retval))
+
+        if self.function_cache is not None:
+            codegen.current_function.fingerprint = self.function_fingerprint()
+        codegen.flush_function()
+
+    def function_fingerprint(self) -> str:
+        '''
+        関数の LLVM IR を決める情報を 1 つの文字列にまとめる．
+        直前の関数の終わりからこの関数の終わりまでのソースコード，関数の名前・引数の数，
+        ソースコードに現れる名前から見える記号 (大域変数の大きさ・呼び出す関数の引数の数など) を含む．
+        ラベル番号は含めない (キャッシュにはずらした番号で保存する)．
+        '''
+        fn   = self.codegen.current_function
+        end  = self.scanner.lexpos
+        span = self.source[self.span_start:end]
+        self.span_start = end
+
+        names = sorted(set(IDENT_RE.findall(span)) - reserved.keys())
+        lines = [f"{fn.name}({fn.args_cnt}) is_func={fn.is_func}", span]
+        lines += [f"{name}: {self.symtab.signature(name)}" for name in names]
+        return '\n'.join(lines)
+
+    # NOTE: WHILE
+
+    def while_init(self):
+        codegen     = self.codegen
+        label_index = codegen.label_index()
+        l_init      = Factor(Scope.LOCAL, val=f"while.init.{label_index}")
+
+        codegen.push_code(llvmcodes.LLVMCodeBrUncond(l_init))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"while.init.{label_index}"))
+        if self.optimization['while_rotation']:
+            codegen.loop_stack.append(len(codegen.current_function.codes))
+
+    def while_condition(self):
+        codegen     = self.codegen
+        label_index = codegen.pop_label_stack(keep=True)
+        cond        = codegen.pop_factor()
+
+        l1 = Factor(Scope.LOCAL, val=f"while.body.{label_index}")
+        l2 = Factor(Scope.LOCAL, val=f"while.end.{label_index}")
+
+        if self.optimization['while_rotation']:
+            # 条件式の命令を覚えておき，while_end で本体の後ろに複製する
+            start = codegen.loop_stack.pop()
+            codegen.loop_stack.append((codegen.current_function.codes[start:], cond))
+        codegen.push_code(llvmcodes.LLVMCodeBrCond(cond, l1, l2))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"while.body.{label_index}"))
+
+    def while_end(self):
+        codegen     = self.codegen
+        label_index = codegen.pop_label_stack()
+        l1          = Factor(Scope.LOCAL, val=f"while.init.{label_index}")
+
+        if self.optimization['while_rotation']:
+            # while.init は最初の 1 回だけ条件を調べ，2 回目からは本体の末尾で調べて本体に戻る (1 回の br i1 だけになる)
+            codes, cond = codegen.loop_stack.pop()
+            replace     = {}
+            for code in codes:
+                codegen.push_code(clone_code(code, replace, codegen.register))
+            l_body = Factor(Scope.LOCAL, val=f"while.body.{label_index}")
+            l_end  = Factor(Scope.LOCAL, val=f"while.end.{label_index}")
+            codegen.push_code(llvmcodes.LLVMCodeBrCond(replace.get(register_of(cond), cond), l_body, l_end))
+        else:
+            codegen.push_code(llvmcodes.LLVMCodeBrUncond(l1))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"while.end.{label_index}"))
+
+    # NOTE: IF - ELSE
+
+    def if_condition(self):
+        codegen     = self.codegen
+        label_index = codegen.label_index()
+        cond        = codegen.pop_factor()
+
+        l1 = Factor(Scope.LOCAL, val=f"if.true.{label_index}")
+        l2 = Factor(Scope.LOCAL, val=f"if.else.{label_index}")
+
+        codegen.push_code(llvmcodes.LLVMCodeBrCond(cond, l1, l2))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"if.true.{label_index}"))
+
+    def if_else(self):
+        codegen     = self.codegen
+        label_index = codegen.pop_label_stack(keep=True)
+        l1          = Factor(Scope.LOCAL, val=f"if.end.{label_index}")
+
+        codegen.push_code(llvmcodes.LLVMCodeBrUncond(l1))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"if.else.{label_index}"))
+
+    def if_end(self):
+        codegen     = self.codegen
+        label_index = codegen.pop_label_stack()
+        l1          = Factor(Scope.LOCAL, val=f"if.end.{label_index}")
+
+        codegen.push_code(llvmcodes.LLVMCodeBrUncond(l1))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"if.end.{label_index}"))
+
+    # NOTE: FOR
+
+    def for_init(self, ident: str):
+        codegen = self.codegen
+
+        # for n:= 2 to 100
+        # ↓
+        # for ident := range_from to range_to
+
+        range_to    = codegen.pop_factor()
+        range_from  = codegen.pop_factor()
+        var         = self.parse_variable(ident)
+        label_index = codegen.label_index()
+
+        # n := 2
+        codegen.push_code(llvmcodes.LLVMCodeStore(range_from, var))
+        # 初期化時は無条件で statement に移動
+        l_body = Factor(Scope.LOCAL, val=f"for.body.{label_index}")
+        codegen.push_code(llvmcodes.LLVMCodeBrUncond(l_body))
+        # statement が終わったあとに戻ってくる for.condition のポイントを作成
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"for.condition.{label_index}"))
+
+        # n++
+        ## n をレジスタに読み込み
+        reg_ident = Factor(Scope.LOCAL, val=codegen.register())
+        codegen.push_code(llvmcodes.LLVMCodeLoad(reg_ident, var))
+        ## n + 1
+        one = Factor(Scope.CONSTANT, val=1)
+        reg_ident_increased = Factor(Scope.LOCAL, val=codegen.register())
+        codegen.push_code(llvmcodes.LLVMCodeAdd(reg_ident, one, reg_ident_increased))
+        ## レジスタの内容を n に戻す
+        codegen.push_code(llvmcodes.LLVMCodeStore(reg_ident_increased, var))
+
+        # n が range_from に到達したかのチェック
+        ## n <= range_to
+        cond = Factor(Scope.LOCAL, val=codegen.register())
+        codegen.push_code(llvmcodes.LLVMCodeIcmp(llvmcodes.CmpType.SLE, reg_ident_increased, range_to, cond))
+        l_end = Factor(Scope.LOCAL, val=f"for.end.{label_index}")
+
+        codegen.push_code(llvmcodes.LLVMCodeBrCond(cond, l_body, l_end))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"for.body.{label_index}"))
+
+    def for_end(self):
+        codegen = self.codegen
+
+        # statement 終了後は強制的に for.condition に戻して n < range_to を評価する
+        label_index = codegen.pop_label_stack()
+        l_cond      = Factor(Scope.LOCAL, val=f"for.condition.{label_index}")
+
+        codegen.push_code(llvmcodes.LLVMCodeBrUncond(l_cond))
+        codegen.push_code(llvmcodes.LLVMCodeRegisterLabel(f"for.end.{label_index}"))
+
+    # NOTE: 変数
+
+    def _parse_variable(self, v):
+        symbol = self.symtab.lookup(v)
+        scope  = symbol.scope
+
+        if scope == Scope.GLOBAL:
+            return Factor(scope, name=v, size=symbol.size, ptr_offset=symbol.ptr_offset)
+        if scope == Scope.LOCAL:
+            return Factor(scope, val=symbol.register, size=symbol.size, ptr_offset=symbol.ptr_offset)
+
+        raise ValueError()
+
+    def parse_variable(self, v, index=None):
+        codegen = self.codegen
+        var     = self._parse_variable(v)
+        if index is not None:
+            symbol    = self.symtab.lookup(v)
+            index_var = Factor(Scope.LOCAL, val=codegen.register())
+            retval    = Factor(Scope.LOCAL, val=codegen.register())
+
+            codegen.push_code(llvmcodes.LLVMCodeSub(index, Factor(Scope.CONSTANT, val=symbol.ptr_offset), index_var))
+            codegen.push_code(llvmcodes.LLVMCodeGetPointer(retval, var, index_var, symbol.size))
+            return retval
+        else:
+            return var
+
+
+def compile_source(text: str, options: Optional[dict] = None, lexer: str = 'ply', engine: str = 'ply',
+                   tracer: Optional[Tracer] = None, function_cache: Optional[CompileCache] = None) -> str:
+    '''
+    ソースコード text をコンパイルし，LLVM IR を文字列で返す．
+    '''
+    return Compiler(options, lexer=lexer, engine=engine, tracer=tracer, function_cache=function_cache).compile(text)
+
+
 if __name__ == "__main__":
-    lexer = lex.lex(debug=0)  # 字句解析器
-    yacc.yacc()  # 構文解析器
+    argparser = argparse.ArgumentParser(description='PL-X のソースコードを LLVM IR にコンパイルする')
+    argparser.add_argument('source', nargs='?', help='PL-X のソースファイル')
+    argparser.add_argument('-o', '--output', default=None, metavar='PATH',
+                           help='出力先 (- で標準出力)．関数ごとに書き出す．省略時は result.ll に書き出して表示する')
+    argparser.add_argument('--batch', default=None, metavar='DIR|GLOB',
+                           help='ディレクトリ以下の .p ファイル (またはグロブに一致するファイル) をまとめてコンパイルする')
+    argparser.add_argument('-j', '--jobs', type=int, default=None, metavar='N',
+                           help='--batch のワーカープロセス数 (省略時は CPU 数)')
+    argparser.add_argument('--outdir', default=None, metavar='DIR',
+                           help='--batch の出力先 (省略時は各ソースファイルと同じディレクトリ)')
+    argparser.add_argument('-O', '--opt', action='append', choices=list(DEFAULT_OPTIMIZATION), default=[],
+                           metavar='NAME', help=f"有効にする最適化 (複数指定できる): {', '.join(DEFAULT_OPTIMIZATION)}")
+    argparser.add_argument('--unroll-budget', type=int, default=None, metavar='N',
+                           help='-O unroll で展開した後のループの命令数の上限')
+    argparser.add_argument('--lexer', choices=LEXERS, default='ply', help='使用する字句解析器')
+    argparser.add_argument('--engine', choices=ENGINES, default='ply',
+                           help='使用する構文解析器 (ply: LALR, rd: 再帰下降)')
+    argparser.add_argument('--trace', type=int, default=TRACE_OFF, metavar='LEVEL',
+                           help='トレースの詳しさ (0: なし, 1: 要約, 2: 記号表・依存関係の全て)')
+    argparser.add_argument('--trace-file', default=None, metavar='PATH',
+                           help='トレースの出力先 (省略時は標準エラー出力)')
+    argparser.add_argument('--trace-format', choices=TRACE_FORMATS, default='text')
+    argparser.add_argument('--cache-dir', default=None, metavar='DIR',
+                           help='コンパイル結果のキャッシュを置くディレクトリ (省略時はキャッシュしない)')
+    argparser.add_argument('--cache-size', type=int, default=256, metavar='MB',
+                           help='キャッシュの大きさの上限')
+    args = argparser.parse_args()
+
+    optimization = {name: True for name in args.opt}
+    if args.unroll_budget is not None:
+        optimization['unroll_budget'] = args.unroll_budget
+
+    if args.batch is not None:
+        from batch import collect_sources, run_batch
+        result = run_batch(collect_sources(args.batch), args.jobs, optimization=optimization,
+                           lexer=args.lexer, engine=args.engine,
+                           outdir=args.outdir, cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 * 1024)
+        print(result.summary())
+        sys.exit(1 if result.failures else 0)
+    if args.source is None:
+        argparser.error('source か --batch を指定してください')
+
+    tracer = Tracer.open(args.trace, args.trace_file, args.trace_format)
+
+    # トレースは実際にコンパイルしないと出力できないので，そのときはキャッシュを使わない
+    cache          = None
+    function_cache = None
+    if args.cache_dir is not None and not tracer.enabled():
+        cache          = CompileCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        function_cache = CompileCache(os.path.join(args.cache_dir, FUNCTION_CACHE_DIR), args.cache_size * 1024 * 1024)
+
+    compiler = Compiler(optimization, lexer=args.lexer, engine=args.engine, tracer=tracer,
+                        function_cache=function_cache)
 
     # ファイルを開いて
-    data = open(sys.argv[1]).read()
+    data = open(args.source).read()
+
+    if args.output is not None:
+        # -o を指定したときは関数ごとに書き出す (キャッシュを使うときはまとめて書き出す)
+        if args.output == '-':
+            out = sys.stdout
+        else:
+            out = open(args.output, mode='w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+        try:
+            if cache is None:
+                compiler.compile_to(data, out)
+            else:
+                key     = cache.key(data, compiler.optimization)
+                content = cache.get(key)
+                if content is None:
+                    content = compiler.compile(data)
+                    cache.put(key, content)
+                out.write(content + '\n')
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            sys.exit(1)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+            tracer.close()
+        sys.exit(0)
+
     # 解析を実行
-    
+
     try:
-        yacc.parse(data, lexer=lexer)
+        if cache is None:
+            content = compiler.compile(data)
+        else:
+            key     = cache.key(data, compiler.optimization)
+            content = cache.get(key)
+            if content is None:
+                content = compiler.compile(data)
+                cache.put(key, content)
     except Exception as e:
         import traceback
         traceback.print_exc()
         print("\n\n--- log --- \n\n")
-        codegen.export("error.ll", verbose=True)
+        compiler.codegen.export("error.ll", verbose=True)
+    else:
+        with open("result.ll", mode='w', encoding='utf-8') as f:
+            f.write(content)
+        print(content)
+    finally:
+        tracer.close()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import functools
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cfg import CFG
+from dce import eliminate_dead_code
+from decls import Fundecl
+from gvn import number_values
+from indvars import reduce_strength
+from inline import Inliner, inline_calls
+from licm import hoist_loop_invariants
+from mem2reg import promote
+from rotate import rotate_loops
+from sccp import propagate_constants
+from tailcall import eliminate_tail_recursion
+from tracing import TRACE_DEBUG, Tracer
+from unroll import unroll_loops
+
+# 制御フローグラフの上で行う最適化 (最適化オプションの名前, パス) を実行する順に並べたもの．
+# パスは (関数, CFG) を受け取り，命令を書き換えたかどうかを返す．
+PASSES: List[Tuple[str, Callable[[Fundecl, CFG], bool]]] = [
+    ('inline',             inline_calls),
+    ('mem2reg',            promote),
+    ('sccp',               propagate_constants),
+    ('tail_calls',         eliminate_tail_recursion),
+    ('unroll',             unroll_loops),
+    ('gvn',                number_values),
+    ('loop_rotation',      rotate_loops),
+    ('licm',               hoist_loop_invariants),
+    ('strength_reduction', reduce_strength),
+    ('remove_deadcode',    eliminate_dead_code),
+]
+
+# パスにキーワード引数として渡す最適化オプション (パスの名前 -> {オプションの名前: 引数の名前})
+PASS_PARAMETERS: Dict[str, Dict[str, str]] = {
+    'unroll': {'unroll_budget': 'budget'},
+}
+
+
+class Pipeline(object):
+    '''
+    有効なパスを順に実行する．関数の命令列を CFG にして渡し，最後に命令列に戻す．
+    '''
+
+    def __init__(self, passes: List[Tuple[str, Callable[[Fundecl, CFG], bool]]], tracer: Optional[Tracer] = None,
+                 inliner: Optional[Inliner] = None):
+        super().__init__()
+        self.passes  = passes
+        self.tracer  = tracer or Tracer()
+        # 関数の展開に使う，最適化を終えた関数の本体 (inline が有効なときだけ)
+        self.inliner = inliner
+
+    @classmethod
+    def from_options(cls, optimization: dict, tracer: Optional[Tracer] = None) -> Optional['Pipeline']:
+        '''
+        optimization で有効になっているパスのパイプライン (1 つもなければ None)
+        '''
+        passes  = []
+        inliner = Inliner() if optimization.get('inline') else None
+        for name, p in PASSES:
+            if not optimization.get(name):
+                continue
+            kwargs = {arg: optimization[key] for key, arg in PASS_PARAMETERS.get(name, {}).items()
+                      if optimization.get(key) is not None}
+            if name == 'inline':
+                kwargs['inliner'] = inliner
+            passes.append((name, functools.partial(p, **kwargs) if len(kwargs) > 0 else p))
+        if not len(passes) > 0:
+            return None
+        return cls(passes, tracer, inliner)
+
+    def run(self, fn: Fundecl):
+        if fn.name is None or not len(fn.codes) > 0:
+            return
+        size = len(fn.codes)
+        cfg  = CFG.from_fundecl(fn)
+        for name, p in self.passes:
+            changed = p(fn, cfg)
+            if self.tracer.enabled(TRACE_DEBUG):
+                self.tracer.emit('pass', f"{fn.name}: {name} ({'変更あり' if changed else '変更なし'})",
+                                 function=fn.name, name=name, changed=changed)
+        fn.codes = cfg.to_codes()
+        if self.inliner is not None:
+            self.inliner.register(fn, size)
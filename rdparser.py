@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+from fastlexer import Token
+
+# 二項演算子の優先順位と，還元時に呼び出す Compiler のメソッド名
+BINARY_OPERATORS = {
+    'PLUS':  (1, 'expression'),
+    'MINUS': (1, 'expression'),
+    'MULT':  (2, 'term'),
+    'DIV':   (2, 'term'),
+}
+
+RELATIONAL_OPERATORS = ('EQ', 'NEQ', 'LT', 'LE', 'GT', 'GE')
+
+
+class RecursiveDescentParser(object):
+    '''
+    PL-X の再帰下降構文解析器．
+    文は再帰下降で，expression / term / factor は優先順位法で解析する．
+    PLY の構文規則が還元時に呼び出すのと同じ順番で Compiler のメソッドを呼び出すため，
+    同じ LLVM IR が生成される．
+    '''
+
+    def __init__(self, compiler, lexer):
+        super().__init__()
+        self.compiler = compiler
+        self.lexer    = lexer
+        self.tok      = None
+        self._token   = None
+
+    def parse(self, data: str):
+        self.lexer.input(data)
+        self._token = self.lexer.token
+        self.next()
+        self.program()
+
+    # NOTE: トークン操作
+
+    def next(self):
+        t = self.tok = self._token()
+        if t is None:
+            self.tok = Token('$end', None, self.lexer.lineno, self.lexer.lexpos)
+        return t
+
+    def expect(self, type: str):
+        t = self.tok
+        if t.type != type:
+            self.error()
+        self.next()
+        return t
+
+    def error(self):
+        t = self.tok
+        if t.type == '$end':
+            raise RuntimeError('構文エラー: 予期しないファイルの終端')
+        raise RuntimeError(f'{t.lineno} 行目: 構文エラー 予期しない文字 "{t.value}" (type: {t.type})')
+
+    # NOTE: 宣言
+
+    def program(self):
+        c = self.compiler
+        self.expect('PROGRAM')
+        self.expect('IDENT')
+        self.expect('SEMICOLON')
+        self.outblock()
+        c.finalize_function()
+        self.expect('PERIOD')
+        if self.tok.type != '$end':
+            self.error()
+        c.program()
+
+    def outblock(self):
+        self.var_decl_part()
+        self.subprog_decl_part()
+        self.compiler.link_main_function()
+        self.statement()
+
+    def var_decl_part(self):
+        if self.tok.type == 'VAR':
+            self.var_decl()
+            while self.tok.type == 'SEMICOLON':
+                self.next()
+                if self.tok.type != 'VAR':
+                    break
+                self.var_decl()
+            else:
+                self.error()
+        self.compiler.var_decl_part()
+
+    def var_decl(self):
+        self.expect('VAR')
+        self.id_list()
+        self.compiler.var_decl()
+
+    def id_list(self):
+        self.link_id()
+        while self.tok.type == 'COMMA':
+            self.next()
+            self.link_id()
+
+    def link_id(self):
+        ident = self.expect('IDENT').value
+        if self.tok.type == 'LBRACKET':
+            self.next()
+            i_from = self.expect('NUMBER').value
+            self.expect('INTERVAL')
+            i_to   = self.expect('NUMBER').value
+            self.expect('RBRACKET')
+            self.compiler.link_id(ident, i_from, i_to)
+        else:
+            self.compiler.link_id(ident)
+
+    def subprog_decl_part(self):
+        while self.tok.type in ('PROCEDURE', 'FUNCTION', 'FORWARD'):
+            self.subprog_decl()
+            self.expect('SEMICOLON')
+
+    def subprog_decl(self):
+        c = self.compiler
+        forward = self.tok.type == 'FORWARD'
+        if forward:
+            self.next()
+
+        is_func = self.tok.type == 'FUNCTION'
+        if not is_func and self.tok.type != 'PROCEDURE':
+            self.error()
+        self.next()
+
+        c.link_proc(self.expect('IDENT').value)
+        if is_func:
+            c.func_name()
+        self.args()
+
+        if forward:
+            c.unlink_current_function()
+            return
+
+        self.expect('SEMICOLON')
+        self.closure()
+
+    def args(self):
+        if self.tok.type != 'LPAREN':
+            return
+        self.next()
+        self.compiler.enter_block()
+        self.id_list()
+        self.compiler.link_args()
+        self.expect('RPAREN')
+
+    def closure(self):
+        c = self.compiler
+        c.enter_block()
+        self.var_decl_part()
+        self.statement()
+        c.leave_block()
+        c.finalize_function()
+        c.remove_local_var()
+
+    # NOTE: 文
+
+    def statement(self):
+        type = self.tok.type
+        if type == 'IDENT':
+            self.ident_statement()
+        elif type == 'BEGIN':
+            self.block_statement()
+        elif type == 'IF':
+            self.if_statement()
+        elif type == 'WHILE':
+            self.while_statement()
+        elif type == 'FOR':
+            self.for_statement()
+        elif type == 'READ':
+            self.read_statement()
+        elif type == 'WRITE':
+            self.write_statement()
+        # それ以外は null_statement
+
+    def ident_statement(self):
+        c     = self.compiler
+        ident = self.expect('IDENT').value
+        type  = self.tok.type
+
+        if type == 'ASSIGN':
+            self.next()
+            self.expression()
+            c.assignment_statement(ident)
+        elif type == 'LBRACKET':
+            self.next()
+            self.expression()
+            self.expect('RBRACKET')
+            self.expect('ASSIGN')
+            self.expression()
+            c.assignment_statement(ident, indexed=True)
+        else:
+            self.proc_call(ident)
+
+    def proc_call(self, ident: str):
+        c = self.compiler
+        c.proc_call_name(ident)
+        if self.tok.type == 'LPAREN':
+            self.next()
+            self.expression()
+            while self.tok.type == 'COMMA':
+                self.next()
+                self.expression()
+            self.expect('RPAREN')
+        c.proc_call()
+
+    def block_statement(self):
+        c = self.compiler
+        self.expect('BEGIN')
+        self.statement()
+        c.statement_list()
+        while self.tok.type == 'SEMICOLON':
+            self.next()
+            self.statement()
+            c.statement_list()
+        self.expect('END')
+
+    def if_statement(self):
+        c = self.compiler
+        self.expect('IF')
+        self.condition()
+        c.if_condition()
+        self.expect('THEN')
+        self.statement()
+        c.if_else()
+        if self.tok.type == 'ELSE':
+            self.next()
+            self.statement()
+        c.if_end()
+
+    def while_statement(self):
+        c = self.compiler
+        self.expect('WHILE')
+        c.while_init()
+        self.condition()
+        c.while_condition()
+        self.expect('DO')
+        self.statement()
+        c.while_end()
+
+    def for_statement(self):
+        c = self.compiler
+        self.expect('FOR')
+        ident = self.expect('IDENT').value
+        self.expect('ASSIGN')
+        self.expression()
+        self.expect('TO')
+        self.expression()
+        c.for_init(ident)
+        self.expect('DO')
+        self.statement()
+        c.for_end()
+
+    def read_statement(self):
+        self.expect('READ')
+        self.expect('LPAREN')
+        self.var_name(self.expect('IDENT').value)
+        self.expect('RPAREN')
+        self.compiler.read_statement()
+
+    def write_statement(self):
+        self.expect('WRITE')
+        self.expect('LPAREN')
+        self.expression()
+        self.expect('RPAREN')
+        self.compiler.write_statement()
+
+    # NOTE: 式
+
+    def condition(self):
+        self.expression()
+        t = self.tok
+        if t.type not in RELATIONAL_OPERATORS:
+            self.error()
+        self.next()
+        self.expression()
+        self.compiler.condition(t.value)
+
+    def expression(self):
+        t = self.tok
+        if t.type == 'PLUS' or t.type == 'MINUS':
+            self.next()
+            self.factor()
+            self.climb(2)
+            self.compiler.expression(t.value, unary=True)
+        else:
+            self.factor()
+        self.climb(1)
+
+    def climb(self, min_prec: int):
+        # 左結合の優先順位法: 優先順位が min_prec 以上の演算子をまとめて読む
+        c = self.compiler
+        while True:
+            t  = self.tok
+            op = BINARY_OPERATORS.get(t.type)
+            if op is None or op[0] < min_prec:
+                return
+            self.next()
+            self.factor()
+            self.climb(op[0] + 1)
+            getattr(c, op[1])(t.value)
+
+    def factor(self):
+        t = self.tok
+        if t.type == 'NUMBER':
+            self.next()
+            self.compiler.factor_number(t.value)
+        elif t.type == 'IDENT':
+            self.next()
+            if self.tok.type == 'LPAREN':
+                self.proc_call(t.value)
+            else:
+                self.var_name(t.value)
+                self.compiler.factor_variable()
+        elif t.type == 'LPAREN':
+            self.next()
+            self.expression()
+            self.expect('RPAREN')
+        else:
+            self.error()
+
+    def var_name(self, ident: str):
+        if self.tok.type == 'LBRACKET':
+            self.next()
+            self.expression()
+            self.expect('RBRACKET')
+            self.compiler.var_name(ident, indexed=True)
+        else:
+            self.compiler.var_name(ident)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Tuple
+
+from cfg import CFG, BasicBlock, clone_code, label_factor, register_of, replace_uses, used_values
+from decls import Factor, Fundecl
+from llvmcodes import LLVMCode, LLVMCodeBrCond, LLVMCodePhi, Opcode
+from loops import Loop, insert_preheader, loop_forest
+from symtab import Scope
+from tracing import TRACE_INFO
+
+# 複製する header の命令数の上限 (これより大きい条件式のループは回転しない)
+ROTATE_MAX_SIZE = 16
+
+
+def header_codes(header: BasicBlock) -> List[LLVMCode]:
+    '''
+    header の phi と終端命令を除いた命令 (preheader とループの末尾に複製するもの)
+    '''
+    return [c for c in header.body if c.opcode != Opcode.PHI]
+
+
+def rotatable(loop: Loop) -> bool:
+    '''
+    header だけが条件を調べてループを出る (while の形の) ループか．
+    header -> 本体 / 出口 の 2 つの行き先はどちらも header からしか入らず，header に戻るブロックは 1 つに限る．
+    '''
+    header = loop.header
+    t      = header.terminator
+    if t is None or t.opcode != Opcode.BR_COND or len(header.succs) != 2 or len(loop.latches) != 1:
+        return False
+    body, exit = header.succs if header.succs[0] in loop else reversed(header.succs)
+    latch      = loop.latches[0]
+    if body not in loop or exit in loop or body is header or latch is header:
+        return False
+    if loop.exiting != [header] or body.preds != [header] or exit.preds != [header]:
+        return False
+    if latch.terminator is None or latch.terminator.opcode != Opcode.BR_UNCOND:
+        return False
+    if next(exit.phis(), None) is not None:
+        return False
+    return len(header_codes(header)) <= ROTATE_MAX_SIZE
+
+
+class LoopRotation(object):
+    '''
+    header で条件を調べるループを，preheader で 1 度だけ条件を調べ (ガード)，2 回目からはループの末尾で調べるループにする．
+    header の命令は preheader とループの末尾に複製し，header で定義していた値は本体と出口の phi で受け取る．
+    '''
+
+    def __init__(self, fn: Fundecl, cfg: CFG):
+        super().__init__()
+        self.fn    = fn
+        self.cfg   = cfg
+        # レジスタ -> それを読む (命令, ブロック)
+        self.users: Dict[int, List[Tuple[LLVMCode, BasicBlock]]] = {}
+        for block in cfg.blocks:
+            for code in block.codes:
+                self.add_user(code, block)
+
+    def add_user(self, code: LLVMCode, block: BasicBlock):
+        for value in used_values(code):
+            r = register_of(value)
+            if r is not None:
+                self.users.setdefault(r, []).append((code, block))
+
+    def copy_header(self, header: BasicBlock, block: BasicBlock, replace: Dict[int, Factor], targets) -> LLVMCode:
+        '''
+        header の命令を block の末尾 (分岐の代わり) に複製し，条件付き分岐で targets に分岐する
+        '''
+        del block.codes[-1]
+        for code in header_codes(header):
+            clone = clone_code(code, replace, self.fn.register)
+            block.codes.append(clone)
+            self.add_user(clone, block)
+        t      = header.terminator
+        branch = LLVMCodeBrCond(replace.get(register_of(t.arg1), t.arg1), *[label_factor(b.label) for b in targets])
+        self.cfg.set_terminator(block, branch)
+        self.add_user(branch, block)
+        return branch
+
+    def rotate(self, loop: Loop) -> bool:
+        cfg, fn   = self.cfg, self.fn
+        preheader = insert_preheader(fn, cfg, loop)
+        if preheader is None:
+            return False
+        header = loop.header
+        latch  = loop.latches[0]
+        t      = header.terminator
+        body, exit = (header.succs if header.succs[0] in loop else list(reversed(header.succs)))
+        targets    = [cfg.block(t.arg2.val), cfg.block(t.arg3.val)]
+
+        pre_label, latch_label = cfg.label_of(preheader), cfg.label_of(latch)
+        phis = list(header.phis())
+        defs = [getattr(c, c.defines) for c in header_codes(header)
+                if c.defines is not None and register_of(getattr(c, c.defines)) is not None]
+
+        # ループの中で header の値の代わりに読む本体の phi
+        inside:  Dict[int, Factor] = {}
+        for f in [phi.retval for phi in phis] + defs:
+            inside[f.val] = Factor(Scope.LOCAL, val=fn.register())
+
+        from_pre:   Dict[int, Factor] = {}
+        from_latch: Dict[int, Factor] = {}
+        for phi in phis:
+            incoming = dict(zip([l.val for l in phi.labels], phi.values))
+            from_pre[phi.retval.val] = incoming[pre_label]
+            value = incoming[latch_label]
+            from_latch[phi.retval.val] = inside.get(register_of(value), value)
+
+        self.copy_header(header, preheader, from_pre, targets)
+        self.copy_header(header, latch, from_latch, targets)
+
+        # header の値を読む命令を，ループの中なら本体の phi，ループの後なら出口の phi に付け替える
+        outside: Dict[int, Factor] = {}
+        for r in inside:
+            for code, block in self.users.get(r, []):
+                if block is header:
+                    continue
+                if block in loop:
+                    replace_uses(code, inside)
+                    self.add_user(code, block)
+                else:
+                    if r not in outside:
+                        outside[r] = Factor(Scope.LOCAL, val=fn.register())
+                    replace_uses(code, outside)
+                    self.add_user(code, block)
+
+        # phi の値 -> (置くブロック, phi)
+        new_phis: Dict[int, Tuple[BasicBlock, LLVMCodePhi]] = {}
+        for target, replace in [(body, inside), (exit, outside)]:
+            for r, f in replace.items():
+                phi = LLVMCodePhi(f, [from_pre[r], from_latch[r]], [label_factor(pre_label), label_factor(latch_label)])
+                new_phis[f.val] = (target, phi)
+        # 読まれない phi (他の phi からしか読まれないものを含む) は作らない．
+        # 出口の phi がループの末尾から受け取る値は本体の phi のこともあるので，両方のブロックの phi をまとめて調べる
+        ids    = set(id(phi) for _, phi in new_phis.values())
+        needed = [v for v in new_phis if any(id(code) not in ids for code, _ in self.users.get(v, []))]
+        keep   = set(needed)
+        while needed:
+            for value in new_phis[needed.pop()][1].values:
+                v = register_of(value)
+                if v in new_phis and v not in keep:
+                    keep.add(v)
+                    needed.append(v)
+        for target in (body, exit):
+            target.codes[0:0] = [phi for v, (t, phi) in new_phis.items() if t is target and v in keep]
+        for v in keep:
+            target, phi = new_phis[v]
+            self.add_user(phi, target)
+
+        for succ in list(header.succs):
+            cfg.unlink(header, succ)
+        return True
+
+
+def rotate_loops(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    ループの回転: while の形のループを，ガードの後で本体の末尾に条件を置くループにする．
+    1 回の繰り返しで実行する分岐が 2 つ (header への br と header の br i1) から 1 つになる．
+    '''
+    cfg.remove_unreachable()
+    forest = loop_forest(cfg)
+    if not len(forest) > 0:
+        return False
+
+    rotation = LoopRotation(fn, cfg)
+    rotated  = 0
+    for loop in forest.loops:
+        if rotatable(loop) and rotation.rotate(loop):
+            rotated += 1
+    if rotated > 0:
+        cfg.remove_unreachable()
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('rotate.summary', f"{fn.name}: {len(forest)}個のループのうち {rotated}個を回転",
+                    function=fn.name, loops=len(forest), rotated=rotated)
+    return rotated > 0
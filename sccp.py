@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Optional, Tuple
+
+from cfg import CFG, BasicBlock, label_factor, register_of, replace_uses, used_values
+from decls import Factor, Fundecl
+from dominance import dominator_tree
+from llvmcodes import LLVMCode, LLVMCodeBrUncond, Opcode, fold_binary
+from symtab import Scope
+from tracing import TRACE_INFO
+
+# 束の最も下 (定数でない)．定数はその値 (int)，まだ値がわからないレジスタは表に入れない
+BOTTOM = None
+
+ARITHMETIC = (Opcode.ADD, Opcode.SUB, Opcode.MUL, Opcode.SDIV)
+
+# 値が定数とわかれば削除できる命令
+FOLDABLE = frozenset(ARITHMETIC + (Opcode.ICMP, Opcode.PHI, Opcode.LOAD))
+
+
+def constant_loads(fn: Fundecl, cfg: CFG) -> Dict[int, int]:
+    '''
+    一度だけ代入される大域変数の load -> 値．
+    関数を呼び出さない関数の中で，大域変数への store が定数の 1 つだけなら，その store が支配する load は必ずその値を読む．
+    '''
+    stores: Dict[str, List[Tuple[BasicBlock, int, LLVMCode]]] = {}
+    for block in cfg.blocks:
+        for i, code in enumerate(block.codes):
+            if code.opcode == Opcode.CALL:
+                return {}
+            if code.opcode == Opcode.STORE and type(code.arg2) is Factor and code.arg2.scope == Scope.GLOBAL:
+                stores.setdefault(code.arg2.name, []).append((block, i, code))
+                continue
+            if code.opcode == Opcode.LOAD:
+                continue
+            # scanf の引数など，load / store 以外で番地を渡された大域変数は書き換えられうる
+            for value in used_values(code):
+                if type(value) is Factor and value.scope == Scope.GLOBAL:
+                    stores.setdefault(value.name, []).append((block, i, code))
+
+    once = {name: found[0] for name, found in stores.items()
+            if len(found) == 1 and type(found[0][2].arg1) is Factor and found[0][2].arg1.scope == Scope.CONSTANT}
+    if not len(once) > 0:
+        return {}
+
+    tree   = dominator_tree(cfg)
+    values = {}
+    for block in cfg.blocks:
+        for i, code in enumerate(block.codes):
+            if code.opcode != Opcode.LOAD or type(code.arg2) is not Factor or code.arg2.scope != Scope.GLOBAL:
+                continue
+            found = once.get(code.arg2.name)
+            if found is None:
+                continue
+            store_block, store_i, store = found
+            if (store_block is block and store_i < i) or (store_block is not block and tree.dominates(store_block, block)):
+                values[id(code)] = store.arg1.val
+    return values
+
+
+class ConstantPropagation(object):
+    '''
+    Wegman-Zadeck の疎な条件付き定数伝搬．
+    実行されうる辺だけをたどりながら，レジスタの値を「未定 -> 定数 -> 定数でない」の束の上で求める．
+    '''
+
+    def __init__(self, fn: Fundecl, cfg: CFG):
+        super().__init__()
+        self.fn     = fn
+        self.cfg    = cfg
+        self.loads  = constant_loads(fn, cfg)
+        self.values: Dict[int, Optional[int]] = {}
+        self.users:  Dict[int, List[Tuple[LLVMCode, BasicBlock]]] = {}
+        self.executable_blocks = set()
+        self.executable_edges  = set()
+        self.flow_work: List[Tuple[Optional[BasicBlock], BasicBlock]] = []
+        self.ssa_work:  List[int] = []
+
+        for block in cfg.blocks:
+            for code in block.codes:
+                for value in used_values(code):
+                    r = register_of(value)
+                    if r is not None:
+                        self.users.setdefault(r, []).append((code, block))
+
+    def value(self, f):
+        '''
+        オペランドの値 (定数なら int，未定なら ...，それ以外は BOTTOM)
+        '''
+        if type(f) is not Factor:
+            return BOTTOM
+        if f.scope == Scope.CONSTANT:
+            return f.val
+        r = register_of(f)
+        if r is None or r < self.fn.args_cnt:
+            return BOTTOM
+        return self.values.get(r, ...)
+
+    def run(self):
+        self.flow_work.append((None, self.cfg.entry))
+        while self.flow_work or self.ssa_work:
+            while self.flow_work:
+                pred, block = self.flow_work.pop()
+                edge = (id(pred), id(block))
+                if edge in self.executable_edges:
+                    continue
+                self.executable_edges.add(edge)
+                first = id(block) not in self.executable_blocks
+                self.executable_blocks.add(id(block))
+                for code in block.codes:
+                    if code.opcode == Opcode.PHI:
+                        self.visit(code, block)
+                    elif first:
+                        self.visit(code, block)
+            while self.ssa_work:
+                r = self.ssa_work.pop()
+                for code, block in self.users.get(r, []):
+                    if id(block) in self.executable_blocks:
+                        self.visit(code, block)
+
+    def lower(self, f: Factor, value):
+        '''
+        レジスタの値を value にする (束の上では下がる方向にしか変わらない)
+        '''
+        r   = f.val
+        old = self.values.get(r, ...)
+        if value is ... or old is BOTTOM or old == value:
+            return
+        if old is not ...:
+            value = BOTTOM
+        self.values[r] = value
+        self.ssa_work.append(r)
+
+    def visit(self, code: LLVMCode, block: BasicBlock):
+        op = code.opcode
+        if op == Opcode.BR_UNCOND:
+            self.flow_work.append((block, self.cfg.block(code.arg1.val)))
+        elif op == Opcode.BR_COND:
+            cond = self.value(code.arg1)
+            if cond is ...:
+                return
+            if cond is BOTTOM or cond != 0:
+                self.flow_work.append((block, self.cfg.block(code.arg2.val)))
+            if cond is BOTTOM or cond == 0:
+                self.flow_work.append((block, self.cfg.block(code.arg3.val)))
+        elif op == Opcode.PHI:
+            self.lower(code.retval, self.meet_phi(code, block))
+        elif op in ARITHMETIC or op == Opcode.ICMP:
+            a, b = self.value(code.arg1), self.value(code.arg2)
+            if a is BOTTOM or b is BOTTOM:
+                value = BOTTOM
+            elif a is ... or b is ...:
+                return
+            elif op == Opcode.ICMP:
+                value = 1 if code.cmptype.evaluate(a, b) else 0
+            else:
+                value = fold_binary(op, a, b)
+            self.lower(code.retval, value)
+        elif op == Opcode.LOAD:
+            self.lower(code.arg1, self.loads.get(id(code), BOTTOM))
+        elif code.defines is not None:
+            f = getattr(code, code.defines)
+            if register_of(f) is not None:
+                self.lower(f, BOTTOM)
+
+    def meet_phi(self, phi: LLVMCode, block: BasicBlock):
+        value = ...
+        for v, label in zip(phi.values, phi.labels):
+            pred = self.cfg.labels.get(label.val)
+            if pred is None or (id(pred), id(block)) not in self.executable_edges:
+                continue
+            incoming = self.value(v)
+            if incoming is ...:
+                continue
+            if incoming is BOTTOM:
+                return BOTTOM
+            if value is ...:
+                value = incoming
+            elif value != incoming:
+                return BOTTOM
+        return value
+
+
+def propagate_constants(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    SCCP: 定数とわかったレジスタを定数に置き換え，条件が定数の br i1 を無条件分岐にして，実行されないブロックを削除する．
+    最後に，分岐でつながっているだけのブロックを 1 つにまとめる．
+    '''
+    cfg.remove_unreachable()
+    sccp = ConstantPropagation(fn, cfg)
+    sccp.run()
+
+    constants = {r: Factor(Scope.CONSTANT, val=v) for r, v in sccp.values.items() if v is not BOTTOM}
+    folded    = 0
+    for block in list(cfg.blocks):
+        codes = []
+        for code in block.codes:
+            if code.opcode in FOLDABLE and register_of(getattr(code, code.defines)) in constants:
+                folded += 1
+                continue
+            replace_uses(code, constants)
+            codes.append(code)
+        block.codes = codes
+
+        t = block.terminator
+        if t is not None and t.opcode == Opcode.BR_COND and type(t.arg1) is Factor and t.arg1.scope == Scope.CONSTANT:
+            taken = t.arg2 if t.arg1.val != 0 else t.arg3
+            cfg.set_terminator(block, LLVMCodeBrUncond(label_factor(taken.val)))
+            folded += 1
+
+    removed = cfg.remove_unreachable()
+    trivial = remove_trivial_phis(cfg)
+    merged  = cfg.merge_blocks()
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('sccp.summary', f"{fn.name}: {len(constants)}個の定数, {folded}個の命令を畳み込み, "
+                    f"{removed}個のブロックを削除, {merged}個のブロックを結合",
+                    function=fn.name, constants=len(constants), folded=folded, removed=removed, merged=merged)
+    return folded + removed + trivial + merged > 0
+
+
+def remove_trivial_phis(cfg: CFG) -> int:
+    '''
+    どの辺から来ても同じ値になる phi (自分自身を除く) をその値に置き換える
+    '''
+    replace: Dict[int, Factor] = {}
+    changed = True
+    while changed:
+        changed = False
+        for block in cfg.blocks:
+            for phi in list(block.phis()):
+                if phi.retval.val in replace:
+                    continue
+                replace_uses(phi, replace)
+                values = {(v.scope, v.val) if type(v) is Factor else v: v
+                          for v in phi.values if register_of(v) != phi.retval.val}
+                if len(values) == 1:
+                    replace[phi.retval.val] = next(iter(values.values()))
+                    changed = True
+
+    if not len(replace) > 0:
+        return 0
+    # 置き換える値が別の取り除く phi のこともあるので，最後の値までたどる
+    for r, value in replace.items():
+        while register_of(value) in replace:
+            value = replace[register_of(value)]
+        replace[r] = value
+    for block in cfg.blocks:
+        block.codes = [c for c in block.codes if not (c.opcode == Opcode.PHI and c.retval.val in replace)]
+        for code in block.codes:
+            replace_uses(code, replace)
+    return len(replace)
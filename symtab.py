@@ -1,19 +1,8 @@
 # -*- coding: utf-8 -*-
 from enum import Enum
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
-ENABLE_COLOR = True
-
-def colored(s: str, color: str):
-    if not ENABLE_COLOR:
-        return s
-    if color == 'red':
-        return f'\033[31m{s}\033[0m'
-    if color == 'yellow':
-        return f'\033[33m{s}\033[0m'
-    if color == 'green':
-        return f'\033[32m{s}\033[0m'
-    return s
+from tracing import TRACE_DEBUG, TRACE_INFO, Tracer
 
 
 class Scope(Enum):
@@ -74,11 +63,33 @@ class Symbol(object):
                self.ptr_offset == other.ptr_offset
 
 class SymbolTable(object):
-    def __init__(self):
+    '''
+    名前をキーとした辞書で記号を管理する．
+    同じ名前の記号は追加した順にリスト (シャドウチェーン) に積まれ，検索では後に追加したものが優先される．
+    局所変数は別に覚えておき，remove_local_var で局所変数の数に比例する時間で取り除く．
+    '''
+    def __init__(self, tracer: Optional[Tracer] = None):
         super().__init__()
-        self.symbols = []
+        self.tracer      = tracer or Tracer()
+        self.trace       = self.tracer.enabled(TRACE_DEBUG)
+        self.trace_info  = self.tracer.enabled(TRACE_INFO)
+        self.table: Dict[str, List[Symbol]] = {}
+        self.local_symbols: List[Symbol]    = []
+        self.order: Dict[int, int]          = {}  # id(symbol) -> 追加順
+        self.inserted    = 0
         self.local_depth = 0
 
+    def __len__(self) -> int:
+        return len(self.order)
+
+    @property
+    def symbols(self) -> List[Symbol]:
+        '''
+        現在の記号を追加した順に並べたもの (表示用)
+        '''
+        symbols = [s for chain in self.table.values() for s in chain]
+        return sorted(symbols, key=lambda s: self.order[id(s)])
+
     def insert(self, token: str, scope: Optional[Union[Scope, str]] = None,
                register: int = None, size: int = 0, ptr_offset: int = 0):
         scope = scope or self.scope()
@@ -88,40 +99,68 @@ class SymbolTable(object):
         if scope == Scope.LOCAL:
             assert register is not None
             symbol = Symbol(token, scope=scope, register=register, size=size, ptr_offset=ptr_offset)
+            self.local_symbols.append(symbol)
         else:
             symbol = Symbol(token, scope=scope, size=size, ptr_offset=ptr_offset)
-        self.symbols.append(symbol)
-        print(f'{colored("追加", "yellow")}: {symbol},\t現在のシンボルの数: {len(self.symbols)}')
-
-    def lookup(self, token: str, scope_condition: Optional[List[Scope]] = None, args_cnt: int = None) -> Symbol:
-        found = [
-            r for r in self.symbols
-            if r.name == token and \
-               (args_cnt        is None or r.args_cnt == args_cnt) and \
-               (scope_condition is None or r.scope in scope_condition)]
 
-        if not len(found) > 0:
-            raise RuntimeError(f'構文エラー: トークンなし ... {token}')
+        chain = self.table.get(token)
+        if chain is None:
+            self.table[token] = [symbol]
+        else:
+            chain.append(symbol)
+        self.order[id(symbol)] = self.inserted
+        self.inserted += 1
+        if self.trace:
+            self.tracer.emit('symtab.insert', f'追加: {symbol},\t現在のシンボルの数: {len(self)}', 'yellow',
+                             symbol=str(symbol), count=len(self))
 
-        print(f'{colored("検索", "green")}: {found[-1]}')
-        return found[-1]
+    def lookup(self, token: str, scope_condition: Optional[List[Scope]] = None, args_cnt: int = None) -> Symbol:
+        for symbol in reversed(self.table.get(token, ())):
+            if (args_cnt        is None or symbol.args_cnt == args_cnt) and \
+               (scope_condition is None or symbol.scope in scope_condition):
+                if self.trace:
+                    self.tracer.emit('symtab.lookup', f'検索: {symbol}', 'green', symbol=str(symbol))
+                return symbol
+
+        raise RuntimeError(f'構文エラー: トークンなし ... {token}')
+
+    def signature(self, token: str) -> str:
+        '''
+        名前 token から見える記号の一覧 (関数ごとのキャッシュのキーに使う)
+        '''
+        return ';'.join(f"{s.scope}:{s.register}:{s.args_cnt}:{s.size}:{s.ptr_offset}"
+                        for s in self.table.get(token, ()))
 
     def update_args_cnt(self, symbol, cnt):
-        found = [i for i, s in enumerate(self.symbols) if s == symbol]
+        chain = self.table.get(symbol.name, [])
+        found = [i for i, s in enumerate(chain) if s == symbol]
         if not len(found) > 0:
             raise RuntimeError("シンボルが見つかりませんでした。")
         index = found[0]
 
         new_symbol = Symbol(name=symbol.name, scope=symbol.scope, register=symbol.register, args_cnt=cnt)
-        if new_symbol not in self.symbols:
-            self.symbols[index].args_cnt = cnt
+        if new_symbol not in chain:
+            chain[index].args_cnt = cnt
         else:
             # 更新先の内容がすでに存在する場合は、削除する
-            self.symbols.pop(index)
+            del self.order[id(chain.pop(index))]
 
     def remove_local_var(self):
-        self.symbols = [s for s in self.symbols if s.scope != Scope.LOCAL]
-        print(f'{colored("削除", "red")}: 現在のシンボル {self.symbols}')
+        # 後に追加したものから取り除くと，ほとんどの場合はチェーンの末尾から取り出すだけで済む
+        removed = self.local_symbols
+        for symbol in reversed(removed):
+            chain = self.table[symbol.name]
+            if chain[-1] is symbol:
+                chain.pop()
+            else:
+                chain.pop(next(i for i, s in enumerate(chain) if s is symbol))
+            if not chain:
+                del self.table[symbol.name]
+            del self.order[id(symbol)]
+        self.local_symbols = []
+        if self.trace_info:
+            self.tracer.emit('symtab.remove_local_var', f'削除: {removed},\t現在のシンボルの数: {len(self)}', 'red',
+                             removed=[str(s) for s in removed], count=len(self))
 
     def scope(self):
         if self.local_depth > 0:
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+import copy
+from typing import Dict, List, Optional, Set, Tuple
+
+from cfg import CFG, BasicBlock, label_factor, register_of, replace_uses
+from decls import Factor, Fundecl
+from llvmcodes import (CmpType, LLVMCode, LLVMCodeBrCond, LLVMCodeBrUncond, LLVMCodeCallProc, LLVMCodeIcmp,
+                       LLVMCodePhi, LLVMCodeProcReturn, Opcode)
+from symtab import Scope
+from tracing import TRACE_INFO
+
+
+def constant_value(value) -> Optional[int]:
+    '''
+    ret の値が定数ならその値 (手続きの ret は int の 0 を返す)
+    '''
+    if type(value) is int:
+        return value
+    if type(value) is Factor and value.scope == Scope.CONSTANT:
+        return value.val
+    return None
+
+
+def duplicate(code: LLVMCode) -> LLVMCode:
+    '''
+    リストのフィールドも複製した code の複製 (レジスタは変えない)
+    '''
+    clone = copy.copy(code)
+    for field in code.fields:
+        value = getattr(code, field)
+        if type(value) is list:
+            setattr(clone, field, list(value))
+    return clone
+
+
+def returned_value(block: BasicBlock, index: int):
+    '''
+    block の index 番目の呼び出しの後に他の命令を実行せず，無条件分岐と phi だけを通って ret に着くなら，その ret が返す値．
+    途中の phi は，たどってきたブロックから来たときの値に置き換える．そうでなければ None
+    '''
+    if index != len(block.codes) - 2:
+        return None
+    values: Dict[int, object] = {}
+    seen = {id(block)}
+    while True:
+        t = block.terminator
+        if t.opcode == Opcode.RET:
+            return values.get(register_of(t.arg), t.arg)
+        if t.opcode != Opcode.BR_UNCOND:
+            return None
+        succ = block.succs[0]
+        if id(succ) in seen or any(code.opcode != Opcode.PHI for code in succ.body):
+            return None
+        seen.add(id(succ))
+        incoming = {}
+        for phi in succ.phis():
+            value = dict(zip([l.val for l in phi.labels], phi.values)).get(block.label)
+            if value is None:
+                return None
+            incoming[phi.retval.val] = values.get(register_of(value), value)
+        values.update(incoming)
+        block = succ
+
+
+def tail_calls(cfg: CFG) -> List[Tuple[BasicBlock, int, LLVMCode, object]]:
+    '''
+    末尾位置の呼び出し (ブロック, 位置, 呼び出し, そのあと返す値)
+    '''
+    sites = []
+    for block in cfg.blocks:
+        index = len(block.codes) - 2
+        if index >= 0 and block.codes[index].opcode == Opcode.CALL:
+            value = returned_value(block, index)
+            if value is not None:
+                sites.append((block, index, block.codes[index], value))
+    return sites
+
+
+def forwards_result(call: LLVMCode, value, procedure: bool) -> bool:
+    '''
+    呼び出しの後で value を返すことが，呼び出しの結果を返すことと同じか．
+    手続きは必ず 0 を返すので，手続きから手続きを呼び出した後で 0 を返すのも同じ (procedure)
+    '''
+    return register_of(value) == call.retval.val or (procedure and constant_value(value) == 0)
+
+
+def eliminate_tail_recursion(fn: Fundecl, cfg: CFG) -> bool:
+    '''
+    末尾再帰の除去: 自分自身を呼び出してその結果を返す (全ての ret が同じ定数を返すならその定数を返す) 呼び出しを，
+    引数を phi で受け取る tailrecurse.N への分岐に置き換えてループにする．
+    入口には alloca だけを残し，ループの中で確保し直してスタックが伸びないように他のブロックの alloca も入口に移す．
+    '''
+    constants = set(constant_value(code.arg) for code in cfg.instructions() if code.opcode == Opcode.RET)
+    sites = [(block, call) for block, _, call, value in tail_calls(cfg)
+             if call.func.name == fn.name and
+             (register_of(value) == call.retval.val or
+              (constant_value(value) is not None and constants == {constant_value(value)}))]
+
+    if len(sites) > 0:
+        entry       = cfg.entry
+        entry_label = cfg.label_of(entry)
+        header      = cfg.add_block(cfg.new_label('tailrecurse'), after=entry)
+        header.codes = [code for code in entry.codes if code.opcode != Opcode.ALLOCA]
+        entry.codes  = [code for code in cfg.instructions() if code.opcode == Opcode.ALLOCA]
+        for block in cfg.blocks[2:]:
+            block.codes = [code for code in block.codes if code.opcode != Opcode.ALLOCA]
+        for succ in list(entry.succs):
+            cfg.unlink(entry, succ)
+            cfg.link(header, succ)
+            cfg.rename_incoming(succ, entry_label, header.label)
+        cfg.set_terminator(entry, LLVMCodeBrUncond(label_factor(header.label)))
+
+        # 引数 %i は，入口から来たときは %i，末尾呼び出しから来たときはその引数になる phi で受け取る
+        phis    = [LLVMCodePhi(Factor(Scope.LOCAL, val=fn.register()), [Factor(Scope.LOCAL, val=i)],
+                               [label_factor(entry_label)]) for i in range(fn.args_cnt)]
+        replace = {i: phi.retval for i, phi in enumerate(phis)}
+        for code in cfg.instructions():
+            replace_uses(code, replace)
+        header.codes[0:0] = phis
+
+        for block, call in sites:
+            block = header if block is entry else block
+            for phi, arg in zip(phis, call.args):
+                phi.values.append(arg)
+                phi.labels.append(label_factor(block.label))
+            block.codes.remove(call)
+            cfg.set_terminator(block, LLVMCodeBrUncond(label_factor(header.label)))
+        cfg.remove_unreachable()
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('tailcall.summary', f"{fn.name}: {len(sites)}個の末尾再帰をループに変換",
+                    function=fn.name, eliminated=len(sites))
+    return len(sites) > 0
+
+
+def mark_tail_calls(fn: Fundecl, procedures: Set[str]) -> int:
+    '''
+    結果をそのまま返す末尾位置の呼び出しに tail を付け，ret を呼び出しの直後に置く．
+    引数の数が同じ (型が同じ) 関数の呼び出しは musttail にし，LLVM に必ず分岐として生成させる．
+    procedures は手続きの名前．印を付けた呼び出しの数を返す．
+    '''
+    procedure = fn.name in procedures
+
+    def sites(cfg: CFG):
+        return [(block, index, call) for block, index, call, value in tail_calls(cfg)
+                if call.tail is None and forwards_result(call, value, procedure and call.func.name in procedures)]
+
+    if not len(sites(CFG.from_fundecl(fn))) > 0:
+        return 0
+    # 展開の候補として登録した本体と命令 (phi など) を共有しているので，複製してから書き換える
+    cfg = CFG.from_codes([duplicate(code) for code in fn.codes], fn.name)
+    marked = sites(cfg)
+    for block, index, call in marked:
+        call.tail = 'musttail' if len(call.args) == fn.args_cnt else 'tail'
+        cfg.set_terminator(block, LLVMCodeProcReturn(call.retval))
+    cfg.remove_unreachable()
+    fn.codes = cfg.to_codes()
+    return len(marked)
+
+
+class RecursionMerger(object):
+    '''
+    末尾呼び出しで互いに呼び出し合う関数を，どの関数から始めるかを第 1 引数で選ぶ 1 つの関数 (名前は 先頭の関数.dispatch) にまとめる．
+    関数の間の末尾呼び出しは呼び出される関数の先頭への分岐になるので，相互再帰がループになる．
+    元の関数は，まとめた関数を呼び出して結果を返すだけの関数になる．
+    '''
+
+    def __init__(self, members: List[Fundecl]):
+        super().__init__()
+        self.members   = members
+        self.index     = {fn.name: k for k, fn in enumerate(members)}
+        self.procedure = not any(fn.is_func for fn in members)
+        self.cfgs      = [CFG.from_fundecl(fn) for fn in members]
+        # 関数ごとの，まとめた後で分岐に置き換える末尾呼び出し (id)
+        self.sites: List[Set[int]] = []
+        for cfg in self.cfgs:
+            self.sites.append(set(id(call) for _, _, call, value in tail_calls(cfg)
+                                  if call.func.name in self.index and forwards_result(call, value, self.procedure)))
+
+    def mergeable(self) -> bool:
+        '''
+        関数と手続きが混ざっておらず，別の関数への末尾呼び出しがあるか
+        '''
+        if any(fn.is_func != self.members[0].is_func for fn in self.members):
+            return False
+        return any(code.opcode == Opcode.CALL and id(code) in self.sites[k] and code.func.name != fn.name
+                   for k, fn in enumerate(self.members) for code in fn.codes)
+
+    def merge(self) -> Fundecl:
+        members = self.members
+        width   = max(fn.args_cnt for fn in members)
+        merged  = Fundecl(f"{members[0].name}.dispatch", tracer=members[0].tracer)
+        merged.args_cnt = width + 1
+        merged.cntr     = width + 1
+        merged.is_func  = members[0].is_func
+        cfg   = CFG.from_codes([], merged.name)
+        entry = cfg.entry
+
+        # 関数ごとのブロック (元のラベル -> 新しいブロック) と，引数を受け取る phi
+        blocks: List[Dict[Optional[str], BasicBlock]] = []
+        params: List[List[LLVMCodePhi]]               = []
+        after = entry
+        for fn, fcfg in zip(members, self.cfgs):
+            new = {}
+            for b in fcfg.blocks:
+                after = new[b.label] = cfg.add_block(cfg.new_label(f"{fn.name}.{b.label or 'entry'}"), after=after)
+            blocks.append(new)
+            params.append([LLVMCodePhi(Factor(Scope.LOCAL, val=merged.register()), [], [])
+                           for _ in range(fn.args_cnt)])
+        starts = [blocks[k][fcfg.entry.label] for k, fcfg in enumerate(self.cfgs)]
+
+        # 第 1 引数 %0 の値で始める関数を選ぶ．残りの引数 %1 .. はその関数の引数になる
+        dispatch = entry
+        for k in range(len(starts) - 1):
+            label = cfg.label_of(dispatch)
+            last  = k == len(starts) - 2
+            for j in ([k, k + 1] if last else [k]):
+                for i, phi in enumerate(params[j]):
+                    phi.values.append(Factor(Scope.LOCAL, val=i + 1))
+                    phi.labels.append(label_factor(label))
+            cond      = Factor(Scope.LOCAL, val=merged.register())
+            following = starts[k + 1] if last else cfg.add_block(cfg.new_label('dispatch'), after=dispatch)
+            dispatch.codes.append(LLVMCodeIcmp(CmpType.EQ, Factor(Scope.LOCAL, val=0), Factor(Scope.CONSTANT, val=k), cond))
+            cfg.set_terminator(dispatch, LLVMCodeBrCond(cond, label_factor(starts[k].label), label_factor(following.label)))
+            dispatch = following
+
+        allocas: List[LLVMCode] = []
+        terminators = []
+        for k, (fn, fcfg) in enumerate(zip(members, self.cfgs)):
+            replace = {i: phi.retval for i, phi in enumerate(params[k])}
+            for code in fcfg.instructions():
+                if code.defines is not None:
+                    value = getattr(code, code.defines)
+                    r     = register_of(value)
+                    if r is not None:
+                        replace[r]     = copy.copy(value)
+                        replace[r].val = merged.register()
+            labels = {l: b.label for l, b in blocks[k].items() if l is not None}
+
+            for b in fcfg.blocks:
+                new   = blocks[k][b.label]
+                codes = b.codes
+                t     = b.terminator
+                if len(codes) >= 2 and id(codes[-2]) in self.sites[k]:
+                    # 末尾呼び出しは，引数を phi に渡して呼び出される関数の先頭へ分岐する
+                    call, callee = codes[-2], self.index[codes[-2].func.name]
+                    for phi, arg in zip(params[callee], call.args):
+                        phi.values.append(replace.get(register_of(arg), arg))
+                        phi.labels.append(label_factor(new.label))
+                    codes = codes[:-1]
+                    t     = LLVMCodeBrUncond(label_factor(starts[callee].label))
+                elif t.opcode == Opcode.RET:
+                    t = LLVMCodeProcReturn(replace.get(register_of(t.arg), t.arg))
+                elif t.opcode == Opcode.BR_UNCOND:
+                    t = LLVMCodeBrUncond(label_factor(labels[t.arg1.val]))
+                else:
+                    t = LLVMCodeBrCond(replace.get(register_of(t.arg1), t.arg1),
+                                       label_factor(labels[t.arg2.val]), label_factor(labels[t.arg3.val]))
+                terminators.append((new, t))
+
+                for code in codes[:-1]:
+                    clone = duplicate(code)
+                    replace_uses(clone, replace)
+                    if code.defines is not None and register_of(getattr(code, code.defines)) is not None:
+                        setattr(clone, code.defines, replace[register_of(getattr(code, code.defines))])
+                    if code.opcode == Opcode.PHI:
+                        clone.labels = [label_factor(labels[l.val]) for l in clone.labels]
+                    if code.opcode == Opcode.ALLOCA:
+                        allocas.append(clone)
+                        continue
+                    new.codes.append(clone)
+
+        for k, start in enumerate(starts):
+            start.codes[0:0] = params[k]
+        for new, t in terminators:
+            cfg.set_terminator(new, t)
+        # 末尾呼び出しを分岐にしたブロックからは，呼び出しの後で通っていた ret までのブロックに来なくなる
+        for block in cfg.blocks:
+            preds = set(pred.label for pred in block.preds)
+            for phi in block.phis():
+                keep = [i for i, l in enumerate(phi.labels) if l.val in preds]
+                phi.values = [phi.values[i] for i in keep]
+                phi.labels = [phi.labels[i] for i in keep]
+        entry.codes[0:0] = allocas
+        cfg.remove_unreachable()
+        cfg.merge_blocks()
+        merged.codes = cfg.to_codes()
+
+        for k, fn in enumerate(members):
+            retval = Factor(Scope.LOCAL, val=fn.register())
+            args   = ([Factor(Scope.CONSTANT, val=k)] + [Factor(Scope.LOCAL, val=i) for i in range(fn.args_cnt)] +
+                      [Factor(Scope.CONSTANT, val=0) for _ in range(width - fn.args_cnt)])
+            fn.codes = [LLVMCodeCallProc(Factor(Scope.FUNC, name=merged.name), args, retval),
+                        LLVMCodeProcReturn(retval)]
+
+        tracer = merged.tracer
+        if tracer.enabled(TRACE_INFO):
+            names = ', '.join(fn.name for fn in members)
+            tracer.emit('tailcall.merge', f"{merged.name}: 相互再帰する {names} をまとめた",
+                        function=merged.name, members=[fn.name for fn in members])
+        return merged
+
+
+def merge_recursion(members: List[Fundecl]) -> Optional[Fundecl]:
+    '''
+    相互再帰の除去: 末尾呼び出しで互いに呼び出し合う関数をまとめた関数 (RecursionMerger を参照)．まとめられなければ None
+    '''
+    merger = RecursionMerger(members)
+    if not merger.mergeable():
+        return None
+    return merger.merge()
@@ -1,10 +1,31 @@
 # -*- coding: utf-8 -*-
+import glob
+import io
+import json
+import os
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
 import textwrap
+import time
 import unittest
+from contextlib import redirect_stderr, redirect_stdout
 
-from symtab import Symbol
+import llvmcodes
+import parser
+from batch import collect_sources, run_batch
+from cache import CompileCache
+from cfg import CFG, label_factor
+from daemon import compile_with_daemon, request
+from dominance import dominator_tree
+from fastlexer import FastLexer
+from interp import Interpreter
+from loops import insert_preheader, loop_forest
+from parser import Compiler, compile_source
+from symtab import Scope, Symbol, SymbolTable
+from tracing import TRACE_DEBUG, TRACE_INFO, Tracer
 
 
 class TestCompiler(unittest.TestCase):
@@ -21,6 +42,900 @@ class TestCompiler(unittest.TestCase):
         self.assertEqual(sym1, sym2)
 
 
+    def test_symtab_shadowing(self):
+        symtab = SymbolTable()
+        symtab.insert("x", scope=Scope.GLOBAL)
+        symtab.insert("f", 'proc')
+        symtab.insert("x", scope=Scope.LOCAL, register=3)
+
+        # 後から追加した局所変数が優先される
+        self.assertEqual(symtab.lookup("x").scope, Scope.LOCAL)
+        self.assertEqual(symtab.lookup("x", [Scope.GLOBAL]).scope, Scope.GLOBAL)
+
+        symtab.remove_local_var()
+        self.assertEqual(symtab.lookup("x").scope, Scope.GLOBAL)
+        self.assertEqual(len(symtab), 2)
+
+    def test_symtab_args_cnt(self):
+        symtab = SymbolTable()
+        # forward 宣言と本体の宣言で同じ関数が 2 回追加される
+        symtab.insert("f", 'proc')
+        symtab.update_args_cnt(symtab.lookup("f", [Scope.FUNC]), cnt=2)
+        symtab.insert("f", 'proc')
+        symtab.update_args_cnt(symtab.lookup("f", [Scope.FUNC]), cnt=2)
+
+        self.assertEqual([s.args_cnt for s in symtab.symbols], [2])
+        self.assertEqual(symtab.lookup("f", [Scope.FUNC], args_cnt=2).args_cnt, 2)
+        with self.assertRaises(RuntimeError):
+            symtab.lookup("f", [Scope.FUNC], args_cnt=1)
+
+    def test_trace_disabled(self):
+        # トレースを有効にしなければ何も出力しない
+        with open("pscripts/opt2.p") as f:
+            data = f.read()
+        out, err = io.StringIO(), io.StringIO()
+        with redirect_stdout(out), redirect_stderr(err):
+            compile_source(data, {"remove_deadcode": True})
+        self.assertEqual(out.getvalue(), "")
+        self.assertEqual(err.getvalue(), "")
+
+    def test_trace_json(self):
+        with open("pscripts/opt2.p") as f:
+            data = f.read()
+        options = {"remove_deadcode": True}
+
+        sink = io.StringIO()
+        ir   = compile_source(data, options, tracer=Tracer(TRACE_DEBUG, sink, format='json'))
+        self.assertEqual(ir, compile_source(data, options))
+
+        events = [json.loads(line)["event"] for line in sink.getvalue().splitlines()]
+        self.assertIn("symtab.insert", events)
+        self.assertIn("symtab.lookup", events)
+        self.assertIn("dce.dependence", events)
+        self.assertIn("dce.summary", events)
+
+        sink = io.StringIO()
+        compile_source(data, options, tracer=Tracer(TRACE_INFO, sink, format='json'))
+        events = set(json.loads(line)["event"] for line in sink.getvalue().splitlines())
+        self.assertEqual(events, {"symtab.remove_local_var", "dce.summary"})
+
+    def test_batch(self):
+        # ワーカープロセスでコンパイルした結果がファイルごとに別々に書き出される
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ["pl3a.p", "arr.p", "pl4a.p"]:
+                shutil.copy(os.path.join("pscripts", name), tmpdir)
+            with open(os.path.join(tmpdir, "bad.p"), mode='w') as f:
+                f.write("program bad; begin x := end.\n")
+
+            outdir = os.path.join(tmpdir, "out")
+            with redirect_stdout(io.StringIO()):
+                result = run_batch(collect_sources(tmpdir), jobs=2, outdir=outdir)
+            self.assertEqual(len(result.items), 4)
+            self.assertEqual([os.path.basename(item.source) for item in result.failures], ["bad.p"])
+            self.assertFalse(os.path.exists(os.path.join(outdir, "bad.ll")))
+            for name in ["pl3a", "arr", "pl4a"]:
+                with open(os.path.join(outdir, name + ".ll")) as f:
+                    self.assertEqual(f.read(), self.execute(os.path.join("pscripts", name + ".p")))
+
+            # 別のディレクトリにある同じ名前のファイルは，outdir の下でも別のディレクトリに書き出される
+            for sub, name in [("a", "pl3a.p"), ("b", "arr.p")]:
+                os.makedirs(os.path.join(tmpdir, "src", sub))
+                shutil.copy(os.path.join("pscripts", name), os.path.join(tmpdir, "src", sub, "x.p"))
+            with redirect_stdout(io.StringIO()):
+                result = run_batch(collect_sources(os.path.join(tmpdir, "src")), jobs=1, outdir=outdir)
+            self.assertEqual(result.failures, [])
+            for sub, name in [("a", "pl3a.p"), ("b", "arr.p")]:
+                with open(os.path.join(outdir, sub, "x.ll")) as f:
+                    self.assertEqual(f.read(), self.execute(os.path.join("pscripts", name)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_compile_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = CompileCache(tmpdir, max_bytes=250)
+            with open("pscripts/pl3a.p") as f:
+                data = f.read()
+
+            key = cache.key(data, {"constant_folding": False})
+            self.assertNotEqual(key, cache.key(data, {"constant_folding": True}))
+            self.assertNotEqual(key, cache.key(data + "\n", {"constant_folding": False}))
+            self.assertIsNone(cache.get(key))
+            cache.put(key, "a" * 100)
+            self.assertEqual(cache.get(key), "a" * 100)
+
+            # 上限を超えると最後に使われた時刻が古いものから削除される
+            os.utime(cache.path(key), (0, 0))
+            cache.put("b" * 64, "b" * 100)
+            cache.put("c" * 64, "c" * 100)
+            cache.evict()
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(cache.get("c" * 64), "c" * 100)
+            self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "stores": 3, "evictions": 1})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_function_cache(self):
+        # 1 つの関数を変更しても，他の関数はキャッシュから取り出される (ラベル番号がずれても同じ結果になる)
+        source = textwrap.dedent('''
+            program cache;
+            var n;
+            procedure p(a);
+            begin
+                while a > 0 do a := a - 1
+            end;
+            function f(a);
+            begin
+                if a > 0 then f := a else f := 0 - a
+            end;
+            begin
+                read(n);
+                p(n);
+                write(f(n))
+            end.
+        ''')
+        edited = source.replace("while a > 0", "if a = 0 then a := 1; while a > 0")
+        options = {"remove_deadcode": True}
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = CompileCache(tmpdir)
+            self.assertEqual(compile_source(source, options, function_cache=cache), compile_source(source, options))
+            self.assertEqual(cache.stats()["stores"], 3)
+            self.assertEqual(compile_source(source, options, function_cache=cache), compile_source(source, options))
+            self.assertEqual(cache.hits, 3)
+            self.assertEqual(compile_source(edited, options, function_cache=cache), compile_source(edited, options))
+            self.assertEqual(cache.hits, 5)
+
+            # 展開した関数の名前が前に付いたラベルはずらさず，展開した呼び出し元はキャッシュしない
+            options = {"inline": True, "mem2reg": True}
+            for data in [source, source, edited, edited]:
+                self.assertEqual(compile_source(data, options, function_cache=cache), compile_source(data, options))
+            self.assertIn("f.if.", compile_source(source, options))
+            with open("pscripts/pl4a.p") as f:
+                data = f.read()
+            for _ in range(2):
+                self.assertEqual(compile_source(data, {"inline": True}, function_cache=cache),
+                                 compile_source(data, {"inline": True}))
+
+            # パスが加えるループの出口のブロックも，キャッシュから取り出したときに同じラベルになる
+            with open("pscripts/pl3b.p") as f:
+                data = f.read()
+            for options in [{"licm": True, "loop_rotation": True}, {"while_rotation": True, "licm": True}]:
+                cold = compile_source(data, options)
+                self.assertIn("while.exit.", cold)
+                for _ in range(2):
+                    self.assertEqual(compile_source(data, options, function_cache=cache), cold)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_daemon(self):
+        tmpdir = tempfile.mkdtemp()
+        path   = os.path.join(tmpdir, "plx.sock")
+        server = subprocess.Popen([sys.executable, "daemon.py", "--socket", path, "serve", "-j", "1"])
+        try:
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.05)
+
+            with open("pscripts/ex4.p") as f:
+                data = f.read()
+            response = compile_with_daemon(data, path=path)
+            self.assertTrue(response["daemon"])
+            self.assertEqual(response["ir"], compile_source(data))
+
+            response = compile_with_daemon("program bad; begin x := end.", path=path)
+            self.assertFalse(response["ok"])
+            self.assertIn("構文エラー", response["diagnostics"])
+
+            stats = request({"command": "stats"}, path)
+            self.assertEqual((stats["requests"], stats["failures"]), (2, 1))
+            request({"command": "shutdown"}, path)
+            server.wait(timeout=10)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            server.kill()
+            shutil.rmtree(tmpdir)
+
+        # デーモンが起動していなければ同じプロセスでコンパイルする
+        with redirect_stdout(io.StringIO()):
+            response = compile_with_daemon(data, path=path)
+        self.assertFalse(response["daemon"])
+        self.assertEqual(response["ir"], compile_source(data))
+
+    def test_llvmcodes_slots(self):
+        # 命令と Factor は __dict__ を持たず，命令の種類は opcode で見分けられる
+        compiler = Compiler({"remove_deadcode": True})
+        with open("pscripts/opt2.p") as f:
+            compiler.compile(f.read())
+        codes = [code for fn in compiler.codegen.functions for code in fn.codes]
+        self.assertTrue(len(codes) > 0)
+        for code in codes:
+            self.assertFalse(hasattr(code, "__dict__"))
+            self.assertIsInstance(code.opcode, llvmcodes.Opcode)
+            for name in type(code).fields:
+                value = getattr(code, name)
+                if isinstance(value, parser.Factor):
+                    self.assertFalse(hasattr(value, "__dict__"))
+        self.assertEqual(len(set(cls.opcode for cls in vars(llvmcodes).values()
+                                 if isinstance(cls, type) and hasattr(cls, "opcode"))), len(llvmcodes.Opcode))
+
+    def test_register_numbering(self):
+        # デッドコード削除の後も，各関数の結果のレジスタは %(引数の数 + 1) からの連番になる
+        for filename in ["pscripts/pl3a.p", "pscripts/opt2.p", "pscripts/pl4a.p"]:
+            with open(filename) as f:
+                data = f.read()
+            for options in [None, {"remove_deadcode": True}]:
+                ir = compile_source(data, options)
+                for header, body in re.findall(r"define i32 @\w+\((.*?)\)\{\n(.*?)\n\}", ir, re.S):
+                    args_cnt = len(header.split(', ')) if header else 0
+                    defined  = [int(r) for r in re.findall(r"^  %(\d+) =", body, re.M)]
+                    self.assertEqual(defined, list(range(args_cnt + 1, args_cnt + 1 + len(defined))))
+                    used = set(int(r) for r in re.findall(r"%(\d+)\b", body))
+                    self.assertTrue(used <= set(defined) | set(range(args_cnt)))
+
+    def test_compile_to_stream(self):
+        # 関数ごとに書き出し，書き出した関数は手放す．宣言が末尾に移る以外は compile() と同じ
+        for filename in ["pscripts/pl3a.p", "pscripts/pl4a.p"]:
+            with open(filename) as f:
+                data = f.read()
+            compiler = Compiler({"remove_deadcode": True})
+            out      = io.StringIO()
+            compiler.compile_to(data, out)
+            self.assertEqual(len(compiler.codegen.functions), 1)
+
+            expected = compile_source(data, {"remove_deadcode": True})
+            self.assertTrue(out.getvalue().endswith("\n"))
+            self.assertEqual(sorted(out.getvalue().split("\n")), sorted((expected + "\n").split("\n")))
+            self.assertLess(out.getvalue().rindex("define "), out.getvalue().index("declare "))
+
+    def test_cfg(self):
+        compiler = Compiler()
+        with open("pscripts/for.p") as f:
+            compiler.compile(f.read())
+        main  = compiler.codegen.functions[-1]
+        graph = CFG.from_fundecl(main)
+        self.assertEqual([str(c) for c in graph.to_codes()], [str(c) for c in main.codes])
+
+        cond, body = graph.block("for.condition.0"), graph.block("for.body.0")
+        self.assertEqual(cond.succs, [body, graph.block("for.end.0")])
+        self.assertEqual(body.preds, [graph.entry, cond])
+        rpo = graph.rpo()
+        self.assertIs(rpo[0], graph.entry)
+        self.assertIs(graph.rpo(), rpo)
+        self.assertEqual(len(rpo), len(graph))
+
+        # 辺を分割すると解析結果は作り直される
+        split = graph.split_edge(cond, body)
+        self.assertEqual(cond.succs, [graph.block("for.end.0"), split])
+        self.assertEqual(split.succs, [body])
+        self.assertIsNot(graph.rpo(), rpo)
+        self.assertIn(split, graph.rpo())
+
+        # 到達しないブロックの削除
+        dead = graph.add_block(graph.new_label("dead"))
+        graph.set_terminator(dead, llvmcodes.LLVMCodeBrUncond(parser.Factor(Scope.LOCAL, val="for.end.1")))
+        self.assertEqual(graph.remove_unreachable(), 1)
+        self.assertNotIn(dead, graph.block("for.end.1").preds)
+
+    def test_loops(self):
+        compiler = Compiler()
+        with open("pscripts/whilewhile.p") as f:
+            compiler.compile(f.read())
+        graph  = CFG.from_fundecl(compiler.codegen.functions[-1])
+        tree   = dominator_tree(graph)
+        forest = loop_forest(graph)
+        self.assertIs(loop_forest(graph), forest)
+
+        outer, inner = forest.loop_for(graph.block("while.init.1")), forest.loop_for(graph.block("while.init.2"))
+        self.assertEqual([l.header.label for l in forest.roots], ["while.init.0", "while.init.1"])
+        self.assertEqual(outer.children, [inner])
+        self.assertEqual((outer.depth, inner.depth, inner.kind), (1, 2, "while"))
+        self.assertIs(inner.preheader, graph.block("while.body.1"))
+        self.assertEqual(inner.exits, [graph.block("while.end.2")])
+        self.assertEqual(outer.exits, [graph.block("while.end.1")])
+        self.assertIn(graph.block("while.body.2"), outer)
+        self.assertTrue(forest.is_back_edge(graph.block("while.end.2"), outer.header))
+        self.assertTrue(tree.dominates(outer.header, graph.block("while.body.2")))
+        self.assertFalse(tree.dominates(graph.block("while.body.2"), graph.block("while.end.2")))
+        self.assertEqual(tree.frontier(graph.block("while.body.2")), [inner.header])
+
+        # for は本体から始まるループになる．辺を分割すると解析結果は作り直される
+        compiler.compile(open("pscripts/for.p").read())
+        graph  = CFG.from_fundecl(compiler.codegen.functions[-1])
+        forest = loop_forest(graph)
+        self.assertEqual([l.header.label for l in forest], ["for.body.2", "for.body.1", "for.body.0"])
+        self.assertEqual(forest.loop_for(graph.block("for.condition.0")).latches, [graph.block("for.condition.0")])
+        self.assertIsNone(forest.loop_for(graph.block("for.end.1")))
+        split = graph.split_edge(graph.block("for.end.0"), graph.block("for.body.1"))
+        self.assertIsNot(loop_forest(graph), forest)
+        self.assertIs(loop_forest(graph).loop_for(graph.block("for.body.1")).preheader, split)
+
+        # ブロック数が数万でも時間がかからない
+        body = "    n := 10;\n    while n > 0 do begin m := n; while m > 0 do m := m - 1; n := n - 1 end;\n" * 3000
+        compiler.compile(f"program BIG;\nvar n, m;\nbegin\n{body}    n := 0\nend.\n")
+        graph = CFG.from_fundecl(compiler.codegen.functions[-1])
+        start = time.perf_counter()
+        self.assertEqual(len(loop_forest(graph)), 6000)
+        self.assertEqual(len(dominator_tree(graph).frontier(graph.block("while.body.0"))), 1)
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_remove_deadcode(self):
+        # ループや分岐のある関数でも，読まれない変数への store とその計算が消える
+        options = {"remove_deadcode": True}
+        with open("pscripts/for-local-var.p") as f:
+            ir = compile_source(f.read(), options)
+        self.assertEqual(ir.count("alloca"), 1)
+        self.assertIn("icmp sle i32 %3, 100", ir)
+
+        with open("pscripts/pl2a.p") as f:
+            ir = compile_source(f.read(), options)
+        self.assertEqual(re.findall(r"%\d+ = alloca", ir), ["%2 = alloca", "%3 = alloca", "%1 = alloca"])
+        self.assertIn("store i32 %3, i32* @n", ir)
+
+        # 上書きされる store は消し，関数の呼び出しと ret の前の大域変数への store は残す
+        data = textwrap.dedent('''
+            program D;
+            var g;
+            procedure p;
+            var x, y;
+            begin
+                x := 1; g := 2; x := 3; y := x;
+                if g > 0 then g := y else g := 0;
+                while x > 0 do begin y := y + 1; x := x - 1 end
+            end;
+            begin g := 5; g := 6; p; g := 7 end.
+        ''')
+        ir = compile_source(data, options)
+        self.assertNotIn("store i32 1,", ir)
+        self.assertNotIn("store i32 5,", ir)
+        for stored in ["2", "3", "6", "7"]:
+            self.assertIn(f"store i32 {stored}, ", ir)
+        self.assertEqual(len(re.findall(r"add nsw", ir)), 0)
+
+        # 10 万命令の関数でも線形時間で終わる
+        body = "    x := x + y * 2;\n    y := x - y;\n    if x > y then z := z + 1 else x := z;\n" * 6000
+        data = f"program B;\nvar x, y;\nprocedure p(a);\nvar z;\nbegin\n{body}    z := a\nend;\nbegin p(1); write(x) end.\n"
+        compiler = Compiler(options)
+        start    = time.perf_counter()
+        compiler.compile(data)
+        self.assertLess(time.perf_counter() - start, 30)
+        self.assertGreater(sum(len(fn.codes) for fn in compiler.codegen.functions), 50000)
+
+    def test_mem2reg(self):
+        # ループの変数は phi になり，メモリの読み書きが残らない
+        for filename in ["pscripts/for.p", "pscripts/whilewhile.p", "pscripts/for-local-var.p"]:
+            with open(filename) as f:
+                ir = compile_source(f.read(), {"mem2reg": True})
+            self.assertNotRegex(ir, r"\b(alloca|load|store)\b")
+            self.assertRegex(ir, r"= phi i32 \[ \d+, %entry \], \[ %\d+, %(for\.condition|while\.body)\.\d+ \]")
+            for header, body in re.findall(r"define i32 @\w+\((.*?)\)\{\n(.*?)\n\}", ir, re.S):
+                args_cnt = len(header.split(', ')) if header else 0
+                start    = args_cnt if body.startswith("  entry:") else args_cnt + 1
+                defined  = [int(r) for r in re.findall(r"^  %(\d+) =", body, re.M)]
+                self.assertEqual(defined, list(range(start, start + len(defined))))
+
+        # 内側のループの phi は外側のループの phi を受け取る
+        with open("pscripts/whilewhile.p") as f:
+            ir = compile_source(f.read(), {"mem2reg": True})
+        self.assertIn("%9 = phi i32 [ %6, %while.body.1 ], [ %12, %while.body.2 ]", ir)
+
+        # 他の関数から読み書きされうる大域変数は昇格しない
+        with open("pscripts/proc.p") as f:
+            data = f.read()
+        self.assertEqual(compile_source(data, {"mem2reg": True}), compile_source(data))
+
+    def test_sccp(self):
+        # i32 の割り算は 0 の方向に切り捨て，0 での割り算は実行時まで残す
+        ir = compile_source("program D; begin write(-7 div 2); write(7 div 2); write(1 div 0) end.",
+                            {"constant_folding": True})
+        self.assertIn("i32 -3)", ir)
+        self.assertIn("i32 3)", ir)
+        self.assertIn("sdiv i32 1, 0", ir)
+        self.assertEqual(llvmcodes.fold_binary(llvmcodes.Opcode.MUL, 65536, 65536), 0)
+        self.assertIsNone(llvmcodes.fold_binary(llvmcodes.Opcode.SDIV, llvmcodes.INT32_MIN, -1))
+
+        # 定数しか使わないプログラムは分岐のない 1 つのブロックになる
+        data = textwrap.dedent('''
+            program C;
+            var a, b, c;
+            begin
+              a := 3;
+              b := a * 4;
+              if b > 10 then c := b - 2 else c := 0;
+              while a > 5 do a := a - 1;
+              write(c div 3)
+            end.
+        ''')
+        ir = compile_source(data, {"mem2reg": True, "sccp": True})
+        self.assertNotRegex(ir, r"\b(br|phi|icmp|load|store)\b")
+        self.assertIn("@.str.write, i64 0, i64 0), i32 3)", ir)
+
+        # 一度だけ代入される大域変数の読み出しは定数になり，条件が定数の分岐は無条件分岐になる
+        data = "program E; var x; begin x := 5; if x > 3 then write(1) else write(2) end."
+        ir = compile_source(data, {"sccp": True})
+        self.assertNotIn("if.else", ir)
+        self.assertNotIn("icmp", ir)
+        self.assertIn("store i32 5, i32* @x", ir)
+
+        # 読み込まれる大域変数は定数にしない
+        data = "program F; var x; begin x := 5; read(x); if x > 3 then write(1) else write(2) end."
+        self.assertIn("icmp", compile_source(data, {"sccp": True}))
+
+        # 取り除く phi が別の取り除く phi に置き換わるときも，最後の値まで置き換える
+        data = "program P; var i, x; begin read(x); for i := 1 to 3 do begin if 1 = 2 then x := 0 end; write(x - 1) end."
+        ir = compile_source(data, {"mem2reg": True, "sccp": True})
+        self.assertEqual(Interpreter(ir, stdin=[8]).run(), [7])
+
+    def test_gvn(self):
+        # ループの中で同じ変数を読み直す load は，ループの先頭で読んだ値を使う
+        with open("pscripts/pl0a.p") as f:
+            ir = compile_source(f.read(), {"gvn": True})
+        self.assertEqual(len(re.findall(r"load i32, i32\* @n", ir)), 1)
+        self.assertIn("%5 = sub nsw i32 %1, 1", ir)
+
+        # 同じ要素の番地は 1 度だけ計算し，store した値はそのまま使う．
+        # 別の要素に書き込みうる store と，大域変数を書き換えうる関数呼び出しの後は読み直す
+        data = textwrap.dedent('''
+            program G;
+            var i, x[1..10];
+            procedure P;
+            begin
+              i := 0
+            end;
+            begin
+              i := 3;
+              x[i] := x[i] + 1;
+              x[2] := 5;
+              write(x[i]);
+              P;
+              write(i)
+            end.
+        ''')
+        ir = compile_source(data, {"gvn": True})
+        self.assertEqual(len(re.findall(r"getelementptr inbounds \[10 x i32\], \[10 x i32\]\* @x, i32 0, i32 %1\b", ir)), 1)
+        self.assertIn("%1 = sub nsw i32 3, 1", ir)
+        self.assertEqual(len(re.findall(r"load i32, i32\* %2,", ir)), 2)
+        self.assertIn("%9 = call i32 @P()\n  %10 = load i32, i32* @i", ir)
+
+        # ループの本体は先頭で求めた番地と値を使う．多くのループがあっても線形時間で終わる
+        body  = "i := 0; while i < x[i] do begin x[i] := x[i] + i; i := i + 1 end;\n" * 3000
+        start = time.perf_counter()
+        ir    = compile_source(f"program H; var i, x[0..10]; begin {body} write(i) end.", {"gvn": True})
+        self.assertLess(time.perf_counter() - start, 30)
+        self.assertEqual(ir.count("getelementptr inbounds [11 x i32]"), 3000)
+
+    def test_licm(self):
+        # ループの外から 2 つのブロックが入る header には，phi の値をまとめた preheader を作る
+        compiler = Compiler({"mem2reg": True})
+        with open("pscripts/for.p") as f:
+            compiler.compile(f.read())
+        main   = compiler.codegen.functions[-1]
+        graph  = CFG.from_fundecl(main)
+        header = graph.block("for.body.0")
+        side   = graph.add_block(graph.new_label("side"), after=graph.entry)
+        graph.set_terminator(side, llvmcodes.LLVMCodeBrUncond(label_factor(header.label)))
+        graph.set_terminator(graph.entry, llvmcodes.LLVMCodeBrCond(parser.Factor(Scope.CONSTANT, val=1),
+                                                                    label_factor(header.label), label_factor(side.label)))
+        for phi in header.phis():
+            phi.add_incoming(parser.Factor(Scope.CONSTANT, val=7), label_factor(side.label))
+        loop = loop_forest(graph).loop_for(header)
+        self.assertIsNone(loop.preheader)
+        preheader = insert_preheader(main, graph, loop)
+        self.assertEqual(preheader.label, "for.preheader.0")
+        self.assertIs(loop_forest(graph).loop_for(header).preheader, preheader)
+        self.assertEqual(set(preheader.preds), {graph.entry, side})
+        self.assertTrue(all(str(phi.labels[0]) == "%for.preheader.0" and len(phi.values) == 2 for phi in header.phis()))
+        self.assertRegex(str(preheader.codes[0]), r"= phi i32 \[ \d+, %entry \], \[ 7, %side\.\d+ \]")
+
+        # ループの中で読み書きする大域変数はレジスタになり，実行する命令が減る
+        with open("pscripts/whilewhile.p") as f:
+            data = f.read()
+        before = Interpreter(compile_source(data))
+        after  = Interpreter(compile_source(data, {"licm": True}))
+        before.run()
+        after.run()
+        self.assertEqual(after.globals, before.globals)
+        self.assertLess(after.instructions, before.instructions * 0.8)
+        self.assertLess(after.counts["load"], 10)
+
+        # ループで変わらない大域変数の読み出しと計算は preheader に移す．
+        # 関数を呼び出すループの大域変数と，ループに入っても実行されるとは限らない配列の読み出しはそのまま
+        data = textwrap.dedent('''
+            program LA;
+            var n, k, s, x[0..9];
+            function f(a);
+            var i, t;
+            begin
+              i := 0; t := 0;
+              while i < a do
+              begin
+                t := t + k * 3 + x[i div 2] + x[a];
+                x[i] := t div 7;
+                i := i + 1
+              end;
+              f := t
+            end;
+            procedure g;
+            begin
+              k := k + 1
+            end;
+            begin
+              n := 0; k := 2; s := 0;
+              while n < 5 do
+              begin
+                s := s + f(n);
+                g;
+                if s > 30 then write(s) else write(n);
+                for k := 1 to 3 do s := s + k div 2;
+                n := n + 1
+              end;
+              write(s); write(k)
+            end.
+        ''')
+        expected = Interpreter(compile_source(data)).run()
+        for options in [{"licm": True}, {"mem2reg": True, "licm": True},
+                        {"mem2reg": True, "sccp": True, "gvn": True, "licm": True, "remove_deadcode": True}]:
+            ir = compile_source(data, options)
+            self.assertEqual(Interpreter(ir).run(), expected)
+        f = re.search(r"define i32 @f\(i32\)\{\n(.*?)\n\}", ir, re.S).group(1)
+        self.assertRegex(f.split("while.init")[0], r"load i32, i32\* @k.*\n.*mul nsw i32 %\d+, 3")
+        self.assertEqual(len(re.findall(r"= load i32, i32\* %", f.split("while.body")[-1])), 2)
+        main = re.search(r"define i32 @main\(\)\{\n(.*?)\n\}", ir, re.S).group(1)
+        self.assertIn("store i32 %", main.split("for.body")[0])
+
+    def test_loop_rotation(self):
+        # 回転した while は 1 回の繰り返しで br i1 を 1 つだけ実行する
+        with open("pscripts/pl0a.p") as f:
+            data = f.read()
+        base = Interpreter(compile_source(data))
+        base.run()
+        for options in [{"while_rotation": True}, {"loop_rotation": True}, {"mem2reg": True, "loop_rotation": True}]:
+            rotated = Interpreter(compile_source(data, options))
+            rotated.run()
+            if "mem2reg" not in options:
+                self.assertEqual(rotated.globals, base.globals)
+            self.assertLessEqual(rotated.counts["branch"], base.counts["branch"] - 10)
+            self.assertLessEqual(rotated.counts["br"], 1)
+
+        ir = compile_source(data, {"while_rotation": True})
+        self.assertIn("br label %while.init.0\n  while.init.0:", ir)
+        self.assertRegex(ir, r"icmp sgt i32 %\d+, 0\n  br i1 %\d+, label %while.body.0, label %while.end.0\n  while.end.0:")
+
+        # header の値はループの中では本体の phi，ループの後では出口の phi で受け取る
+        ir = compile_source(data, {"mem2reg": True, "loop_rotation": True})
+        self.assertNotIn("while.init", ir)
+        self.assertIn("%1 = phi i32 [ 10, %entry ], [ %4, %while.body.0 ]", ir)
+        data = textwrap.dedent('''
+            program R;
+            var n, s;
+            function f(x);
+            var k;
+            begin
+              k := 0;
+              while k * k < x do k := k + 1;
+              f := k
+            end;
+            begin
+              n := 0;
+              while n < 6 do
+              begin
+                s := 0;
+                while s < n do s := s + f(n);
+                write(s);
+                n := n + 1
+              end
+            end.
+        ''')
+        expected = Interpreter(compile_source(data)).run()
+        for options in [{"while_rotation": True}, {"loop_rotation": True}, {"mem2reg": True, "loop_rotation": True},
+                        {"while_rotation": True, "mem2reg": True, "sccp": True, "gvn": True, "licm": True},
+                        {"mem2reg": True, "sccp": True, "gvn": True, "loop_rotation": True, "licm": True,
+                         "remove_deadcode": True}]:
+            self.assertEqual(Interpreter(compile_source(data, options)).run(), expected)
+        for engine in ["ply", "rd"]:
+            ir = compile_source(data, {"while_rotation": True}, engine=engine)
+            self.assertEqual(ir.count("br i1"), 6)
+
+        # 出口の phi が末尾から受け取る値は，本体で読まれない本体の phi のこともある
+        data = textwrap.dedent('''
+            program S;
+            var a, b, c, t;
+            begin
+              read(a); read(b); read(c);
+              while c > 0 do begin t := a; a := b; b := t; c := c - 1 end;
+              write(a); write(b)
+            end.
+        ''')
+        ir = compile_source(data, {"mem2reg": True, "loop_rotation": True})
+        for c in [0, 1, 2, 3]:
+            self.assertEqual(Interpreter(ir, stdin=[5, 7, c]).run(), [5, 7] if c % 2 == 0 else [7, 5])
+
+    def test_strength_reduction(self):
+        # 配列を走査する for の添字 i - 1 は，0 から 1 ずつ増える変数になり，i は取り除かれる
+        data = textwrap.dedent('''
+            program S;
+            var i, n, s, a[1..101], b[0..99];
+            begin
+              n := 100;
+              for i := 1 to n do a[i] := i * 3;
+              for i := 1 to n do b[i - 1] := a[i] + a[i + 1] * 2;
+              s := 0;
+              for i := 1 to n do s := s + a[i] - b[i - 1];
+              write(s);
+              i := 10;
+              while i > 0 do begin s := s + a[11 - i]; i := i - 1 end;
+              write(s);
+              write(i)
+            end.
+        ''')
+        base = Interpreter(compile_source(data, {"mem2reg": True, "gvn": True, "remove_deadcode": True}))
+        expected = base.run()
+        options = {"mem2reg": True, "gvn": True, "strength_reduction": True, "remove_deadcode": True}
+        reduced = Interpreter(compile_source(data, options))
+        self.assertEqual(reduced.run(), expected)
+        self.assertLess(reduced.counts["binary"], base.counts["binary"] - 300)
+        self.assertEqual(reduced.counts["icmp"], base.counts["icmp"])
+
+        ir = compile_source(data, options)
+        self.assertIn("phi i32 [ 0, %entry ], [", ir)
+        self.assertIn("phi i32 [ 3, %entry ], [", ir)
+        self.assertRegex(ir, r"icmp sle i32 %\d+, 99\n")
+        for options in [{"mem2reg": True, "strength_reduction": True},
+                        {"mem2reg": True, "sccp": True, "gvn": True, "loop_rotation": True, "licm": True,
+                         "strength_reduction": True, "remove_deadcode": True},
+                        {"while_rotation": True, "licm": True, "strength_reduction": True}]:
+            self.assertEqual(Interpreter(compile_source(data, options)).run(), expected)
+
+    def test_unroll(self):
+        # 回数が定数の for は，小さければ完全に，大きければ何回分かずつまとめて展開する
+        data = textwrap.dedent('''
+            program U;
+            var i, s, a[1..40];
+            begin
+              for i := 1 to 4 do a[i] := i * i;
+              s := 0;
+              for i := 1 to 4 do s := s + a[i];
+              write(s);
+              for i := 1 to 37 do begin a[i] := a[i] + i; if a[i] > 20 then s := s + 1 end;
+              write(s);
+              write(i);
+              for i := 10 to 3 do write(i);
+              write(i)
+            end.
+        ''')
+        base = Interpreter(compile_source(data, {"mem2reg": True, "sccp": True}))
+        expected = base.run()
+        self.assertEqual(expected, [30, 47, 38, 10, 11])
+        options = {"mem2reg": True, "sccp": True, "unroll": True}
+        unrolled = Interpreter(compile_source(data, options))
+        self.assertEqual(unrolled.run(), expected)
+        self.assertLess(unrolled.counts["condbr"], base.counts["condbr"] - 25)
+
+        ir = compile_source(data, options)
+        self.assertNotIn("for.condition.0", ir)
+        self.assertIn("store i32 16, i32* %", ir)
+        # 37 回は 3 回ずつ 12 回と，残りの 1 回を元のループで繰り返す
+        self.assertIn("icmp slt i32 %", ir)
+        self.assertRegex(ir, r"icmp slt i32 %\d+, 37\n")
+        self.assertIn("icmp sle i32 %", ir)
+
+        for options in [{"mem2reg": True, "unroll": True, "unroll_budget": 1000},
+                        {"mem2reg": True, "unroll": True, "unroll_budget": 0},
+                        {"mem2reg": True, "sccp": True, "unroll": True, "gvn": True, "licm": True,
+                         "strength_reduction": True, "remove_deadcode": True}]:
+            self.assertEqual(Interpreter(compile_source(data, options)).run(), expected)
+        ir = compile_source(data, {"mem2reg": True, "unroll": True, "unroll_budget": 1000})
+        self.assertNotIn("for.condition", ir)
+
+        # 多くのループを持つ関数でも，複製を並べる位置を探すのに時間がかからない
+        body  = "    for i := 1 to 3 do s := s + i;\n" * 6000
+        data  = f"program L;\nvar s;\nprocedure p(a);\nvar i;\nbegin\n{body}    s := s + a\nend;\nbegin p(1); write(s) end.\n"
+        start = time.perf_counter()
+        ir    = compile_source(data, {"mem2reg": True, "unroll": True})
+        self.assertLess(time.perf_counter() - start, 15)
+        self.assertNotIn("br i1", ir)
+
+    def test_inline(self):
+        # 小さな関数の呼び出しは本体に置き換わり，定数の引数は呼び出し元で畳み込まれる
+        options = {"inline": True, "mem2reg": True, "sccp": True, "remove_deadcode": True}
+        for filename in ["pscripts/opt2.p", "pscripts/proc.p"]:
+            with open(filename) as f:
+                ir = compile_source(f.read(), options)
+            main = ir[ir.index("define i32 @main"):]
+            self.assertNotIn("call i32 @", main)
+            self.assertNotIn("br ", main)
+        with open("pscripts/opt2.p") as f:
+            self.assertIn("i32 6)", compile_source(f.read(), options))
+
+        # forward で宣言した関数・再帰する関数・配列を持つ関数
+        data = textwrap.dedent('''
+            program I;
+            var s, k;
+            forward function even(n);
+            function odd(n);
+            begin
+              if n = 0 then odd := 0 else odd := even(n - 1)
+            end;
+            function even(n);
+            begin
+              if n = 0 then even := 1 else even := odd(n - 1)
+            end;
+            function sq(n);
+            var b[1..2];
+            begin
+              b[1] := n; b[2] := n * n; sq := b[1] + b[2]
+            end;
+            function fact(n);
+            begin
+              if n <= 1 then fact := 1 else fact := n * fact(n - 1)
+            end;
+            begin
+              s := 0;
+              for k := 1 to 5 do s := s + sq(k) + even(k) * 100;
+              write(s);
+              write(fact(6));
+              write(odd(7))
+            end.
+        ''')
+        base     = Interpreter(compile_source(data, {"mem2reg": True}))
+        expected = base.run()
+        self.assertEqual(expected, [270, 720, 1])
+        inlined = Interpreter(compile_source(data, {"inline": True, "mem2reg": True}))
+        self.assertEqual(inlined.run(), expected)
+        self.assertLess(inlined.counts["call"], base.counts["call"])
+        ir = compile_source(data, {"inline": True, "mem2reg": True})
+        main = ir[ir.index("define i32 @main"):]
+        self.assertNotIn("call i32 @sq(", main)
+        self.assertIn("call i32 @fact(", main)
+        for options in [{"inline": True},
+                        {"inline": True, "mem2reg": True, "sccp": True, "unroll": True, "gvn": True, "licm": True,
+                         "strength_reduction": True, "remove_deadcode": True}]:
+            ir = compile_source(data, options)
+            self.assertEqual(Interpreter(ir).run(), expected)
+            # odd は後で定義する even を展開するので，関数ごとに書き出すときは even の定義まで待つ
+            out = io.StringIO()
+            Compiler(options).compile_to(data, out)
+            self.assertEqual(sorted(out.getvalue().split("\n")), sorted((ir + "\n").split("\n")))
+
+    def test_tail_calls(self):
+        # 互いに末尾で呼び出す手続きは 1 つの関数のループにまとまり，元の手続きはその関数を呼び出すだけになる
+        with open("pscripts/pl4a.p") as f:
+            data = f.read()
+        ir = compile_source(data, {"tail_calls": True})
+        self.assertIn("define i32 @proc1.dispatch(i32){", ir)
+        self.assertIn("tail call i32 @proc1.dispatch(i32 0)", ir)
+        self.assertEqual(Interpreter(ir).run(), Interpreter(compile_source(data)).run())
+
+        # 自分自身の末尾の呼び出しはループになる．互いに再帰する関数は深く再帰しても Python の再帰の上限に届かない
+        data = textwrap.dedent('''
+            program T;
+            var n, s;
+            forward function even(n);
+            function odd(n);
+            begin
+              if n = 0 then odd := 0 else odd := even(n - 1)
+            end;
+            function even(n);
+            begin
+              if n = 0 then even := 1 else even := odd(n - 1)
+            end;
+            function gcd(a, b);
+            begin
+              if b = 0 then gcd := a else if a < b then gcd := gcd(b, a) else gcd := gcd(a - b, b)
+            end;
+            procedure count(k);
+            begin
+              s := s + k;
+              if k > 0 then count(k - 1)
+            end;
+            begin
+              read(n);
+              s := 0;
+              count(n);
+              write(s);
+              write(gcd(n * 6, 84));
+              write(even(n));
+              write(odd(n))
+            end.
+        ''')
+        expected = Interpreter(compile_source(data, {"mem2reg": True}), stdin=[10]).run()
+        self.assertEqual(expected, [55, 12, 1, 0])
+        for options in [{"tail_calls": True},
+                        {"mem2reg": True, "tail_calls": True},
+                        {"inline": True, "mem2reg": True, "sccp": True, "tail_calls": True, "gvn": True,
+                         "loop_rotation": True, "licm": True, "remove_deadcode": True}]:
+            ir = compile_source(data, options)
+            self.assertEqual(Interpreter(ir, stdin=[10]).run(), expected)
+            if options.get("mem2reg"):
+                # 関数の返り値は mem2reg で変数を使わなくなってから末尾の呼び出しとわかる
+                gcd = ir[ir.index("define i32 @gcd"):]
+                gcd = gcd[:gcd.index("}")]
+                self.assertIn("tailrecurse", gcd)
+                self.assertNotIn("call i32 @gcd(", gcd)
+            out = io.StringIO()
+            Compiler(options).compile_to(data, out)
+            self.assertEqual(sorted(out.getvalue().split("\n")), sorted((ir + "\n").split("\n")))
+        ir = compile_source(data, {"mem2reg": True, "tail_calls": True})
+        self.assertEqual(Interpreter(ir, stdin=[100000]).run(), [5000050000 % 2 ** 32, 12, 1, 0])
+
+    def test_compile_in_process(self):
+        # 同じプロセス内で繰り返しコンパイルしても状態が漏れない
+        compiler = Compiler()
+        for filename in ["pscripts/pl3a.p", "pscripts/arr.p", "pscripts/pl4a.p"]:
+            expected = self.execute(filename)
+            with open(filename) as f:
+                data = f.read()
+            self.assertEqual(expected, compile_source(data))
+            self.assertEqual(expected, compiler.compile(data))
+            self.assertEqual(expected, compiler.compile(data))
+
+    def test_parse_tables(self):
+        # 文法のハッシュ値に対応しない古い表は消され，新しい表が生成される
+        parser.build_tables()
+        signature = parser.grammar_signature()
+        stale     = os.path.join(parser.TABLE_DIR, f"{parser.PARSETAB_NAME}_0000000000000000.py")
+        with open(stale, mode='w') as f:
+            f.write("broken")
+        os.remove(os.path.join(parser.TABLE_DIR, f"{parser.PARSETAB_NAME}_{signature}.py"))
+
+        parser.build_tables()
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(os.path.join(parser.TABLE_DIR, f"{parser.PARSETAB_NAME}_{signature}.py")))
+        self.assertTrue(os.path.exists(os.path.join(parser.TABLE_DIR, f"{parser.LEXTAB_NAME}_{signature}.py")))
+
+    def tokens(self, lexer, data):
+        lexer.input(data)
+        result = []
+        while True:
+            t = lexer.token()
+            if t is None:
+                return result
+            result.append((t.type, t.value, t.lineno, t.lexpos))
+
+    def test_fast_lexer(self):
+        # FastLexer は PLY の字句解析器と同じトークン列を返す
+        for filename in sorted(glob.glob("pscripts/*.p")):
+            with open(filename) as f:
+                data = f.read()
+            ply_lexer = parser.get_lexer().clone()
+            ply_lexer.lineno = 1
+            self.assertEqual(self.tokens(ply_lexer, data), self.tokens(FastLexer(parser.reserved), data), filename)
+
+        data = "x:=y..z<>a<=b>=c:d # comment\n\n  007 begin BEGIN\t12ab[1..2]."
+        ply_lexer = parser.get_lexer().clone()
+        ply_lexer.lineno = 1
+        self.assertEqual(self.tokens(ply_lexer, data), self.tokens(FastLexer(parser.reserved), data))
+
+    def test_compile_fast_lexer(self):
+        for filename in sorted(glob.glob("pscripts/*.p")):
+            with open(filename) as f:
+                data = f.read()
+            self.assertEqual(compile_source(data), compile_source(data, lexer='fast'), filename)
+
+    def test_rd_parser(self):
+        # 再帰下降の構文解析器は PLY と同じ LLVM IR を生成する
+        options = [None, {"constant_folding": True, "remove_deadcode": True}]
+        for filename in sorted(glob.glob("pscripts/*.p")):
+            with open(filename) as f:
+                data = f.read()
+            for option in options:
+                expected = compile_source(data, option)
+                self.assertEqual(expected, compile_source(data, option, engine='rd'), filename)
+                self.assertEqual(expected, compile_source(data, option, lexer='fast', engine='rd'), filename)
+
+    def test_rd_parser_unary(self):
+        data = "program U; var x, y; begin x := -y * 2 + 3; y := +x - 1; x := -(x + y) div 2 end."
+        self.assertEqual(compile_source(data), compile_source(data, lexer='fast', engine='rd'))
+
+    def test_rd_parser_error(self):
+        with self.assertRaises(RuntimeError):
+            compile_source("program E; var x; begin x := end.", lexer='fast', engine='rd')
+        with self.assertRaises(RuntimeError):
+            compile_source("program E; begin end. x", lexer='fast', engine='rd')
+
     def test_ex1(self):
         actual = self.execute("pscripts/ex1.p")
         expected = textwrap.dedent(r'''
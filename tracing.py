@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+from typing import Optional, TextIO
+
+ENABLE_COLOR = True
+
+# トレースの詳しさ
+TRACE_OFF   = 0  # 何も出力しない
+TRACE_INFO  = 1  # 関数ごとの要約 (デッドコード削除の結果・局所変数の削除など)
+TRACE_DEBUG = 2  # 記号表の追加・検索，依存関係の 1 つ 1 つまで出力する
+
+TRACE_FORMATS = ('text', 'json')
+
+
+def colored(s: str, color: str):
+    if not ENABLE_COLOR:
+        return s
+    if color == 'red':
+        return f'\033[31m{s}\033[0m'
+    if color == 'yellow':
+        return f'\033[33m{s}\033[0m'
+    if color == 'green':
+        return f'\033[32m{s}\033[0m'
+    return s
+
+
+class Tracer(object):
+    '''
+    記号表やデッドコード削除のトレースの出力先．
+    LLVM IR とは別のストリーム (標準エラー出力・ファイル) に，テキストか 1 行 1 つの JSON で書き出す．
+    呼び出し側は enabled() が False のときはメッセージを組み立てないこと．
+    '''
+
+    def __init__(self, level: int = TRACE_OFF, stream: Optional[TextIO] = None, format: str = 'text'):
+        super().__init__()
+        if format not in TRACE_FORMATS:
+            raise ValueError(f'KeyError: {format}')
+        self.level  = level
+        self.stream = stream if stream is not None else sys.stderr
+        self.format = format
+        self.color  = format == 'text' and hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._owns_stream = False
+
+    @classmethod
+    def open(cls, level: int, path: Optional[str] = None, format: str = 'text'):
+        '''
+        path が None か '-' のときは標準エラー出力に書き出す
+        '''
+        if level <= TRACE_OFF or path is None or path == '-':
+            return cls(level, format=format)
+        tracer = cls(level, open(path, mode='w', encoding='utf-8'), format)
+        tracer._owns_stream = True
+        return tracer
+
+    def enabled(self, level: int = TRACE_INFO) -> bool:
+        return self.level >= level
+
+    def emit(self, event: str, message: str, color: Optional[str] = None, **fields):
+        if self.format == 'json':
+            record = {'event': event, 'message': message}
+            record.update(fields)
+            line = json.dumps(record, ensure_ascii=False, default=str)
+        else:
+            line = colored(message, color) if color and self.color else message
+        self.stream.write(line + '\n')
+
+    def close(self):
+        if self._owns_stream:
+            self.stream.close()
+        else:
+            self.stream.flush()
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Optional, Tuple
+
+from cfg import CFG, BasicBlock, clone_code, label_factor, register_of, replace_uses, used_values
+from decls import Factor, Fundecl
+from indvars import basic_variables, constant_of
+from llvmcodes import (CmpType, LLVMCode, LLVMCodeBrCond, LLVMCodeBrUncond, LLVMCodeIcmp, LLVMCodePhi, Opcode,
+                       fold_binary, INT32_MAX, INT32_MIN)
+from loops import Loop, insert_preheader, loop_forest
+from symtab import Scope
+from tracing import TRACE_INFO
+
+# 展開した後のループの命令数の上限 (繰り返し回数 * ループの命令数がこれ以下なら完全に展開する)
+UNROLL_BUDGET = 64
+
+# 部分展開で 1 回の繰り返しに並べる本体の数の上限
+UNROLL_MAX_FACTOR = 8
+
+# 定数を畳み込める命令
+FOLDABLE = frozenset((Opcode.ADD, Opcode.SUB, Opcode.MUL, Opcode.SDIV))
+
+# 比較の向きを変えたもの (a < b と b > a) / 否定したもの (a < b と a >= b)
+SWAPPED = {CmpType.EQ: CmpType.EQ, CmpType.NE: CmpType.NE, CmpType.SLT: CmpType.SGT,
+           CmpType.SLE: CmpType.SGE, CmpType.SGT: CmpType.SLT, CmpType.SGE: CmpType.SLE}
+NEGATED = {CmpType.EQ: CmpType.NE, CmpType.NE: CmpType.EQ, CmpType.SLT: CmpType.SGE,
+           CmpType.SLE: CmpType.SGT, CmpType.SGT: CmpType.SLE, CmpType.SGE: CmpType.SLT}
+
+
+def trip_count(cmptype: CmpType, first: int, step: int, bound: int) -> Optional[int]:
+    '''
+    本体を 1 回実行するごとに first, first + step, ... と比べ，first + k * step (cmptype) bound が成り立つ間は繰り返すときの，
+    本体を実行する回数 (for と同じく最初の 1 回は比べずに実行する)．求まらないときは None．
+    '''
+    if not cmptype.evaluate(first, bound):
+        return 1
+    if cmptype in (CmpType.SLT, CmpType.SLE) and step > 0:
+        limit = bound - 1 if cmptype == CmpType.SLT else bound
+        return (limit - first) // step + 2
+    if cmptype in (CmpType.SGT, CmpType.SGE) and step < 0:
+        limit = bound + 1 if cmptype == CmpType.SGT else bound
+        return (first - limit) // -step + 2
+    if cmptype == CmpType.NE and (bound - first) % step == 0 and (bound - first) // step > 0:
+        return (bound - first) // step + 1
+    return None
+
+
+class Unroller(object):
+    '''
+    繰り返し回数が定数のループの展開．
+    ループ (内側にループを持たず，header に戻るブロックだけがループを出るもの) のブロックを繰り返しの回数分複製して並べる．
+    '''
+
+    def __init__(self, fn: Fundecl, cfg: CFG, budget: int):
+        super().__init__()
+        self.fn     = fn
+        self.cfg    = cfg
+        self.budget = budget
+        # レジスタ -> それを定義する (命令, ブロック) / それを読む (命令, ブロック)
+        self.defs:  Dict[int, Tuple[LLVMCode, BasicBlock]]       = {}
+        self.users: Dict[int, List[Tuple[LLVMCode, BasicBlock]]] = {}
+        # id(ブロック) -> 展開を始める前の並びでの位置 (複製は元のブロックの間に入るので，元のブロックの前後は変わらない)
+        self.position: Dict[int, int] = {}
+        for i, block in enumerate(cfg.blocks):
+            self.position[id(block)] = i
+            for code in block.codes:
+                self.add_code(code, block)
+        self.full = self.partial = 0
+
+    def add_code(self, code: LLVMCode, block: BasicBlock):
+        if code.defines is not None:
+            r = register_of(getattr(code, code.defines))
+            if r is not None:
+                self.defs[r] = (code, block)
+        for value in used_values(code):
+            r = register_of(value)
+            if r is not None:
+                self.users.setdefault(r, []).append((code, block))
+
+    def analyze(self, loop: Loop) -> Optional[Tuple[int, LLVMCodePhi, LLVMCode, int, LLVMCode]]:
+        '''
+        (繰り返し回数, 帰納変数の phi, 増やす命令, step, ループを続けるかの比較)．展開できないループなら None．
+        '''
+        latch = loop.latches[0]
+        t     = latch.terminator
+        if t is None or t.opcode != Opcode.BR_COND or loop.exiting != [latch] or len(loop.children) > 0:
+            return None
+        exit = latch.succs[0] if latch.succs[1] is loop.header else latch.succs[1]
+        if loop.header not in latch.succs or exit.preds != [latch]:
+            return None
+        if any(len(phi.values) != 2 for phi in loop.header.phis()):
+            return None
+        found = self.defs.get(register_of(t.arg1))
+        if found is None or found[0].opcode != Opcode.ICMP or found[1] not in loop:
+            return None
+        compare = found[0]
+
+        for phi, start, increment, step in basic_variables(self.cfg, loop, self.defs):
+            if constant_of(start) is None:
+                continue
+            cmptype = compare.cmptype
+            value, bound = register_of(compare.arg1), compare.arg2
+            if constant_of(bound) is None:
+                value, bound, cmptype = register_of(compare.arg2), compare.arg1, SWAPPED[cmptype]
+            if constant_of(bound) is None or value not in (phi.retval.val, increment.retval.val):
+                continue
+            if t.arg2.val != loop.header.label:
+                cmptype = NEGATED[cmptype]
+            first = start.val if value == phi.retval.val else start.val + step
+            count = trip_count(cmptype, first, step, bound.val)
+            if count is None or not INT32_MIN <= start.val + count * step <= INT32_MAX:
+                continue
+            return count, phi, increment, step, compare
+        return None
+
+    def label(self, block: BasicBlock, copy: int) -> str:
+        label = f"{block.label}.{copy}"
+        return label if label not in self.cfg.labels else self.cfg.new_label(f"{block.label}.u")
+
+    def clone(self, loop: Loop, copy: int, values: Dict[int, Factor], after: BasicBlock, skip: Optional[LLVMCode],
+              pending: Dict[int, Tuple[BasicBlock, LLVMCode]]) -> Tuple[Dict[int, Factor], Dict[str, BasicBlock]]:
+        '''
+        ループの本体を 1 つ複製して after の後に並べる．header の phi の値は values を使う．
+        終端命令は全てのブロックを作ってから付けるので pending (id(ブロック) -> (ブロック, 終端命令)) に加える．
+        '''
+        cfg     = self.cfg
+        replace = dict(values)
+        blocks: Dict[str, BasicBlock] = {}
+        for block in loop.blocks:
+            after = blocks[block.label] = cfg.add_block(self.label(block, copy), after=after)
+        labels = {label: b.label for label, b in blocks.items()}
+
+        for block in loop.blocks:
+            new = blocks[block.label]
+            for code in block.codes:
+                if code is skip or (block is loop.header and code.opcode == Opcode.PHI):
+                    continue
+                if code is block.terminator:
+                    if code.opcode == Opcode.BR_UNCOND:
+                        t = LLVMCodeBrUncond(label_factor(labels.get(code.arg1.val, code.arg1.val)))
+                    else:
+                        t = LLVMCodeBrCond(replace.get(register_of(code.arg1), code.arg1),
+                                           label_factor(labels.get(code.arg2.val, code.arg2.val)),
+                                           label_factor(labels.get(code.arg3.val, code.arg3.val)))
+                    pending[id(new)] = (new, t)
+                    continue
+                if code.opcode in FOLDABLE:
+                    a = replace.get(register_of(code.arg1), code.arg1)
+                    b = replace.get(register_of(code.arg2), code.arg2)
+                    if constant_of(a) is not None and constant_of(b) is not None:
+                        folded = fold_binary(code.opcode, a.val, b.val)
+                        if folded is not None:
+                            replace[code.retval.val] = Factor(Scope.CONSTANT, val=folded)
+                            continue
+                clone = clone_code(code, replace, self.fn.register)
+                if clone.opcode == Opcode.PHI:
+                    clone.labels = [label_factor(labels[l.val]) for l in clone.labels]
+                new.codes.append(clone)
+                self.add_code(clone, new)
+        return replace, blocks
+
+    def incoming(self, loop: Loop, label: str, replace: Dict[int, Factor]) -> Dict[int, Factor]:
+        '''
+        header の phi の，label から来たときの値 (replace で置き換える)
+        '''
+        values = {}
+        for phi in loop.header.phis():
+            value = phi.values[[l.val for l in phi.labels].index(label)]
+            values[phi.retval.val] = replace.get(register_of(value), value)
+        return values
+
+    def leave(self, loop: Loop, exit: BasicBlock, latch: BasicBlock, replace: Dict[int, Factor]):
+        '''
+        ループの後で読むループの中の値を，latch (最後に実行する複製の末尾) までに求めた値にする
+        '''
+        self.cfg.rename_incoming(exit, self.cfg.label_of(loop.latches[0]), latch.label)
+        outside = {r: f for r, f in replace.items() if r in self.defs and self.defs[r][1] in loop}
+        for r in outside:
+            for code, block in self.users.get(r, []):
+                if block not in loop:
+                    replace_uses(code, outside)
+
+    def unroll(self, loop: Loop) -> bool:
+        found = self.analyze(loop)
+        if found is None:
+            return False
+        count, phi, increment, step, compare = found
+        cfg       = self.cfg
+        preheader = loop.preheader
+        header    = loop.header
+        latch     = loop.latches[0]
+        exit      = next(s for s in latch.succs if s is not header)
+        size      = sum(1 for block in loop.blocks for code in block.codes if code.opcode != Opcode.PHI)
+        # ループを続けるかの比較は，分岐のほかで使わなければ複製しない
+        skip      = compare if len(self.users.get(compare.retval.val, [])) == 1 else None
+        after     = cfg.previous(min(loop.blocks, key=lambda b: self.position[id(b)]))
+        pre_label = cfg.label_of(preheader)
+
+        if count * size <= self.budget:
+            # 完全な展開: 繰り返しの回数だけ本体を並べ，header に戻る分岐は次の複製への分岐にする
+            factor, chunks, rest = count, 1, 0
+            values = self.incoming(loop, pre_label, {})
+        else:
+            # 部分展開: factor 個の本体を並べたループを chunks 回繰り返し，残りの rest 回は元のループで繰り返す
+            factor = min(UNROLL_MAX_FACTOR, self.budget // size, count // 2)
+            if factor < 2:
+                return False
+            factor = next((k for k in range(factor, 1, -1) if count % k == 0), factor)
+            chunks, rest = divmod(count, factor)
+            phis   = [LLVMCodePhi(Factor(Scope.LOCAL, val=self.fn.register())) for _ in header.phis()]
+            values = {p.retval.val: new.retval for p, new in zip(header.phis(), phis)}
+
+        pending: Dict[int, Tuple[BasicBlock, LLVMCode]] = {}
+        copies:  List[Tuple[Dict[int, Factor], Dict[str, BasicBlock]]] = []
+        for copy in range(factor):
+            replace, blocks = self.clone(loop, copy, values, after, skip, pending)
+            after  = blocks[loop.blocks[-1].label]
+            values = self.incoming(loop, cfg.label_of(latch), replace)
+            copies.append((replace, blocks))
+        for copy in range(factor - 1):
+            new_latch = copies[copy][1][latch.label]
+            pending[id(new_latch)] = (new_latch, LLVMCodeBrUncond(label_factor(copies[copy + 1][1][header.label].label)))
+
+        first, last = copies[0][1][header.label], copies[-1][1][latch.label]
+        after_loop  = header if rest > 0 else exit
+        if chunks == 1:
+            pending[id(last)] = (last, LLVMCodeBrUncond(label_factor(after_loop.label)))
+        else:
+            for p, new in zip(header.phis(), phis):
+                new.add_incoming(p.values[[l.val for l in p.labels].index(pre_label)], label_factor(pre_label))
+                new.add_incoming(values[p.retval.val], label_factor(last.label))
+            first.codes[0:0] = phis
+            for new in phis:
+                self.add_code(new, first)
+            # 帰納変数が chunks * factor 回分進んだらループを出る
+            end   = Factor(Scope.CONSTANT, val=phi.values[[l.val for l in phi.labels].index(pre_label)].val + chunks * factor * step)
+            check = LLVMCodeIcmp(CmpType.SLT if step > 0 else CmpType.SGT, copies[-1][0][increment.retval.val], end,
+                                 Factor(Scope.LOCAL, val=self.fn.register()))
+            last.codes.append(check)
+            self.add_code(check, last)
+            pending[id(last)] = (last, LLVMCodeBrCond(check.retval, label_factor(first.label), label_factor(after_loop.label)))
+        for block, t in pending.values():
+            cfg.set_terminator(block, t)
+
+        if rest > 0:
+            # 残りの繰り返しは元のループで行う
+            for p in header.phis():
+                index = [l.val for l in p.labels].index(pre_label)
+                p.values[index] = values[p.retval.val]
+                p.labels[index] = label_factor(last.label)
+            self.partial += 1
+        else:
+            self.leave(loop, exit, last, copies[-1][0])
+            if chunks == 1:
+                self.full += 1
+            else:
+                self.partial += 1
+        cfg.retarget(preheader, header, first)
+        return True
+
+
+def unroll_loops(fn: Fundecl, cfg: CFG, budget: int = UNROLL_BUDGET) -> bool:
+    '''
+    ループの展開: 帰納変数の初期値と比べる値が定数で繰り返し回数が求まるループを，
+    本体の命令数 * 回数が budget 以下なら完全に展開し，そうでなければ本体を何個か並べて展開する (部分展開)．
+    '''
+    cfg.remove_unreachable()
+    forest = loop_forest(cfg)
+    if not len(forest) > 0:
+        return False
+    for loop in forest.loops:
+        if loop.preheader is None and len(loop.latches) == 1:
+            insert_preheader(fn, cfg, loop)
+
+    unroller = Unroller(fn, cfg, budget)
+    for loop in forest.loops:
+        if loop.preheader is not None and len(loop.latches) == 1:
+            unroller.unroll(loop)
+    if unroller.full + unroller.partial > 0:
+        cfg.remove_unreachable()
+        # 完全に展開した本体の複製を 1 つのブロックにつなげる
+        cfg.merge_blocks()
+
+    tracer = fn.tracer
+    if tracer.enabled(TRACE_INFO):
+        tracer.emit('unroll.summary', f"{fn.name}: {len(forest)}個のループのうち {unroller.full}個を完全に展開, "
+                    f"{unroller.partial}個を部分展開",
+                    function=fn.name, loops=len(forest), full=unroller.full, partial=unroller.partial)
+    return unroller.full + unroller.partial > 0